@@ -0,0 +1,3 @@
+from annotateEZ.cli import main
+
+main()
@@ -0,0 +1,173 @@
+import threading
+
+import numpy as np
+
+
+class EmbeddingFeatures:
+    """Event features from the embeddings of a `SimilarIndex`, standardized
+    by the mean and deviation of a sample of events."""
+
+    def __init__(self, similar, sample=65536):
+        self.similar = similar
+        rng = np.random.default_rng(0)
+        n = similar.offsets[-1]
+        vectors = similar.vectors(
+            np.sort(rng.choice(n, min(n, sample), replace=False)))
+        self.mean = vectors.mean(axis=0)
+        self.std = np.maximum(vectors.std(axis=0), 1e-6)
+        self.dim = vectors.shape[1]
+
+    def rows(self, ids):
+        return((self.similar.vectors(ids) - self.mean) / self.std)
+
+    def blocks(self, chunk=65536):
+        "Yield the ids and features of all events, in storage order."
+        for i, index in enumerate(self.similar.files):
+            for start in range(0, len(index['ids']), chunk):
+                ids = index['ids'][start:start + chunk] \
+                    + self.similar.offsets[i]
+                vectors = index['vectors'][start:start + chunk]
+                yield(ids, (vectors - self.mean) / self.std)
+
+
+class ColumnFeatures:
+    """Event features from numeric data columns, standardized.
+
+    Columns are read on first use, missing values are set to the mean.
+    """
+
+    def __init__(self, get_column, names, n_events):
+        self.get_column = get_column
+        self.names = list(names)
+        self.n_events = n_events
+        self.dim = len(self.names)
+        self.stats = None
+
+    def rows(self, ids):
+        if self.stats is None:
+            self.stats = []
+            for name in self.names:
+                values = self.get_column(name)
+                std = np.nanstd(values)
+                self.stats.append((np.nanmean(values), std if std else 1.0))
+        out = np.empty((len(ids), self.dim), dtype='float32')
+        for j, name in enumerate(self.names):
+            mean, std = self.stats[j]
+            out[:, j] = (self.get_column(name)[ids] - mean) / std
+        return(np.nan_to_num(out, copy=False))
+
+    def blocks(self, chunk=65536):
+        for start in range(0, self.n_events, chunk):
+            ids = np.arange(start, min(start + chunk, self.n_events))
+            yield(ids, self.rows(ids))
+
+
+class ActiveLearner:
+    """Queue of the unreviewed events a classifier is least sure about.
+
+    Events count as reviewed once their page was shown and saved, and
+    events with a label from an earlier session are reviewed from the
+    start. A softmax regression on the `features` of the reviewed events
+    is trained by minibatch SGD, warm started from the previous weights,
+    so each refresh only needs a few epochs. Classes are weighted by
+    their inverse frequency, as most reviewed events are negatives.
+
+    Unreviewed events are then ranked by the margin between their two
+    most likely classes, smallest first, and the `queue_size` most
+    uncertain are kept. A refresh is due every `refresh` newly reviewed
+    events.
+    """
+
+    def __init__(self, features, n_classes, labels, refresh=500,
+                 queue_size=2000, learning_rate=1.0, epochs=10, l2=1e-4,
+                 batch=256):
+        self.features = features
+        self.n_classes = n_classes
+        self.refresh = refresh
+        self.queue_size = queue_size
+        self.learning_rate = learning_rate
+        self.epochs = epochs
+        self.l2 = l2
+        self.batch = batch
+        self.reviewed = np.asarray(labels) != 0
+        self.n_new = 0
+        self.weights = np.zeros((features.dim + 1, n_classes), 'float32')
+        self.lock = threading.Lock()
+        self.rng = np.random.default_rng(0)
+
+    def review(self, ids):
+        "Mark events as reviewed, return True when a refresh is due."
+        ids = np.asarray(ids, dtype='int64')
+        ids = ids[ids < len(self.reviewed)]
+        self.n_new += int(np.count_nonzero(~self.reviewed[ids]))
+        self.reviewed[ids] = True
+        return(self.n_new >= self.refresh)
+
+    def snapshot(self, labels):
+        """Ids and labels of the reviewed events and a copy of the reviewed
+        mask, taken in the thread that owns the labels."""
+        self.n_new = 0
+        ids = np.flatnonzero(self.reviewed)
+        return(ids, np.asarray(labels)[ids], self.reviewed.copy())
+
+    def fit(self, ids, labels):
+        "Train on the events `ids` with `labels`, return the classes seen."
+        classes = np.unique(labels)
+        if len(classes) < 2:
+            return(classes)
+        x = self.features.rows(ids)
+        x = np.hstack([x, np.ones((len(x), 1), dtype='float32')])
+        target = np.searchsorted(classes, labels)
+        counts = np.bincount(target)
+        sample_weight = (len(target) / (len(classes) * counts))[target]
+        weights = self.weights[:, classes]
+        for _ in range(self.epochs):
+            for batch in np.array_split(
+                    self.rng.permutation(len(x)),
+                    max(1, len(x) // self.batch)):
+                p = softmax(x[batch] @ weights)
+                p[np.arange(len(batch)), target[batch]] -= 1
+                p *= sample_weight[batch, None]
+                gradient = x[batch].T @ p / len(batch) + self.l2 * weights
+                weights -= self.learning_rate * gradient
+        self.weights[:, classes] = weights
+        return(classes)
+
+    def rank(self, classes, reviewed):
+        "Return the most uncertain unreviewed events, the least sure first."
+        queue_ids = np.empty(0, dtype='int64')
+        queue_margins = np.empty(0, dtype='float32')
+        weights = self.weights[:, classes]
+        for ids, x in self.features.blocks():
+            ids = np.asarray(ids, dtype='int64')
+            mask = ~reviewed[ids]
+            if not mask.any():
+                continue
+            ids, x = ids[mask], x[mask]
+            if len(classes) < 2:
+                margins = np.zeros(len(ids), dtype='float32')
+            else:
+                p = softmax(x @ weights[:-1] + weights[-1])
+                top = np.partition(p, -2, axis=1)
+                margins = top[:, -1] - top[:, -2]
+            queue_ids = np.concatenate([queue_ids, ids])
+            queue_margins = np.concatenate([queue_margins, margins])
+            if len(queue_ids) > self.queue_size:
+                keep = np.argpartition(
+                    queue_margins, self.queue_size)[:self.queue_size]
+                queue_ids, queue_margins = queue_ids[keep], queue_margins[keep]
+        # ties, e.g. before any positive, are shown in file order
+        order = np.lexsort((queue_ids, queue_margins))
+        return(queue_ids[order])
+
+    def update(self, ids, labels, reviewed):
+        "Retrain and rank from a `snapshot`, safe to run in a thread."
+        with self.lock:
+            classes = self.fit(ids, labels)
+            return(self.rank(classes, reviewed))
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    p = np.exp(logits)
+    return(p / p.sum(axis=1, keepdims=True))
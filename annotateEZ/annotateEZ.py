@@ -1,54 +1,40 @@
-from PyQt5.QtGui import *
-from PyQt5.QtWidgets import *
-from PyQt5.QtCore import *
-import pandas as pd
+from PyQt5.QtCore import (
+    QEvent, QRect, QSize, Qt, QThread, QTimer, pyqtSignal)
+from PyQt5.QtGui import (
+    QColor, QIcon, QImage, QKeySequence, QPainter, QPen, QPixmap)
+from PyQt5.QtWidgets import (
+    QApplication, QCheckBox, QComboBox, QDialog, QDoubleSpinBox, QFileDialog,
+    QGridLayout, QHBoxLayout, QLabel, QLineEdit, QMainWindow, QMenu,
+    QMessageBox, QProgressBar, QPushButton, QRadioButton, QRubberBand,
+    QShortcut, QSpinBox, QToolButton, QToolTip, QVBoxLayout, QWidget)
 import numpy as np
 import sys
 import os
-import h5py
-import yaml
+import time
 import logging
-# Input
-images = []
-df = pd.DataFrame()
+from collections import OrderedDict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from annotateEZ.active import ActiveLearner, ColumnFeatures, EmbeddingFeatures
+from annotateEZ.convert import CHANNEL_COLORS, DisplayTransform
+from annotateEZ.data import (
+    EventOrder, Prefetcher, Session, convert_page, session_paths)
+from annotateEZ.duplicates import read_groups
+from annotateEZ.journal import SessionJournal
+from annotateEZ.labels import LabelModel, LabelStore
+from annotateEZ.metadata import ColumnStore
+from annotateEZ.metrics import metrics
+from annotateEZ.order import EventIndex
+from annotateEZ.similar import SimilarIndex
+from annotateEZ.thumbnails import ThumbnailCache
 
 # Constants:
 script_dir = os.path.dirname(os.path.abspath(__file__))
 config_path = os.path.join(script_dir, 'config.yml')
 log_path    = os.path.join(script_dir, 'main.log')
 
-# Logger setup
 logger = logging.getLogger(__name__)
-c_handler = logging.StreamHandler()
-console_format = logging.Formatter("[%(levelname)s] %(message)s")
-c_handler.setFormatter(console_format)
-c_handler.setLevel(logging.INFO)
-logging.getLogger().addHandler(c_handler)
-f_handler = logging.FileHandler(filename=log_path, mode='w')
-f_format = logging.Formatter("%(asctime)s: [%(levelname)s] %(message)s")
-f_handler.setFormatter(f_format)
-f_handler.setLevel(logging.DEBUG)
-logging.getLogger().addHandler(f_handler)
-logging.getLogger().setLevel(logging.DEBUG)
-
-
-def channels2rgb8bit(image):
-    "Convert 4 channel images to 8-bit RGB color images."
-    assert(image.dtype == 'uint16')
-    image = image.astype('float')
-    if(len(image.shape) == 4):
-        image[:, :, :, 0:3] = image[:, :, :, [1,2,0]]
-        if(image.shape[3] > 3):
-            image = image[:, :, :, 0:3] + np.expand_dims(image[:, :, :, 3], 3)
-        
-    elif(len(image.shape) == 3):
-        image[:, :, 0:3] = image[:, :, [1, 2, 0]]
-        if(image.shape[2] > 3):
-            image = image[:, :, 0:3] + np.expand_dims(image[:, :, 3], 2)
-        
-    image[image > 65535] = 65535
-    image = (image // 256).astype('uint8')
-    return(image)
 
 
 # Classes
@@ -152,6 +138,198 @@ class TextBox(QWidget):
                 config[self.key] = int(self.textbox.text())
 
 
+class Channel(QWidget):
+
+    def __init__(self, id, on_change):
+        super().__init__()
+        self.id = id
+        self.on_change = on_change
+        channel = config['channels'][self.id]
+
+        self.checkbox = QCheckBox(channel['name'])
+        self.checkbox.setFixedWidth(72)
+        self.checkbox.setChecked(channel.get('active', True))
+        self.checkbox.stateChanged.connect(self.update_settings)
+        self.colorbox = QComboBox()
+        self.colorbox.addItems(list(CHANNEL_COLORS))
+        self.colorbox.setCurrentText(channel.get('color', 'none'))
+        self.colorbox.currentTextChanged.connect(self.update_settings)
+        self.minbox = QSpinBox()
+        self.minbox.setRange(0, 65535)
+        self.minbox.setValue(channel.get('min', 0))
+        self.minbox.valueChanged.connect(self.update_settings)
+        self.maxbox = QSpinBox()
+        self.maxbox.setRange(0, 65535)
+        self.maxbox.setValue(channel.get('max', 65535))
+        self.maxbox.valueChanged.connect(self.update_settings)
+        self.gammabox = QDoubleSpinBox()
+        self.gammabox.setRange(0.1, 5.0)
+        self.gammabox.setSingleStep(0.1)
+        self.gammabox.setValue(channel.get('gamma', 1.0))
+        self.gammabox.valueChanged.connect(self.update_settings)
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(5)
+        layout.addWidget(self.checkbox)
+        layout.addWidget(self.colorbox)
+        layout.addWidget(QLabel("min"))
+        layout.addWidget(self.minbox)
+        layout.addWidget(QLabel("max"))
+        layout.addWidget(self.maxbox)
+        layout.addWidget(QLabel("gamma"))
+        layout.addWidget(self.gammabox)
+
+        self.setLayout(layout)
+
+    def update_settings(self):
+        channel = config['channels'][self.id]
+        channel['active'] = self.checkbox.isChecked()
+        channel['color'] = self.colorbox.currentText()
+        channel['min'] = self.minbox.value()
+        channel['max'] = self.maxbox.value()
+        channel['gamma'] = round(self.gammabox.value(), 2)
+        self.on_change()
+
+
+class DisplayWindow(QWidget):
+
+    def __init__(self, on_change):
+        super().__init__()
+        self.on_change = on_change
+        layout = QVBoxLayout()
+        layout.setContentsMargins(10, 10, 10, 10)
+        layout.setSpacing(5)
+
+        self.modebox = QComboBox()
+        self.modebox.addItems(
+            ['rgb', 'gray'] + [c['name'] for c in config['channels']])
+        self.modebox.setCurrentText(config.get('display_mode', 'rgb'))
+        self.modebox.currentTextChanged.connect(self.update_mode)
+        mode_box = QHBoxLayout()
+        mode_box.addWidget(QLabel("show"))
+        mode_box.addWidget(self.modebox)
+        mode_box.addStretch()
+        layout.addLayout(mode_box)
+
+        self.channels = [Channel(id, on_change)
+                         for id in range(len(config['channels']))]
+        for channel in self.channels:
+            layout.addWidget(channel)
+        self.setLayout(layout)
+        self.setWindowTitle('Display')
+
+    def update_mode(self):
+        config['display_mode'] = self.modebox.currentText()
+        self.on_change()
+
+
+class OrderBar(QWidget):
+
+    # order of the active learning queue, next to the columns
+    UNCERTAIN = "uncertain first"
+
+    def __init__(self, on_apply):
+        super().__init__()
+        self.on_apply = on_apply
+
+        self.columnbox = QComboBox()
+        self.columnbox.setMinimumWidth(128)
+        self.columnbox.addItem("file order")
+        self.descendingbox = QCheckBox("descending")
+        self.lowbox = QLineEdit()
+        self.lowbox.setFixedWidth(96)
+        self.lowbox.setPlaceholderText("min")
+        self.highbox = QLineEdit()
+        self.highbox.setFixedWidth(96)
+        self.highbox.setPlaceholderText("max")
+        self.applybutton = QPushButton("apply")
+        self.applybutton.pressed.connect(self.apply)
+        # shown when the files have duplicate groups
+        self.collapsebox = QCheckBox("one per duplicate group")
+        self.collapsebox.setVisible(False)
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(QLabel("sort by"))
+        layout.addWidget(self.columnbox)
+        layout.addWidget(self.descendingbox)
+        layout.addWidget(QLabel("filter"))
+        layout.addWidget(self.lowbox)
+        layout.addWidget(self.highbox)
+        layout.addWidget(self.applybutton)
+        layout.addWidget(self.collapsebox)
+        layout.addStretch()
+
+        self.setLayout(layout)
+
+    def set_columns(self, columns, active=False, duplicates=False):
+        self.collapsebox.blockSignals(True)
+        self.collapsebox.setChecked(False)
+        self.collapsebox.blockSignals(False)
+        self.collapsebox.setVisible(duplicates)
+        self.columnbox.clear()
+        self.columnbox.addItem("file order")
+        if active:
+            self.columnbox.addItem(self.UNCERTAIN)
+        self.columnbox.addItems([str(column) for column in columns])
+
+    def apply(self):
+        column = None
+        if self.columnbox.currentIndex() > 0:
+            column = self.columnbox.currentText()
+        if column == self.UNCERTAIN:
+            self.on_apply(column, False, None, None)
+            return
+        try:
+            low = float(self.lowbox.text()) if self.lowbox.text() else None
+            high = float(self.highbox.text()) if self.highbox.text() else None
+        except ValueError:
+            QMessageBox.warning(self, 'Error', "Filter limits must be numbers!")
+            return
+        self.on_apply(column, self.descendingbox.isChecked(), low, high)
+
+
+class BulkBar(QWidget):
+
+    def __init__(self, on_apply):
+        super().__init__()
+        self.on_apply = on_apply
+
+        self.pagesbox = QLineEdit()
+        self.pagesbox.setFixedWidth(96)
+        self.pagesbox.setPlaceholderText("all pages")
+        self.labelbutton = QPushButton("label")
+        self.labelbutton.pressed.connect(
+            lambda: self.apply(config['active_label']))
+        self.junkbutton = QPushButton("junk")
+        self.junkbutton.pressed.connect(lambda: self.apply(0))
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(QLabel("bulk label pages"))
+        layout.addWidget(self.pagesbox)
+        layout.addWidget(self.labelbutton)
+        layout.addWidget(self.junkbutton)
+        layout.addStretch()
+
+        self.setLayout(layout)
+
+    def apply(self, label):
+        first = last = None
+        text = self.pagesbox.text().strip()
+        if text:
+            try:
+                parts = [int(part) for part in text.split('-')]
+            except ValueError:
+                QMessageBox.warning(
+                    self, 'Error', "Pages must be a number or a range "
+                                   "like 3-7!")
+                return
+            first, last = parts[0], parts[-1]
+        self.on_apply(label, first, last)
+
+
 class SettingWindow(QWidget):
 
     def __init__(self, *args, **kwargs):
@@ -205,85 +383,375 @@ class SettingWindow(QWidget):
             QFileDialog.ShowDirsOnly)
 
 
-class Pos(QWidget):
-    
-    def __init__(self, id, qImage, label, *args, **kwargs):
-        super(Pos, self).__init__(*args, **kwargs)
-        self.setFixedSize(QSize(config['tile_size'], config['tile_size']))
-        self.id = id
-        self.image = qImage
-        self.label = label
-        
-    def reset(self, id, qImage, label):
-        self.id = id
-        self.image = qImage
-        self.label = label
+class PixmapCache:
+    "LRU cache of tile pixmaps scaled to the tile size, bounded in bytes."
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        self.pixmaps = OrderedDict()
+
+    def get(self, key):
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        if key in self.pixmaps:
+            self.nbytes -= self.size(self.pixmaps.pop(key))
+        self.pixmaps[key] = pixmap
+        self.nbytes += self.size(pixmap)
+        while self.nbytes > self.budget and len(self.pixmaps) > 1:
+            _, old = self.pixmaps.popitem(last=False)
+            self.nbytes -= self.size(old)
+
+    def clear(self):
+        self.pixmaps.clear()
+        self.nbytes = 0
+
+    @staticmethod
+    def size(pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+class TileCanvas(QWidget):
+    """A page of tiles drawn from a single composited buffer.
+
+    Tiles are pixmaps already scaled to the tile size and are painted
+    once into `buffer`, and the widget blits the exposed part of it.
+    Clicks are mapped to tiles arithmetically and only the tile whose
+    label changed is painted again.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TileCanvas, self).__init__(*args, **kwargs)
+        self.ids = []
+        self.tiles = []
+        self.model = None
+        # returns the tooltip text of an event id
+        self.describe = None
+        # shows the events similar to an event id
+        self.find_similar = None
+        self.origin = None
+        self.band = QRubberBand(QRubberBand.Rectangle, self)
+        self.resize_grid(1, 1)
+
+    def resize_grid(self, x_size, y_size):
+        self.x_size = x_size
+        self.y_size = y_size
+        self.tile_size = config['tile_size']
+        self.buffer = QImage(
+            x_size * self.tile_size, y_size * self.tile_size,
+            QImage.Format_RGB32)
+        self.buffer.fill(Qt.black)
+        self.setFixedSize(self.buffer.size())
+
+    def tile_rect(self, i):
+        return QRect((i % self.x_size) * self.tile_size,
+                     (i // self.x_size) * self.tile_size,
+                     self.tile_size, self.tile_size)
+
+    def tile_at(self, pos):
+        x = pos.x() // self.tile_size
+        y = pos.y() // self.tile_size
+        if 0 <= x < self.x_size and 0 <= y < self.y_size:
+            return x + self.x_size * y
+        return None
+
+    def set_page(self, ids, tiles, model):
+        self.ids = ids
+        self.tiles = tiles
+        self.model = model
+        p = QPainter(self.buffer)
+        for i in range(len(self.ids)):
+            self.draw_tile(p, i)
+        p.end()
         self.update()
-    
-    def paintEvent(self, event):
-        p = QPainter(self)
-        p.setRenderHint(QPainter.Antialiasing)
-        
-        r = event.rect()
-        p.drawImage(r, self.image)
-        # p.drawPixmap(r, QPixmap(self.image))
-        color = self.get_color()
-        pen = QPen(color)
+
+    def draw_tile(self, p, i):
+        r = self.tile_rect(i)
+        p.setClipRect(r)
+        p.drawPixmap(r.topLeft(), self.tiles[i])
+        # labels are still loading while the first page is shown
+        label = 0 if self.model is None else self.model[self.ids[i]]
+        pen = QPen(get_color(label))
         pen.setWidth(4)
         p.setPen(pen)
         p.drawRect(r)
-        
-    def flag(self):
-        self.label = config['active_label']
-        logger.info(f"Event {self.id} is selected!")
-        self.update()
-        
-    def junk(self):
-        self.label = 0
-        logger.info(f"Event {self.id} is discarded!")
+
+    def tiles_in(self, rect):
+        "Return the tiles of the page overlapping `rect`."
+        x0 = max(rect.left() // self.tile_size, 0)
+        x1 = min(rect.right() // self.tile_size, self.x_size - 1)
+        y0 = max(rect.top() // self.tile_size, 0)
+        y1 = min(rect.bottom() // self.tile_size, self.y_size - 1)
+        return([x + self.x_size * y for y in range(y0, y1 + 1)
+                for x in range(x0, x1 + 1)
+                if x + self.x_size * y < len(self.ids)])
+
+    def refresh(self, i):
+        "Paint tile `i` into the buffer again and schedule its blit."
+        p = QPainter(self.buffer)
+        self.draw_tile(p, i)
+        p.end()
+        self.update(self.tile_rect(i))
+
+    def label_tiles(self, tiles, label):
+        """Set `label` on all `tiles` with one write and repaint them.
+
+        Returns the number of events whose label changed.
+        """
+        changed = self.model.set_many([self.ids[i] for i in tiles], label)
+        p = QPainter(self.buffer)
+        for i in tiles:
+            self.draw_tile(p, i)
+        p.end()
         self.update()
+        return(changed)
 
-    def get_color(self):
-        color = config['labels'][self.label]['color']
-        color_map = {
-            'black': Qt.black,
-            'red': Qt.red,
-            'yellow': Qt.yellow,
-            'green': Qt.green,
-            'blue': Qt.blue,
-            'magenta': Qt.magenta,
-            'cyan': Qt.cyan,
-            'orange': QColor(255, 165, 0),
-            'purple': QColor(128, 0, 128),
-            'brown': QColor(165, 42, 42),
-            'pink': QColor(255, 192, 203),
-            'gray': Qt.gray,
-            'olive': QColor(128, 128, 0),
-            'teal': QColor(0, 128, 128),
-            'lime': QColor(50, 205, 50)
-        }
-        
-        if color in color_map:
-            return color_map[color]
-        else:
-            quit("Invalid color selection!")
+    def paintEvent(self, event):
+        with metrics.span('paint'):
+            p = QPainter(self)
+            r = event.rect()
+            p.drawImage(r, self.buffer, r)
+
+    def flag(self, i):
+        self.model.set(self.ids[i], config['active_label'])
+        logger.info(f"Event {self.ids[i]} is selected!")
+        self.refresh(i)
+
+    def junk(self, i):
+        self.model.set(self.ids[i], 0)
+        logger.info(f"Event {self.ids[i]} is discarded!")
+        self.refresh(i)
+
+    def show_menu(self, i, pos):
+        "Actions on the event of tile `i`, opened by shift + right click."
+        menu = QMenu(self)
+        action = menu.addAction("find similar events")
+        action.setEnabled(self.can_find_similar(i))
+        if menu.exec_(pos) is action:
+            self.find_similar(self.ids[i])
+
+    def can_find_similar(self, i):
+        "Whether tile `i` shows an event, and not the padding of a page."
+        return(self.find_similar is not None and self.model is not None
+               and i < len(self.ids) and self.ids[i] < self.model.n_events)
+
+    def event(self, event):
+        "Show the data of the event under the cursor as a tooltip."
+        if event.type() == QEvent.ToolTip:
+            i = self.tile_at(event.pos())
+            text = None
+            if i is not None and i < len(self.ids) \
+                    and self.describe is not None:
+                text = self.describe(self.ids[i])
+            if text:
+                QToolTip.showText(event.globalPos(), text, self)
+            else:
+                QToolTip.hideText()
+                event.ignore()
+            return True
+        return super(TileCanvas, self).event(event)
+
+    def mousePressEvent(self, event):
+        self.origin = event.pos()
+
+    def mouseMoveEvent(self, event):
+        "Drag a rubber band over the tiles to label at once."
+        if self.origin is None:
+            return
+        if (event.pos() - self.origin).manhattanLength() \
+                >= QApplication.startDragDistance():
+            self.band.setGeometry(QRect(self.origin, event.pos()).normalized())
+            self.band.show()
 
     def mouseReleaseEvent(self, event):
-        if event.button() == Qt.RightButton:
-            self.junk()
+        if self.band.isVisible():
+            self.band.hide()
+            self.origin = None
+            if self.model is None:
+                return
+            label = 0 if event.button() == Qt.RightButton \
+                else config['active_label']
+            tiles = self.tiles_in(self.band.geometry())
+            changed = self.label_tiles(tiles, label)
+            logger.info(f"{changed} of {len(tiles)} dragged events set to "
+                        f"{config['labels'][label]['name']}!")
+            return
+        self.origin = None
+        i = self.tile_at(event.pos())
+        if i is None or i >= len(self.ids) or self.model is None:
+            return
+        if event.button() == Qt.RightButton \
+                and event.modifiers() & Qt.ShiftModifier:
+            self.show_menu(i, event.globalPos())
+        elif event.button() == Qt.RightButton:
+            self.junk(i)
         elif event.button() == Qt.LeftButton:
-            self.flag()
+            self.flag(i)
+
+
+class Loader(QThread):
+    """Opens a session of input files in a background thread.
+
+    The first page is converted and handed over before the data frames and
+    labels are read, so it is shown while the rest is still loading.
+    """
+
+    progress = pyqtSignal(int, str)
+    first_page = pyqtSignal(object, object)
+    loaded = pyqtSignal(dict)
+    failed = pyqtSignal(str)
+
+    def __init__(self, paths, transform, page_size, thumbnail_cache=None):
+        super(Loader, self).__init__()
+        self.paths = paths
+        self.transform = transform
+        self.page_size = page_size
+        self.thumbnail_cache = thumbnail_cache
+
+    def run(self):
+        store = None
+        try:
+            with metrics.span('load', files=len(self.paths)):
+                store = Session(
+                    self.paths, config['image_key'],
+                    page_size=self.page_size,
+                    max_open=config.get('max_open_files', 16))
+                self.loaded.emit(self.load(store))
+        except Exception as e:
+            if store is not None:
+                store.close()
+            self.failed.emit(f"{type(e)}: {e}")
+
+    def load(self, store):
+        self.progress.emit(0, "Reading the first page")
+        logger.info(f"Opened images with size : {store.shape}")
+        if any(channel.get('percentile') is not None
+               for channel in config['channels']):
+            self.transform.fit(store.read_page(1))
+        thumbnails = None
+        if self.thumbnail_cache is not None:
+            thumbnails = self.thumbnail_cache.session(
+                store, self.transform.settings)
+        page = convert_page(
+            EventOrder(store, self.page_size), 1, self.transform, thumbnails)
+        if page.raw is None \
+                and config.get('display_mode', 'rgb') not in ('rgb', 'gray'):
+            page.raw = store.read_page(1)
+        self.first_page.emit(store, page)
+
+        # data columns are only read when sorted, filtered or shown
+        self.progress.emit(10, "Reading data columns")
+        columns = ColumnStore(
+            self.paths, config['data_key'],
+            config.get('column_key', 'columns'), store.sizes)
+        logger.info(f"Found {len(columns)} data columns")
+        similar = SimilarIndex(
+            self.paths, config.get('embedding_key', 'embeddings'),
+            store.sizes)
+        if similar:
+            logger.info(f"Found embeddings in {similar.n_files} files")
+        duplicates = read_groups(
+            self.paths, config.get('duplicate_key', 'duplicates'),
+            store.sizes)
+        if duplicates is not None:
+            logger.info(f"Found {duplicates.n_groups} duplicate groups")
+
+        # Labels have their own dataset, seeded from older label columns
+        self.progress.emit(70, "Reading labels")
+        store.close()
+        label_stores = []
+        labels = []
+        for i, path in enumerate(self.paths):
+            label_store = LabelStore(
+                path, config.get('label_key', 'annotations'),
+                int(store.sizes[i]))
+            initial = columns.read('label', i) if 'label' in columns else None
+            labels.append(label_store.load(initial))
+            label_stores.append(label_store)
+        labels = np.concatenate(labels)
+
+        # Unsaved changes of a previous session are in the journals
+        self.progress.emit(90, "Replaying journals")
+        journal = SessionJournal(store)
+        replayed = journal.replay(labels)
+        if len(replayed):
+            logger.info(f"Replayed {len(replayed)} unsaved labels "
+                        f"from the journals")
+        model = LabelModel(labels, len(config['labels']), journal=journal)
+        model.dirty[replayed] = True
+        return(dict(store=store, columns=columns, label_stores=label_stores,
+                    journal=journal, model=model, thumbnails=thumbnails,
+                    similar=similar, duplicates=duplicates))
+
+
+class Ranker(QThread):
+    "Retrains an `ActiveLearner` and ranks its queue in the background."
+
+    ranked = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, learner, snapshot):
+        super(Ranker, self).__init__()
+        self.learner = learner
+        self.snapshot = snapshot
+
+    def run(self):
+        try:
+            with metrics.span('active_refresh',
+                              events=len(self.snapshot[0])):
+                self.ranked.emit(self.learner.update(*self.snapshot))
+        except Exception as e:
+            logger.exception("Active learning refresh failed")
+            self.failed.emit(f"{type(e)}: {e}")
 
 
 class MainWindow(QMainWindow):
     
-    def __init__(self, *args, **kwargs):
+    def __init__(self, paths=None, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
         #self.setStyleSheet("background-color: black;")
         self.current_page = 0
         self.n_pages = 0
         self.f_name = 'Empty'
-        self.open_settings()
+        self.store = None
+        self.pages = None
+        self.prefetcher = None
+        self.journal = None
+        self.model = None
+        self.similar = None
+        self.duplicates = None
+        # the order shown, before duplicates are collapsed
+        self.shown_order = None
+        # active learning: the learner, its running refresh and the queue
+        # waiting for the next page turn
+        self.learner = None
+        self.ranker = None
+        self.active = False
+        self.show_queue = False
+        self.next_queue = None
+        self.loader = None
+        self.load_started = None
+        self.pixmaps = PixmapCache(
+            config.get('pixmap_cache_mb', 256) * 1024 * 1024)
+        self.transform = DisplayTransform(config['channels'])
+        # converted images of earlier sessions, when a directory is set
+        self.thumbnail_cache = None
+        self.thumbnails = None
+        if config.get('thumbnail_cache_dir'):
+            self.thumbnail_cache = ThumbnailCache(
+                os.path.expanduser(config['thumbnail_cache_dir']),
+                config.get('thumbnail_cache_mb', 4096) * 1024 * 1024)
+        # thumbnails are opened once the display settings stop changing
+        self.thumbnail_timer = QTimer(self)
+        self.thumbnail_timer.setSingleShot(True)
+        self.thumbnail_timer.setInterval(1000)
+        self.thumbnail_timer.timeout.connect(self.open_thumbnails)
+        self.page_buffer = None
+        self.deploy_config()
 
         self.dialog = QFileDialog()
         self.dialog.setFileMode(QFileDialog.AnyFile)
@@ -327,7 +795,24 @@ class MainWindow(QMainWindow):
         self.savebutton.setIconSize(QSize(32, 32))
         self.savebutton.setIcon(QIcon("./icons/Save.png"))
         self.savebutton.pressed.connect(self.save_data)
+
+        self.displaybutton = QToolButton()
+        self.displaybutton.setText("Display")
+        self.displaybutton.setToolButtonStyle(Qt.ToolButtonTextUnderIcon)
+        self.displaybutton.setFixedSize(QSize(64, 64))
+        self.displaybutton.setIconSize(QSize(32, 32))
+        self.displaybutton.setIcon(QIcon("./icons/Brightness.png"))
+        self.displaybutton.pressed.connect(self.open_display)
+        self.display_window = None
         
+        self.exportbutton = QToolButton()
+        self.exportbutton.setText("Export")
+        self.exportbutton.setToolButtonStyle(Qt.ToolButtonTextUnderIcon)
+        self.exportbutton.setFixedSize(QSize(64, 64))
+        self.exportbutton.setIconSize(QSize(32, 32))
+        self.exportbutton.setIcon(QIcon("./icons/Export.png"))
+        self.exportbutton.pressed.connect(self.export_data)
+
         self.loadbutton = QToolButton()
         self.loadbutton.setText("Load")
         self.loadbutton.setToolButtonStyle(Qt.ToolButtonTextUnderIcon)
@@ -336,8 +821,9 @@ class MainWindow(QMainWindow):
         self.loadbutton.setFixedSize(QSize(64, 64))
         self.loadbutton.pressed.connect(self.load_data)
        
-        self.grid = QGridLayout()
-        self.grid.setSpacing(0)
+        self.canvas = TileCanvas()
+        self.canvas.describe = self.describe
+        self.canvas.find_similar = self.find_similar
         
         self.page_number = QLabel()
         self.page_number.setFixedSize(QSize(64, 64))
@@ -345,6 +831,9 @@ class MainWindow(QMainWindow):
         self.page_number.setText(f"{self.f_name}\n\n"
                                  f"{self.current_page} / {self.n_pages}")
         self.legend = Legend()
+        self.order_bar = OrderBar(self.apply_order)
+        self.order_bar.collapsebox.toggled.connect(self.collapse_duplicates)
+        self.bulk_bar = BulkBar(self.label_pages)
 
         key_box = QHBoxLayout()
         key_box.addWidget(self.legend)
@@ -354,64 +843,156 @@ class MainWindow(QMainWindow):
         key_box.addWidget(self.prevbutton)
         key_box.addWidget(self.page_number)
         key_box.addWidget(self.nextbutton)
+        key_box.addWidget(self.displaybutton)
         key_box.addWidget(self.savebutton)
+        key_box.addWidget(self.exportbutton)
         key_box.addWidget(self.loadbutton)
                
         main_box = QVBoxLayout()
-        main_box.addLayout(self.grid)
+        main_box.addWidget(self.canvas)
+        main_box.addWidget(self.order_bar)
+        main_box.addWidget(self.bulk_bar)
         main_box.addLayout(key_box)
 
         main_widget = QWidget()
         main_widget.setLayout(main_box)
         self.setCentralWidget(main_widget)
-        
-        self.load_data(init_map=True)
+
+        # Loading progress, shown while files are opened in the background
+        self.progress = QProgressBar()
+        self.progress.setMaximumWidth(256)
+        self.progress.setVisible(False)
+        self.statusBar().addPermanentWidget(self.progress)
+        self.busy_widgets = [
+            self.selectallbutton, self.selectnonebutton, self.prevbutton,
+            self.nextbutton, self.displaybutton, self.savebutton,
+            self.exportbutton, self.loadbutton, self.order_bar,
+            self.bulk_bar]
+
+        # Performance overlay, toggled with F12
+        if config.get('metrics_file'):
+            metrics.open(os.path.join(script_dir, config['metrics_file']))
+        self.overlay = QLabel(self.canvas)
+        self.overlay.setStyleSheet(
+            "QLabel{background: rgba(0, 0, 0, 180); color: white;"
+            " font-family: monospace; padding: 4px}")
+        self.overlay.setVisible(config.get('show_metrics', False))
+        self.overlay_timer = QTimer(self)
+        self.overlay_timer.timeout.connect(self.update_overlay)
+        self.overlay_timer.start(500)
+        QShortcut(QKeySequence('F12'), self, self.toggle_overlay)
+
+        # label changes logged before an idle period are synced to disk
+        self.journal_timer = QTimer(self)
+        self.journal_timer.timeout.connect(self.sync_journal)
+        self.journal_timer.start(1000)
+
+        # the window is shown at once, files are loaded in the background
+        self.canvas.resize_grid(self.x_size, self.y_size)
         self.show()
+        self.open_settings()
+        if paths:
+            self.load_data(paths=paths)
     
 
     def calc_index(self, x, y):
-        return((self.current_page - 1) * self.x_size * self.y_size \
+        pos = ((self.current_page - 1) * self.x_size * self.y_size
                + x + self.x_size * y)
-    
-    def get_image(self, id, mode):
-        global images
+        if self.pages.order is None:
+            return(pos)
+        if pos < self.pages.n_events:
+            return(int(self.pages.order[pos]))
+        # padding tiles get ids past the last event
+        return(self.n_events + pos)
+
+    def load_page(self):
+        "Fetch the converted images of the current page."
+        self.page_buffer = self.prefetcher.get(self.current_page)
+
+    def get_tile(self, i, id):
+        "Return the scaled pixmap of tile `i`, converting it on a miss."
+        mode = config.get('display_mode', 'rgb')
+        key = (id, config['tile_size'], self.transform.key, mode)
+        pixmap = self.pixmaps.get(key)
+        metrics.count('pixmap_cache_miss' if pixmap is None
+                      else 'pixmap_cache_hit')
+        if pixmap is None:
+            if self.page_buffer is None:
+                self.load_page()
+            pixmap = QPixmap.fromImage(self.get_image(i, mode).scaled(
+                config['tile_size'], config['tile_size']))
+            self.pixmaps.put(key, pixmap)
+        return pixmap
+
+    def get_image(self, i, mode):
+        """Return image `i` of the current page as a QImage without a copy.
+
+        `mode` is 'rgb', 'gray' or the name of a channel shown alone. The
+        QImage keeps the page buffer alive, so its memory is not recycled
+        while the view exists.
+        """
+        page = self.page_buffer
         if mode == 'rgb':
-            return(
-                QImage(
-                    images[id].data, self.im_w, self.im_h,
-                    self.im_w * 3, QImage.Format_RGB888)
-            )
-
-    def get_label(self, id):
-        global df
-        if id >= self.n_events:
-            return 0
+            data, image_format = page.rgb[i], QImage.Format_RGB888
+        elif mode == 'gray':
+            data, image_format = page.gray()[i], QImage.Format_Grayscale8
         else:
-            return df.label.iat[id]
-
-    def init_map(self):
-        for x in range(0, self.x_size):
-            for y in range(0, self.y_size):
-                id = self.calc_index(x, y)
-                qImage = self.get_image(id, mode='rgb')
-                label = self.get_label(id)
-                w = Pos(id, qImage, label)
-                self.grid.addWidget(w, y, x)
+            names = [channel['name'] for channel in config['channels']]
+            if page.raw is None:
+                # pages from the thumbnail cache are read on demand
+                page.raw = self.prefetcher.get_raw(self.current_page)
+            data = page.channel(names.index(mode), self.transform)[i]
+            image_format = QImage.Format_Grayscale8
+        image = QImage(data.data, self.im_w, self.im_h, data.strides[0],
+                       image_format)
+        image.page = page
+        return(image)
 
     def reset_map(self):
-        for x in range(0, self.x_size):
-            for y in range(0, self.y_size):
-                id = self.calc_index(x, y)
-                qImage = self.get_image(id, mode='rgb')
-                label = self.get_label(id)
-                w = self.grid.itemAtPosition(y, x).widget()
-                w.reset(id, qImage, label)
+        # the page is only fetched when one of its tiles is not cached
+        self.page_buffer = None
+        with metrics.span('page_build', page=self.current_page):
+            ids = [self.calc_index(x, y) for y in range(0, self.y_size)
+                   for x in range(0, self.x_size)]
+            tiles = [self.get_tile(i, id) for i, id in enumerate(ids)]
+            self.canvas.set_page(ids, tiles, self.model)
     
+    def describe(self, id):
+        "Tooltip text of an event, its label and data columns."
+        if self.model is None or id >= self.n_events:
+            return(None)
+        lines = [f"event {id}: "
+                 f"{config['labels'][self.model[id]]['name']}"]
+        for name, value in self.columns.row(id).items():
+            if isinstance(value, float):
+                value = f"{value:.6g}"
+            lines.append(f"{name}: {value}")
+        return("\n".join(lines))
+
+    def toggle_overlay(self):
+        self.overlay.setVisible(not self.overlay.isVisible())
+        self.update_overlay()
+
+    def update_overlay(self):
+        if self.overlay.isVisible():
+            self.overlay.setText("\n".join(metrics.summary()))
+            self.overlay.adjustSize()
+
+    def sync_journal(self):
+        if self.journal is not None:
+            self.journal.sync_due()
+
     def update_page_number(self):
         self.page_number.setText(f"{self.f_name}\n\n"
                                  f"{self.current_page} / {self.n_pages}")
 
     def nextPage(self):
+        if self.active and self.next_queue is not None:
+            # a refreshed queue replaces the pages left of the old one
+            queue, self.next_queue = self.next_queue, None
+            self.show_order(queue)
+            logger.info(f"Showing {len(queue)} uncertain events")
+            return
         if self.current_page < self.n_pages:
             self.current_page += 1
             self.update_page_number()
@@ -432,127 +1013,409 @@ class MainWindow(QMainWindow):
         self.reset_map()
         
     def selectAll(self):
-        for x in range(0, self.x_size):
-            for y in range(0, self.y_size):
-                w = self.grid.itemAtPosition(y, x).widget()
-                w.flag()
-                w.update()
-                
+        label = config['active_label']
+        changed = self.canvas.label_tiles(range(len(self.canvas.ids)), label)
+        logger.info(f"{changed} events of page {self.current_page} set to "
+                    f"{config['labels'][label]['name']}!")
+
     def selectNone(self):
-        for x in range(0, self.x_size):
-            for y in range(0, self.y_size):
-                w = self.grid.itemAtPosition(y, x).widget()
-                w.junk()
-                w.update()
+        changed = self.canvas.label_tiles(range(len(self.canvas.ids)), 0)
+        logger.info(f"{changed} events of page {self.current_page} "
+                    f"discarded!")
+
+    def label_pages(self, label, first=None, last=None):
+        """Label all events of pages `first` to `last` of the current order
+        and filter, of all its pages when None."""
+        if self.model is None:
+            return
+        first = max(first or 1, 1)
+        last = min(last or self.n_pages, self.n_pages)
+        ids = self.pages.ids(first, last)
+        name = config['labels'][label]['name']
+        if len(ids) > len(self.canvas.ids):
+            result = QMessageBox.question(
+                self, "Confirm bulk labelling...",
+                f"Set {len(ids)} events of pages {first}-{last} to {name}?",
+                QMessageBox.Yes | QMessageBox.No)
+            if result != QMessageBox.Yes:
+                return
+        with metrics.span('bulk_label', events=len(ids)):
+            changed = self.model.set_many(ids, label)
+        logger.info(f"{changed} of {len(ids)} events of pages {first}-{last}"
+                    f" set to {name}!")
+        self.canvas.set_page(self.canvas.ids, self.canvas.tiles, self.model)
                 
     def save_labels(self):
-        global df
-        for x in range(0, self.x_size):
-            for y in range(0, self.y_size):
-                w = self.grid.itemAtPosition(y, x).widget()
-                if w.id < self.n_events:
-                    df.label.iat[w.id] = w.label # w.get_label()
-                
-        logger.info(f"Selection: {sum(df.label)}")
+        # tiles write straight into the label model
+        logger.info(f"Selection: {self.model.n_selected}")
+        # the saved page was reviewed, its labels train the active learner
+        if self.learner is None:
+            return
+        ids = self.canvas.ids
+        if self.model.groups is not None:
+            ids = self.model.groups(ids)
+        if self.learner.review(ids) and self.active:
+            self.refresh_queue()
 
     def open_settings(self):
-        main_dialog = QDialog()
+        "Show the settings next to the window, they apply when closed."
+        self.settings_dialog = QDialog(self)
         layout = QVBoxLayout()
         setting_window = SettingWindow()
         layout.addWidget(setting_window)
-        main_dialog.setLayout(layout)
-        main_dialog.setWindowTitle('Settings')
-        main_dialog.setWindowModality(Qt.ApplicationModal)
-        main_dialog.exec_()
+        self.settings_dialog.setLayout(layout)
+        self.settings_dialog.setWindowTitle('Settings')
+        self.settings_dialog.finished.connect(self.apply_settings)
+        self.settings_dialog.show()
+
+    def apply_settings(self):
+        keys = (config['image_key'], config['data_key'])
+        grid = (config['x_size'], config['y_size'], config['tile_size'])
+        loaded_keys = getattr(self, 'keys', keys)
+        loaded_grid = (self.x_size, self.y_size, self.canvas.tile_size)
         save_config()
         self.deploy_config()
+        if self.loader is None and self.store is None:
+            # nothing given on the command line
+            self.canvas.resize_grid(self.x_size, self.y_size)
+            self.load_data()
+        elif keys != loaded_keys:
+            self.load_data(paths=self.paths)
+        elif grid != loaded_grid:
+            if self.loader is not None:
+                self.loader.wait()
+                QApplication.processEvents()
+            self.canvas.resize_grid(self.x_size, self.y_size)
+            if self.prefetcher is not None:
+                self.set_order(self.pages.order)
+                self.current_page = 1
+                self.update_page_number()
+                self.reset_map()
+
+    def open_display(self):
+        if self.display_window is None:
+            self.display_window = DisplayWindow(self.update_display)
+        self.display_window.show()
+        self.display_window.raise_()
+
+    def update_display(self):
+        """Recompile the display tables and redraw the current page.
+
+        Pages are converted without thumbnails until the settings rest, so
+        stepping through values does not leave a thumbnail file per step.
+        """
+        self.transform.update(config['channels'])
+        if self.prefetcher is not None:
+            self.release_thumbnails()
+            self.prefetcher.set_convert(self.transform, None)
+            self.reset_map()
+            if self.thumbnail_cache is not None:
+                self.thumbnail_timer.start()
+
+    def open_thumbnails(self):
+        "Open the thumbnails of the current display settings."
+        if self.prefetcher is None or self.thumbnail_cache is None:
+            return
+        self.release_thumbnails()
+        self.thumbnails = self.thumbnail_cache.session(
+            self.store, self.transform.settings)
+        self.prefetcher.set_convert(self.transform, self.thumbnails)
+
+    def release_thumbnails(self):
+        if self.thumbnails is not None:
+            self.thumbnail_cache.release(self.thumbnails)
+        self.thumbnails = None
 
     def deploy_config(self):
         self.x_size = config['x_size']
         self.y_size = config['y_size']
 
-    def load_data(self, init_map=False):
-        global images
-        global df
+    def load_data(self, paths=None, block=False):
+        """Open input files in a background thread.
 
-        self.f_path, _ = self.dialog.getOpenFileName(
-            self.loadbutton, "Open File", '', "HDF files (*.hdf5)")
+        The first page is shown as soon as it is decoded and the window
+        stays responsive while the rest loads. `block` loads in the calling
+        thread instead, e.g. in scripts and benchmarks.
+        """
+        if paths is None:
+            paths, _ = self.dialog.getOpenFileNames(
+                self.loadbutton, "Open Files", '', "HDF files (*.hdf5)")
 
-        if not self.f_path:
+        if not paths:
             return
-        try:
-            self.f_name = os.path.basename(self.f_path).replace('.hdf5', '')
-            logger.info(f"loading input data from: {self.f_path}")
-
-            # Load images
-            with h5py.File(self.f_path, 'r') as file:
-                self.input_keys = list(file.keys())
-                logger.debug(f"Input file keys: {self.input_keys}")
-                if config['image_key'] in self.input_keys:
-                    images = file.get(config['image_key'])[:]
-                    logger.info(f"Loaded images with size : {images.shape}")
-                else:
-                    logger.error("Images not found in input file!")
-                    sys.exit(-1)
-
-            if config['data_key'] in self.input_keys:
-                df = pd.read_hdf(self.f_path, config['data_key'])
-                logger.info(f"Loaded data with size: {df.shape}")
-                logger.debug(f"Types of data columns:\n{df.dtypes}")
-            else:
-                logger.info(f"Data not found in input file!")
-                sys.exit(-1)
-
-        except Exception as e:
-            QMessageBox.warning(
-                self, 'Error', f"The following error occured:\n{type(e)}: {e}")
-
-        self.im_shape   = images.shape
-        self.n_events   = self.im_shape[0]
-        self.im_h       = self.im_shape[1]
-        self.im_w       = self.im_shape[2]
-        self.n_channels = self.im_shape[3]
-        self.n_pages    = 1 + self.n_events // (self.x_size * self.y_size)
-        self.n_tiles    = self.n_pages * (self.x_size * self.y_size)
-
-        if self.n_tiles > self.n_events:
-            images = np.concatenate((images,
-                np.zeros(
-                    (self.n_tiles - self.n_events, self.im_h, self.im_w,
-                    self.n_channels),
-                    dtype=images.dtype)),
-                axis=0
-            )
-
-        images = channels2rgb8bit(images)
-
-        if 'label' not in df.columns:
-            df['label'] = np.zeros(self.n_events, dtype='uint8')
+        if self.loader is not None and self.loader.isRunning():
+            self.loader.wait()
+            QApplication.processEvents()
+        if self.ranker is not None:
+            self.ranker.wait()
+        self.paths = list(paths)
+        self.f_path = self.paths[0]
+        self.f_name = os.path.basename(self.f_path).replace('.hdf5', '')
+        if len(self.paths) > 1:
+            self.f_name = (
+                f"{os.path.basename(os.path.dirname(self.f_path))}"
+                f" ({len(self.paths)} files)")
+        logger.info(f"loading input data from: {self.paths}")
+
+        # Close the previous session, pages are read on demand
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+            self.store.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.thumbnail_timer.stop()
+        self.release_thumbnails()
+        self.prefetcher = None
+        self.journal = None
+        self.model = None
+        self.learner = None
+        self.active = False
+        self.next_queue = None
+        self.thumbnails = None
+        self.pixmaps.clear()
+        self.keys = (config['image_key'], config['data_key'])
+
+        self.set_busy(True)
+        self.load_started = time.perf_counter()
+        self.loader = Loader(
+            self.paths, self.transform, self.x_size * self.y_size,
+            self.thumbnail_cache)
+        self.loader.progress.connect(self.show_progress)
+        self.loader.first_page.connect(self.show_first_page)
+        self.loader.loaded.connect(self.finish_load)
+        self.loader.failed.connect(self.load_failed)
+        if block:
+            self.loader.run()
+        else:
+            self.loader.start()
+
+    def set_busy(self, busy):
+        "Show the progress bar and lock the controls while loading."
+        self.progress.setValue(0)
+        self.progress.setVisible(busy)
+        for widget in self.busy_widgets:
+            widget.setEnabled(not busy)
+        if not busy:
+            self.statusBar().clearMessage()
+
+    def show_progress(self, value, text):
+        self.progress.setValue(value)
+        self.statusBar().showMessage(text)
+
+    def set_shape(self, store):
+        self.store      = store
+        self.im_shape   = store.shape
+        self.n_events   = store.n_events
+        self.im_h       = store.im_h
+        self.im_w       = store.im_w
+        self.n_channels = store.n_channels
+
+    def show_first_page(self, store, page_buffer):
+        "Draw the first page while labels are still loading."
+        self.set_shape(store)
+        self.current_page = 1
+        self.n_pages = store.n_pages
+        self.update_page_number()
+        self.canvas.resize_grid(self.x_size, self.y_size)
+        # its tiles are cached, so the full page build reuses them
+        self.page_buffer = page_buffer
+        ids = list(range(self.x_size * self.y_size))
+        tiles = [self.get_tile(i, id) for i, id in enumerate(ids)]
+        self.canvas.set_page(ids, tiles, None)
+        metrics.record('first_page', time.perf_counter() - self.load_started)
+
+    def finish_load(self, result):
+        self.columns = result['columns']
+        self.label_stores = result['label_stores']
+        self.journal = result['journal']
+        self.model = result['model']
+        self.thumbnails = result['thumbnails']
+        self.similar = result['similar']
+        self.duplicates = result['duplicates']
+        self.shown_order = None
+        self.set_shape(result['store'])
+        self.set_order(None)
+        self.n_tiles = self.n_pages * (self.x_size * self.y_size)
+
+        self.index = EventIndex(self.columns.get, self.columns.where)
+        self.learner = self.make_learner()
+        self.order_bar.set_columns(
+            self.columns.numeric, active=self.learner is not None,
+            duplicates=self.duplicates is not None)
 
         self.current_page = 1
         self.update_page_number()
-        if init_map:
-            self.init_map()
+        self.reset_map()
+        self.set_busy(False)
+        logger.info(f"Loaded {self.n_events} events in "
+                    f"{time.perf_counter() - self.load_started:.2f} s")
+
+    def make_learner(self):
+        """An active learner on the embeddings of all files, or else on the
+        numeric data columns, None without either."""
+        if self.similar and self.similar.n_files == len(self.paths):
+            features = EmbeddingFeatures(self.similar)
         else:
-            self.reset_map()
+            names = self.columns.numeric
+            if not names:
+                return(None)
+            features = ColumnFeatures(
+                self.columns.get, names, self.n_events)
+        return(ActiveLearner(
+            features, len(config['labels']), self.model.labels,
+            refresh=config.get('active_refresh', 500),
+            queue_size=config.get('active_queue', 2000)))
+
+    def refresh_queue(self):
+        "Retrain the active learner in the background, unless it runs."
+        if self.ranker is not None and self.ranker.isRunning():
+            return
+        self.ranker = Ranker(
+            self.learner, self.learner.snapshot(self.model.labels))
+        self.ranker.ranked.connect(self.queue_ranked)
+        self.ranker.failed.connect(
+            lambda message: logger.error(f"Ranking failed: {message}"))
+        self.ranker.start()
+
+    def queue_ranked(self, queue):
+        if not self.active:
+            return
+        logger.info(f"Ranked {len(queue)} uncertain events")
+        if self.show_queue:
+            self.show_queue = False
+            self.show_order(queue)
+        else:
+            self.next_queue = queue
+
+    def load_failed(self, message):
+        self.set_busy(False)
+        # without a session only another file can be loaded
+        for widget in self.busy_widgets:
+            widget.setEnabled(widget is self.loadbutton)
+        self.store = None
+        self.canvas.resize_grid(self.x_size, self.y_size)
+        self.canvas.set_page([], [], None)
+        QMessageBox.warning(
+            self, 'Error', f"The following error occured:\n{message}")
+
+    def set_order(self, order):
+        "Page through the event ids `order`, or all events when None."
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+        self.pages = EventOrder(
+            self.store, self.x_size * self.y_size, order)
+        self.prefetcher = Prefetcher(
+            self.pages, self.transform,
+            ahead=config.get('prefetch_pages', 2),
+            cache_pages=config.get('cache_pages', 8),
+            thumbnails=self.thumbnails)
+        self.n_pages = self.pages.n_pages
+
+    def apply_order(self, column, descending, low, high):
+        if self.prefetcher is None:
+            return
+        self.active = column == OrderBar.UNCERTAIN
+        self.next_queue = None
+        if self.active:
+            # the first queue is shown as soon as it is ranked
+            self.show_queue = True
+            self.refresh_queue()
+            logger.info("Active learning, ranking uncertain events")
+            return
+        if column is None:
+            self.show_order(None)
+        else:
+            self.show_order(self.index.order(column, descending, low, high))
+        logger.info(f"Showing {self.pages.n_events} events ordered by "
+                    f"{column or 'file order'}")
+
+    def show_order(self, order):
+        "Show the first page of the event ids `order`."
+        self.shown_order = order
+        if self.model.groups is not None:
+            order = self.duplicates.collapse(order)
+        self.set_order(order)
+        self.save_labels()
+        self.current_page = 1
+        self.update_page_number()
+        self.reset_map()
 
-    def save_data(self, export_txt=True):
-        global df
+    def collapse_duplicates(self, collapse):
+        """Show one event per duplicate group, labels set on it are set on
+        the whole group."""
+        if self.model is None or self.duplicates is None:
+            return
+        self.model.groups = self.duplicates.members if collapse else None
+        self.show_order(self.shown_order)
+        logger.info(f"Showing {self.pages.n_events} events"
+                    f"{', one per duplicate group' if collapse else ''}")
+
+    def find_similar(self, id):
+        "Show the events most similar to event `id` by their embeddings."
+        if not self.similar:
+            QMessageBox.warning(
+                self, 'Error', "No embeddings found, run eval.py with "
+                "--embed to compute them!")
+            return
+        with metrics.span('similar_search'):
+            order = self.similar.search(
+                id, k=config.get('similar_events', 1000),
+                probes=config.get('similar_probes', 16))
+        if order is None:
+            QMessageBox.warning(
+                self, 'Error', f"Event {id} has no embedding!")
+            return
+        self.show_order(order)
+        logger.info(f"Showing {len(order)} events similar to event {id}")
+
+    def save_data(self):
         self.save_labels()
-        # saving annotations to hdf5 file
-        df.to_hdf(self.f_path, key=config['data_key'], mode='r+')
-        # saving label keymap
-        with h5py.File(self.f_path, 'r+') as file:
-            if 'labels' in file.keys():
-                del file['labels']
-            file.create_dataset(
-                'labels', data=[item['name'] for item in config['labels']])
-        logger.info("Stored data in HDF file!")
-        # exporting data to a txt file if requested
-        if export_txt:
-            export_path = f"{config['output_dir']}/{self.f_name}.txt"
-            df.to_csv(export_path, index=False, sep='\t')
+        # input files are held open for reading between saves
+        self.prefetcher.wait()
+        self.store.close()
+        # saving changed annotations and the label keymap of each file
+        dirty = self.model.take_dirty()
+        names = [item['name'] for item in config['labels']]
+        offsets = self.store.offsets
+        n_chunks = 0
+        try:
+            with metrics.span('save', events=len(dirty)):
+                for i, local in self.store.split(dirty):
+                    n_chunks += self.label_stores[i].save(
+                        self.model.labels[offsets[i]:offsets[i + 1]],
+                        local, names=names)
+        except Exception:
+            self.model.dirty[dirty] = True
+            raise
+        finally:
+            self.store.open()
+        self.journal.truncate()
+        metrics.write_counters()
+        logger.info(f"Stored {n_chunks} changed label chunks in HDF file!")
+
+    def export_data(self):
+        "Write the labels into the data frames and export them to txt files."
+        self.save_data()
+        self.prefetcher.wait()
+        self.store.close()
+        offsets = self.store.offsets
+        for i, path in enumerate(self.paths):
+            # the only place the full frames are read
+            frame = self.columns.frame(config['data_key'], i)
+            frame['label'] = self.model.labels[offsets[i]:offsets[i + 1]]
+            with metrics.span('export', events=len(frame)):
+                frame.to_hdf(path, key=config['data_key'], mode='r+')
+            name = os.path.basename(path).replace('.hdf5', '')
+            export_path = f"{config['output_dir']}/{name}.txt"
+            frame.to_csv(export_path, index=False, sep='\t')
             logger.info(f"Exported data to {export_path}")
+        self.store.open()
+        # the frames were rewritten, so columns are located again
+        self.columns = ColumnStore(
+            self.paths, config['data_key'],
+            config.get('column_key', 'columns'), self.store.sizes)
+        self.index = EventIndex(self.columns.get, self.columns.where)
+        logger.info("Stored data frames in HDF files!")
 
     def closeEvent(self,event):
         result = QMessageBox.question(self,
@@ -562,11 +1425,64 @@ class MainWindow(QMainWindow):
         event.ignore()
 
         if result == QMessageBox.Yes:
+            if self.loader is not None:
+                self.loader.wait()
+            if self.ranker is not None:
+                self.ranker.wait()
+            if self.prefetcher is not None:
+                self.prefetcher.shutdown()
+            self.thumbnail_timer.stop()
+            self.journal_timer.stop()
+            self.release_thumbnails()
+            if self.journal is not None:
+                self.journal.close()
+            metrics.write_counters()
+            metrics.close()
             event.accept()
 
 # Functions
+def get_color(label):
+    color = config['labels'][label]['color']
+    color_map = {
+        'black': Qt.black,
+        'red': Qt.red,
+        'yellow': Qt.yellow,
+        'green': Qt.green,
+        'blue': Qt.blue,
+        'magenta': Qt.magenta,
+        'cyan': Qt.cyan,
+        'orange': QColor(255, 165, 0),
+        'purple': QColor(128, 0, 128),
+        'brown': QColor(165, 42, 42),
+        'pink': QColor(255, 192, 203),
+        'gray': Qt.gray,
+        'olive': QColor(128, 128, 0),
+        'teal': QColor(0, 128, 128),
+        'lime': QColor(50, 205, 50)
+    }
+
+    if color in color_map:
+        return color_map[color]
+    else:
+        quit("Invalid color selection!")
+
+def setup_logging():
+    c_handler = logging.StreamHandler()
+    console_format = logging.Formatter("[%(levelname)s] %(message)s")
+    c_handler.setFormatter(console_format)
+    c_handler.setLevel(logging.INFO)
+    logging.getLogger().addHandler(c_handler)
+    f_handler = logging.FileHandler(filename=log_path, mode='a')
+    f_format = logging.Formatter("%(asctime)s: [%(levelname)s] %(message)s")
+    f_handler.setFormatter(f_format)
+    f_handler.setLevel(logging.DEBUG)
+    logging.getLogger().addHandler(f_handler)
+    logging.getLogger().setLevel(logging.DEBUG)
+
 def load_config():
     global config
+    import yaml
+
     if not os.path.exists(config_path):
         sys.exit("config file does not exist! at: " + config_path)
     else:
@@ -576,15 +1492,20 @@ def load_config():
 
 def save_config():
     global config
+    import yaml
+
     with open(config_path, 'w') as file:
         yaml.dump(config, file, default_flow_style=False)
     
 
 
 def main():
+    setup_logging()
     load_config()
     app = QApplication([])
-    window = MainWindow()
+    # an input file, a directory or a glob pattern may be given
+    paths = session_paths(sys.argv[1]) if len(sys.argv) > 1 else None
+    window = MainWindow(paths=paths)
     ret = app.exec_()
     sys.exit(ret)
 
@@ -599,10 +1520,6 @@ if __name__ == '__main__':
 # Change it to dark theme
 # Scale images
 # Improve images
-# Add option 3-color or gray-scale
-# Add multiple selection by dragging mouse click
-# Filter using size
-# Show event data while hovering cursor over the item and waiting
 
 
 ##### To be used later
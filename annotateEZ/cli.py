@@ -0,0 +1,540 @@
+"""Headless batch tools for annotateEZ files.
+
+Runs without Qt, e.g. `python -m annotateEZ stats run/*.hdf5`. Every
+command streams the files in chunks of events, so memory stays bounded by
+the chunk size and not by the number of events.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+import yaml
+
+from annotateEZ.convert import (
+    DisplayTransform, channels2rgb8bit, convert_parallel)
+from annotateEZ.data import Session, load_filters, session_paths
+from annotateEZ.duplicates import find_groups, tile_hash
+from annotateEZ.journal import Journal
+from annotateEZ.metadata import frame_labels
+
+logger = logging.getLogger(__name__)
+
+config_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'config.yml')
+
+
+def load_keys():
+    "Dataset keys and label names from config.yml, with defaults."
+    config = {}
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as stream:
+            config = yaml.safe_load(stream)
+    return {
+        'image_key': config.get('image_key', 'images'),
+        'data_key': config.get('data_key', 'features'),
+        'label_key': config.get('label_key', 'annotations'),
+        'column_key': config.get('column_key', 'columns'),
+        'duplicate_key': config.get('duplicate_key', 'duplicates'),
+        'names': [label['name'] for label in config.get('labels', [])],
+        'channels': config.get('channels', []),
+        'page_size': config.get('x_size', 15) * config.get('y_size', 15),
+    }
+
+
+def expand(inputs):
+    paths = [path for spec in inputs for path in session_paths(spec)]
+    if not paths:
+        sys.exit(f"No input files found at: {' '.join(inputs)}")
+    return paths
+
+
+def n_events(file, keys):
+    return file[keys['image_key']].shape[0]
+
+
+def read_labels(file, keys, start, stop, journal=None):
+    """Labels of events [start, stop), with unsaved journal records applied.
+
+    Files without a label dataset have the labels of the data frame's
+    `label` column, like `LabelStore.load` seeds them, or all labels 0.
+    """
+    labels = None
+    if keys['label_key'] in file:
+        labels = file[keys['label_key']][start:stop]
+    else:
+        labels = frame_labels(file, keys['data_key'], slice(start, stop))
+    if labels is None:
+        labels = np.zeros(stop - start, dtype='uint8')
+    if journal is not None:
+        apply_journal(labels, journal, start)
+    return labels
+
+
+def apply_journal(labels, journal, start):
+    """Apply the journal records of events [start, start + len(labels)) in
+    place, return how many there were."""
+    records = journal[(journal['id'] >= start)
+                      & (journal['id'] < start + len(labels))]
+    labels[records['id'].astype('int64') - start] = records['label']
+    return len(records)
+
+
+def label_names(file, keys):
+    if 'labels' in file:
+        return list(file['labels'].asstr()[:])
+    return keys['names']
+
+
+def chunks(n, chunk):
+    for start in range(0, n, chunk):
+        yield start, min(start + chunk, n)
+
+
+def export(args, keys):
+    import pandas as pd
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for path in expand(args.input):
+        name = os.path.basename(path).replace('.hdf5', '')
+        journal = Journal(f"{path}.journal").read()
+        out_path = os.path.join(
+            args.output_dir,
+            f"{name}.{'txt' if args.format == 'tsv' else 'parquet'}")
+        writer = None
+        with h5py.File(path, 'r') as file:
+            n = n_events(file, keys)
+            for start, stop in chunks(n, args.chunk):
+                frame = pd.read_hdf(
+                    path, keys['data_key'], start=start, stop=stop)
+                frame.index = np.arange(start, stop)
+                if keys['column_key'] in file:
+                    for column, dataset in file[keys['column_key']].items():
+                        frame[column] = dataset[start:stop]
+                frame['label'] = read_labels(file, keys, start, stop, journal)
+                if args.format == 'tsv':
+                    frame.to_csv(out_path, index=False, sep='\t',
+                                 mode='w' if start == 0 else 'a',
+                                 header=start == 0)
+                else:
+                    writer = write_parquet(writer, out_path, frame)
+        if writer is not None:
+            writer.close()
+        logger.info(f"Exported {n} events to {out_path}")
+
+
+def write_parquet(writer, path, frame):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        sys.exit("Parquet export needs pyarrow to be installed!")
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    if writer is None:
+        writer = pq.ParquetWriter(path, table.schema)
+    writer.write_table(table)
+    return writer
+
+
+def convert(args, keys):
+    """Convert all images to 8-bit RGB .npy files, in parallel over events.
+
+    The output is memory mapped, so files larger than memory are fine.
+    """
+    os.makedirs(args.output_dir, exist_ok=True)
+    transform = channels2rgb8bit
+    if args.display:
+        transform = DisplayTransform(keys['channels'])
+    for path in expand(args.input):
+        name = os.path.basename(path).replace('.hdf5', '')
+        out_path = os.path.join(args.output_dir, f"{name}.rgb.npy")
+        with h5py.File(path, 'r') as file:
+            images = file[keys['image_key']]
+            if args.display and any(
+                    channel.get('percentile') is not None
+                    for channel in keys['channels']):
+                transform.fit(images[:args.chunk])
+            out = np.lib.format.open_memmap(
+                out_path, mode='w+', dtype='uint8',
+                shape=images.shape[:3] + (3,))
+            started = time.perf_counter()
+            convert_parallel(images, out, convert=transform,
+                             chunk=args.chunk, workers=args.workers)
+            out.flush()
+            del out
+        seconds = time.perf_counter() - started
+        logger.info(f"Converted {len(images)} events to {out_path} in "
+                    f"{seconds:.1f} s "
+                    f"({len(images) / max(seconds, 1e-9):.0f} events/s)")
+
+
+def dedup(args, keys):
+    """Find near-duplicate events by perceptual hashes of their images.
+
+    The raw images are hashed, so dim events keep their detail, and the
+    events of all input files are grouped together. Each file stores its
+    hashes and, for each event, the file name and id of its group's
+    representative in the `duplicate_key` group, where the viewer finds
+    them to show one event per group.
+    """
+    paths = expand(args.input)
+    started = time.perf_counter()
+    hashes = []
+    for path in paths:
+        with h5py.File(path, 'r') as file:
+            images = file[keys['image_key']]
+            part = np.empty(images.shape[0], dtype='uint64')
+            for start, stop in chunks(len(part), args.chunk):
+                part[start:stop] = tile_hash(images[start:stop])
+        hashes.append(part)
+    sizes = [len(part) for part in hashes]
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    representative = find_groups(np.concatenate(hashes), args.distance)
+    files = np.searchsorted(offsets, representative, side='right') - 1
+    names = [os.path.basename(path) for path in paths]
+    for i, path in enumerate(paths):
+        part = slice(offsets[i], offsets[i + 1])
+        with h5py.File(path, 'r+') as file:
+            if keys['duplicate_key'] in file:
+                del file[keys['duplicate_key']]
+            group = file.create_group(keys['duplicate_key'])
+            group.create_dataset('hashes', data=hashes[i])
+            group.create_dataset(
+                'representative',
+                data=representative[part] - offsets[files[part]])
+            group.create_dataset(
+                'representative_file', data=files[part].astype('uint32'))
+            group.attrs['files'] = names
+            group.attrs['distance'] = args.distance
+    n = int(offsets[-1])
+    n_groups = int(np.count_nonzero(representative == np.arange(n)))
+    seconds = time.perf_counter() - started
+    logger.info(f"{n - n_groups} of {n} events in {len(paths)} files are "
+                f"near duplicates in {n_groups} groups, found in "
+                f"{seconds:.1f} s ({n / max(seconds, 1e-9):.0f} events/s)")
+
+
+def rechunk(args, keys):
+    """Rewrite the images with one chunk per page of the viewer.
+
+    Pages read by the viewer then decompress exactly one chunk. All other
+    datasets and groups are copied unchanged. The images are copied in
+    blocks of whole pages, so memory stays bounded by the chunk size, and
+    the result replaces the input file only once it is complete.
+    """
+    page_size = args.page_size or keys['page_size']
+    options = filter_options(args.compression)
+    block = max(page_size, args.chunk // page_size * page_size)
+    for path in expand(args.input):
+        out_path = path
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            out_path = os.path.join(args.output_dir, os.path.basename(path))
+        tmp_path = f"{out_path}.rechunk"
+        size = os.path.getsize(path)
+        before = page_latency(path, keys['image_key'], page_size)
+        started = time.perf_counter()
+        with h5py.File(path, 'r') as source, \
+                h5py.File(tmp_path, 'w') as target:
+            target.attrs.update(source.attrs)
+            for name in source:
+                if name != keys['image_key']:
+                    source.copy(source[name], target, name=name)
+            images = source[keys['image_key']]
+            n = images.shape[0]
+            out = target.create_dataset(
+                keys['image_key'], shape=images.shape, dtype=images.dtype,
+                maxshape=images.maxshape,
+                chunks=(min(page_size, max(n, 1)),) + images.shape[1:],
+                **options)
+            out.attrs.update(images.attrs)
+            for start, stop in chunks(n, block):
+                out[start:stop] = images[start:stop]
+        os.replace(tmp_path, out_path)
+        seconds = time.perf_counter() - started
+        after = page_latency(out_path, keys['image_key'], page_size)
+        logger.info(f"Rechunked {n} events to {out_path} in {seconds:.1f} s, "
+                    f"{size / 2**20:.1f} MB -> "
+                    f"{os.path.getsize(out_path) / 2**20:.1f} MB, "
+                    f"page read {before[0] * 1e3:.2f} ms -> "
+                    f"{after[0] * 1e3:.2f} ms, random ids "
+                    f"{before[1] * 1e3:.2f} ms -> {after[1] * 1e3:.2f} ms")
+
+
+def filter_options(name):
+    "h5py dataset options of a compression filter."
+    if name == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    if name == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 1,
+                'shuffle': True}
+    if name == 'blosc':
+        try:
+            import hdf5plugin
+        except ImportError:
+            sys.exit("Blosc compression needs hdf5plugin to be installed!")
+        return dict(hdf5plugin.Blosc(
+            cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    return {}
+
+
+def page_latency(path, key, page_size, pages=32, id_pages=8):
+    """Median seconds to read one of `pages` random pages of images, and
+    to read one of `id_pages` pages of random event ids, as sorted or
+    filtered views do."""
+    session = Session([path], key, page_size)
+    rng = np.random.default_rng(0)
+    n = session.n_events
+    page_times, id_times = [], []
+    try:
+        for page in rng.permutation(max(1, -(-n // page_size)))[:pages]:
+            start = time.perf_counter()
+            session.read_page(int(page) + 1)
+            page_times.append(time.perf_counter() - start)
+        for _ in range(id_pages):
+            ids = rng.choice(n, min(n, page_size), replace=False)
+            start = time.perf_counter()
+            session.read_ids(ids)
+            id_times.append(time.perf_counter() - start)
+    finally:
+        session.close()
+    return float(np.median(page_times)), float(np.median(id_times))
+
+
+def merge(args, keys):
+    """Merge the labels of `sources` into `target`, all for the same events.
+
+    With `--strategy fill` only unlabelled events of the target are set,
+    with `overwrite` every labelled event of a later source wins. Unsaved
+    journal records of all files are applied first, the target's journal
+    is emptied once the merged labels are written.
+    """
+    sources = [h5py.File(path, 'r') for path in args.sources]
+    journals = [Journal(f"{path}.journal").read() for path in args.sources]
+    target_journal = Journal(f"{args.target}.journal")
+    try:
+        with h5py.File(args.target, 'r+') as target:
+            n = n_events(target, keys)
+            for source in sources:
+                if n_events(source, keys) != n:
+                    sys.exit(f"{source.filename} has a different number of "
+                             f"events than {args.target}!")
+            pending = target_journal.read()
+            created = keys['label_key'] not in target
+            if created:
+                # seeded from the data frame in the first pass below
+                target.create_dataset(
+                    keys['label_key'], shape=(n,), dtype='uint8',
+                    maxshape=(None,), chunks=(min(args.chunk, max(n, 1)),))
+            dataset = target[keys['label_key']]
+            changed = 0
+            for start, stop in chunks(n, args.chunk):
+                labels = dataset[start:stop]
+                if created:
+                    initial = frame_labels(
+                        target, keys['data_key'], slice(start, stop))
+                    if initial is not None:
+                        labels = initial
+                replayed = apply_journal(labels, pending, start)
+                merged = labels.copy()
+                for source, journal in zip(sources, journals):
+                    other = read_labels(source, keys, start, stop, journal)
+                    mask = other != 0
+                    if args.strategy == 'fill':
+                        mask &= merged == 0
+                    merged[mask] = other[mask]
+                changed += int(np.count_nonzero(merged != labels))
+                if created or replayed or \
+                        not np.array_equal(merged, labels):
+                    dataset[start:stop] = merged
+    finally:
+        for source in sources:
+            source.close()
+    target_journal.truncate()
+    logger.info(f"Merged {len(sources)} label sets into {args.target}, "
+                f"{changed} labels changed")
+
+
+def stats(args, keys):
+    paths = expand(args.input)
+    names = keys['names']
+    total = np.zeros(0, dtype='int64')
+    for path in paths:
+        journal = Journal(f"{path}.journal").read()
+        counts = np.zeros(0, dtype='int64')
+        with h5py.File(path, 'r') as file:
+            names = label_names(file, keys) or names
+            for start, stop in chunks(n_events(file, keys), args.chunk):
+                labels = read_labels(file, keys, start, stop, journal)
+                counts = add_counts(counts, np.bincount(labels))
+        print_counts(path, counts, names)
+        total = add_counts(total, counts)
+    if len(paths) > 1:
+        print_counts('total', total, names)
+
+
+def add_counts(a, b):
+    size = max(len(a), len(b))
+    return np.pad(a, (0, size - len(a))) + np.pad(b, (0, size - len(b)))
+
+
+def print_counts(title, counts, names):
+    print(f"{title}: {counts.sum()} events")
+    for label, count in enumerate(counts):
+        if count:
+            name = names[label] if label < len(names) else str(label)
+            print(f"  {label:>3} {name:<16}{count:>12}")
+
+
+def validate(args, keys):
+    "Check the layout of input files, exit with 1 when a problem was found."
+    failed = False
+    for path in expand(args.input):
+        problems = []
+        try:
+            with h5py.File(path, 'r') as file:
+                problems = check_file(file, keys, args.chunk)
+        except OSError as e:
+            problems = [f"cannot open file: {e}"]
+        pending = len(Journal(f"{path}.journal").read())
+        if pending:
+            logger.warning(f"{path}: {pending} unsaved journal records")
+        for problem in problems:
+            logger.error(f"{path}: {problem}")
+        if not problems:
+            logger.info(f"{path}: OK")
+        failed |= bool(problems)
+    if failed:
+        sys.exit(1)
+
+
+def check_file(file, keys, chunk):
+    problems = []
+    if keys['image_key'] not in file:
+        return [f"image dataset '{keys['image_key']}' is missing"]
+    images = file[keys['image_key']]
+    if images.ndim != 4:
+        problems.append(f"images have shape {images.shape}, expected "
+                        f"(events, height, width, channels)")
+    if images.dtype != np.dtype('uint16'):
+        problems.append(f"images are {images.dtype}, expected uint16")
+    n = images.shape[0]
+    if keys['data_key'] not in file:
+        problems.append(f"data frame '{keys['data_key']}' is missing")
+    else:
+        rows = data_rows(file[keys['data_key']])
+        if rows is not None and rows != n:
+            problems.append(f"data frame has {rows} rows for {n} events")
+    if keys['label_key'] in file:
+        labels = file[keys['label_key']]
+        if labels.shape != (n,):
+            problems.append(f"labels have shape {labels.shape} for {n} "
+                            f"events")
+        n_names = len(label_names(file, keys))
+        if n_names:
+            for start, stop in chunks(labels.shape[0], chunk):
+                if labels[start:stop].max(initial=0) >= n_names:
+                    problems.append(f"labels past the {n_names} label "
+                                    f"names in events {start}-{stop}")
+                    break
+    if keys['column_key'] in file:
+        for name, dataset in file[keys['column_key']].items():
+            if dataset.shape != (n,):
+                problems.append(f"column '{name}' has shape "
+                                f"{dataset.shape} for {n} events")
+    return problems
+
+
+def data_rows(group):
+    "Number of rows of a pandas frame stored in fixed or table format."
+    if 'table' in group:
+        return group['table'].shape[0]
+    if 'axis1' in group:
+        # pandas marks empty arrays with a placeholder and a shape attribute
+        if 'shape' in group['axis1'].attrs:
+            return 0
+        return group['axis1'].shape[0]
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m annotateEZ',
+        description="Batch tools for annotateEZ files, no display needed.")
+    parser.add_argument(
+        '--chunk', type=int,
+        help="number of events processed at once, 65536 by default, "
+             "8192 per thread for convert and 4096 for dedup")
+    parser.set_defaults(default_chunk=65536)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_export = commands.add_parser(
+        'export', help="export data and labels to TSV or Parquet")
+    parser_export.add_argument('input', nargs='+')
+    parser_export.add_argument(
+        '--format', choices=['tsv', 'parquet'], default='tsv')
+    parser_export.add_argument('--output-dir', default='.')
+    parser_export.set_defaults(func=export)
+
+    parser_convert = commands.add_parser(
+        'convert', help="convert images to 8-bit RGB .npy files")
+    parser_convert.add_argument('input', nargs='+')
+    parser_convert.add_argument('--output-dir', default='.')
+    parser_convert.add_argument(
+        '--workers', type=int, default=os.cpu_count(),
+        help="conversion threads")
+    parser_convert.add_argument(
+        '--display', action='store_true',
+        help="use the channel display settings of config.yml")
+    # every thread holds a chunk of raw images and its intermediates
+    parser_convert.set_defaults(func=convert, default_chunk=8192)
+
+    parser_dedup = commands.add_parser(
+        'dedup', help="group near-duplicate events by perceptual hashes")
+    parser_dedup.add_argument('input', nargs='+')
+    parser_dedup.add_argument(
+        '--distance', type=int, default=3, choices=range(4),
+        help="most differing hash bits of duplicates, at most 3")
+    # the images of a chunk are held raw and as gray float32 images
+    parser_dedup.set_defaults(func=dedup, default_chunk=4096)
+
+    parser_rechunk = commands.add_parser(
+        'rechunk', help="rewrite images with one compressed chunk per page")
+    parser_rechunk.add_argument('input', nargs='+')
+    parser_rechunk.add_argument(
+        '--output-dir', help="write here instead of replacing the input")
+    parser_rechunk.add_argument(
+        '--page-size', type=int,
+        help="events per chunk, x_size * y_size of config.yml by default")
+    parser_rechunk.add_argument(
+        '--compression', choices=['lzf', 'gzip', 'blosc', 'none'],
+        default='lzf', help="blosc needs hdf5plugin")
+    parser_rechunk.set_defaults(func=rechunk)
+
+    parser_merge = commands.add_parser(
+        'merge', help="merge label sets of the same events into one file")
+    parser_merge.add_argument('target')
+    parser_merge.add_argument('sources', nargs='+')
+    parser_merge.add_argument(
+        '--strategy', choices=['fill', 'overwrite'], default='fill')
+    parser_merge.set_defaults(func=merge)
+
+    parser_stats = commands.add_parser('stats', help="per-class counts")
+    parser_stats.add_argument('input', nargs='+')
+    parser_stats.set_defaults(func=stats)
+
+    parser_validate = commands.add_parser(
+        'validate', help="check the layout of input files")
+    parser_validate.add_argument('input', nargs='+')
+    parser_validate.set_defaults(func=validate)
+
+    args = parser.parse_args(argv)
+    if args.chunk is None:
+        args.chunk = args.default_chunk
+    logging.basicConfig(
+        level=logging.INFO, format="[%(levelname)s] %(message)s")
+    load_filters()
+    args.func(args, load_keys())
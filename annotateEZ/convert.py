@@ -0,0 +1,184 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+# Source channel shown in each of the R, G and B outputs
+RGB_ORDER = (1, 2, 0)
+# Channel added on top of all three outputs when present
+WHITE_CHANNEL = 3
+
+
+def channels2rgb8bit(image, out=None, chunk=256):
+    """Convert 4 channel images to 8-bit RGB color images.
+
+    Accepts a single (h, w, c) image or a (n, h, w, c) stack. The result is
+    written into `out` when given, otherwise into a new uint8 array, and is
+    computed with integer arithmetic `chunk` events at a time so that the
+    only temporary is one uint32 channel of a chunk.
+    """
+    assert(image.dtype == 'uint16')
+    if image.ndim == 3:
+        if out is None:
+            out = np.empty(image.shape[:2] + (3,), dtype='uint8')
+        channels2rgb8bit(image[np.newaxis], out[np.newaxis])
+        return(out)
+
+    n = image.shape[0]
+    if out is None:
+        out = np.empty(image.shape[:3] + (3,), dtype='uint8')
+    white = image.shape[3] > WHITE_CHANNEL
+    scratch = np.empty((min(chunk, n),) + image.shape[1:3], dtype='uint32')
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        tmp = scratch[:stop - start]
+        for k, c in enumerate(RGB_ORDER):
+            if white:
+                np.add(image[start:stop, :, :, c],
+                       image[start:stop, :, :, WHITE_CHANNEL],
+                       out=tmp, dtype='uint32')
+                np.minimum(tmp, 65535, out=tmp)
+            else:
+                np.copyto(tmp, image[start:stop, :, :, c])
+            np.right_shift(tmp, 8, out=tmp)
+            np.copyto(out[start:stop, :, :, k], tmp, casting='unsafe')
+    return(out)
+
+
+def convert_parallel(images, out=None, convert=channels2rgb8bit,
+                     chunk=8192, workers=None):
+    """Convert a (n, h, w, c) image stack `chunk` events at a time on a
+    thread pool of `workers` threads, one per core by default.
+
+    `images` may be anything sliced along the event axis, e.g. an array, a
+    memory map or an h5py dataset, which is then read chunk by chunk by the
+    workers. Each chunk is written into its slice of `out`, e.g. a memory
+    mapped .npy file, so at most `workers` chunks are held in memory. NumPy
+    releases the GIL while converting, so this scales with the cores.
+    """
+    n = images.shape[0]
+    if out is None:
+        out = np.empty(images.shape[:3] + (3,), dtype='uint8')
+
+    def task(start):
+        stop = min(start + chunk, n)
+        convert(np.asarray(images[start:stop]), out=out[start:stop])
+        return(stop - start)
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        # consume the results to raise errors of the workers here
+        for _ in pool.map(task, range(0, n, chunk)):
+            pass
+    return(out)
+
+
+CHANNEL_COLORS = {
+    'none': (0, 0, 0),
+    'red': (255, 0, 0),
+    'green': (0, 255, 0),
+    'blue': (0, 0, 255),
+    'white': (255, 255, 255),
+    'gray': (255, 255, 255),
+    'yellow': (255, 255, 0),
+    'magenta': (255, 0, 255),
+    'cyan': (0, 255, 255),
+    'orange': (255, 165, 0),
+}
+# Colors matching the fixed mapping of channels2rgb8bit
+DEFAULT_COLORS = ('blue', 'red', 'green', 'white')
+
+
+def channel_lut(low, high, gamma):
+    "Build the 65536-entry uint16 -> uint8 lookup table of one channel."
+    x = np.arange(65536, dtype='float64')
+    x = np.clip((x - low) / max(high - low, 1), 0, 1)
+    if gamma != 1:
+        x **= gamma
+    return(np.rint(x * 255).astype('uint8'))
+
+
+class DisplayTransform:
+    """Per-channel contrast and color assignment compiled to lookup tables.
+
+    Each entry of `channels` (the `channels` list of config.yml) may set
+    `color`, `min`, `max`, `gamma`, `active` and `percentile`. When
+    `percentile` is given as [low, high], the window is taken from the
+    percentiles of the sample passed to `fit` instead of `min` and `max`.
+    Output values are `((v - min) / (max - min)) ** gamma` scaled by the
+    channel color and summed with saturation over channels.
+
+    Tables are only rebuilt for channels whose settings changed, so calling
+    `update` on every slider movement is cheap.
+    """
+
+    def __init__(self, channels):
+        self.limits = {}
+        self.luts = {}
+        self.tables = {}
+        self.settings = []
+        self.update(channels)
+
+    def channel_settings(self, c, channel):
+        color = channel.get(
+            'color', DEFAULT_COLORS[c] if c < len(DEFAULT_COLORS) else 'none')
+        if not channel.get('active', True):
+            color = 'none'
+        if channel.get('percentile') is not None and c in self.limits:
+            low, high = self.limits[c]
+        else:
+            low, high = channel.get('min', 0), channel.get('max', 65535)
+        return((CHANNEL_COLORS[color], int(low), int(high),
+                float(channel.get('gamma', 1.0))))
+
+    def update(self, channels):
+        "Apply new channel settings, recompiling only the changed tables."
+        self.channels = channels
+        settings = [self.channel_settings(c, channel)
+                    for c, channel in enumerate(channels)]
+        for c, setting in enumerate(settings):
+            if c < len(self.settings) and self.settings[c] == setting:
+                continue
+            color, low, high, gamma = setting
+            lut = channel_lut(low, high, gamma)
+            self.luts[c] = lut
+            self.tables[c] = [
+                None if w == 0 else
+                (lut.astype('uint16') * w // 255).astype('uint8')
+                for w in color]
+        self.settings = settings
+        self.key = hash(tuple(settings))
+
+    def fit(self, sample):
+        "Set percentile windows from a (n, h, w, c) sample of raw images."
+        for c, channel in enumerate(self.channels):
+            if channel.get('percentile') is None or c >= sample.shape[-1]:
+                continue
+            values = sample[..., c].ravel()
+            # a million pixels are plenty for a stable estimate
+            values = values[::max(1, values.size // 1000000)]
+            self.limits[c] = tuple(np.percentile(values, channel['percentile']))
+        self.update(self.channels)
+
+    def channel(self, image, c, out=None):
+        "Map channel `c` of uint16 images to 8-bit gray through its window."
+        return(np.take(self.luts[c], image[..., c], out=out, mode='clip'))
+
+    def __call__(self, image, out=None):
+        "Convert uint16 images to 8-bit RGB through the lookup tables."
+        assert(image.dtype == 'uint16')
+        if out is None:
+            out = np.empty(image.shape[:-1] + (3,), dtype='uint8')
+        n_channels = min(image.shape[-1], len(self.settings))
+        acc = np.empty(image.shape[:-1], dtype='uint16')
+        tmp = np.empty(image.shape[:-1], dtype='uint8')
+        for k in range(3):
+            acc.fill(0)
+            for c in range(n_channels):
+                lut = self.tables[c][k]
+                if lut is None:
+                    continue
+                np.take(lut, image[..., c], out=tmp, mode='clip')
+                np.add(acc, tmp, out=acc)
+            np.minimum(acc, 255, out=acc)
+            np.copyto(out[..., k], acc, casting='unsafe')
+        return(out)
@@ -0,0 +1,531 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from glob import glob
+import os
+import threading
+import weakref
+
+import numpy as np
+
+from annotateEZ.metrics import metrics
+
+
+class ImageStore:
+    """Lazy, page-wise access to the image dataset of an HDF5 file.
+
+    The dataset is kept open and only the events of the requested page are
+    read. Neighbouring pages are read ahead by a `Prefetcher`. The chunk
+    cache holds `cache_chunks` chunks, so reads of scattered ids do not
+    decompress the same chunk again, e.g. with one chunk per page, which
+    is often larger than the default cache of HDF5.
+    """
+
+    cache_chunks = 4
+
+    def __init__(self, path, key, page_size):
+        self.path = path
+        self.key = key
+        self.file = None
+        self.open()
+
+        self.shape      = self.dataset.shape
+        self.dtype      = self.dataset.dtype
+        self.n_events   = self.shape[0]
+        self.im_h       = self.shape[1]
+        self.im_w       = self.shape[2]
+        self.n_channels = self.shape[3]
+        self.page_size  = page_size
+        self.n_pages    = 1 + self.n_events // self.page_size
+
+    def open(self):
+        # h5py is imported on first use to keep the GUI start fast
+        import h5py
+
+        load_filters()
+        self.file = h5py.File(self.path, 'r')
+        if self.key not in self.file:
+            self.close()
+            raise KeyError(f"Images not found in input file: {self.key}")
+        dataset = self.file[self.key]
+        nbytes = 0
+        if dataset.chunks is not None:
+            nbytes = self.cache_chunks * dataset.dtype.itemsize \
+                * int(np.prod(dataset.chunks))
+        if nbytes > self.file.id.get_access_plist().get_cache()[2]:
+            # the cache is set when a dataset is first opened, so the
+            # handle used to look at the chunks is dropped before
+            del dataset
+            access = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+            access.set_chunk_cache(521, nbytes, 1.0)
+            dataset = h5py.Dataset(h5py.h5d.open(
+                self.file.id, self.key.encode(), access))
+        self.dataset = dataset
+
+    def read(self, start, stop):
+        "Read events [start, stop) padding past the last event with zeros."
+        out = np.zeros(
+            (stop - start, self.im_h, self.im_w, self.n_channels),
+            dtype=self.dtype)
+        end = min(stop, self.n_events)
+        if start < end:
+            with metrics.span('hdf5_read', events=end - start):
+                self.dataset.read_direct(
+                    out, np.s_[start:end], np.s_[0:end - start])
+        return(out)
+
+    def read_page(self, page):
+        "Return the raw images of a 1-based page."
+        start = (page - 1) * self.page_size
+        return(self.read(start, start + self.page_size))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.dataset = None
+
+
+def load_filters():
+    "Register the extra compression filters of hdf5plugin, if installed."
+    try:
+        import hdf5plugin  # noqa: F401
+    except ImportError:
+        pass
+
+
+def session_paths(spec):
+    "Expand a file, a directory or a glob pattern to sorted .hdf5 paths."
+    if os.path.isdir(spec):
+        spec = os.path.join(spec, '*.hdf5')
+    return(sorted(glob(spec)))
+
+
+class Session:
+    """Several input files paged through as one combined event space.
+
+    Events are numbered across the files in order. The (file, offset) of
+    an event is found by a binary search in the cumulative file sizes, so
+    the index costs one integer per file. Files are opened on first use
+    and at most `max_open` are kept open, the least recently used one is
+    closed first. Provides the same reading interface as `ImageStore`.
+    """
+
+    def __init__(self, paths, key, page_size, max_open=16):
+        if not paths:
+            raise FileNotFoundError("No input files given!")
+        self.paths = list(paths)
+        self.key = key
+        self.stores = []
+        for path in self.paths:
+            store = ImageStore(path, key, page_size)
+            store.close()
+            if self.stores and (store.shape[1:] != self.stores[0].shape[1:]
+                                or store.dtype != self.stores[0].dtype):
+                raise ValueError(
+                    f"Images of {path} do not match {self.paths[0]}: "
+                    f"{store.shape} {store.dtype}")
+            self.stores.append(store)
+        self.sizes = np.array([s.n_events for s in self.stores], 'int64')
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes)))
+        self.max_open = max(1, max_open)
+        self.open_stores = OrderedDict()
+        self.lock = threading.RLock()
+
+        first = self.stores[0]
+        self.n_events   = int(self.offsets[-1])
+        self.shape      = (self.n_events,) + first.shape[1:]
+        self.dtype      = first.dtype
+        self.im_h       = first.im_h
+        self.im_w       = first.im_w
+        self.n_channels = first.n_channels
+        self.page_size  = page_size
+        self.n_pages    = 1 + self.n_events // self.page_size
+
+    def locate(self, ids):
+        "Return the file index and the offset within that file of each id."
+        files = np.searchsorted(self.offsets, ids, side='right') - 1
+        return(files, ids - self.offsets[files])
+
+    def split(self, ids):
+        "Group session-wide ids by file as (file index, local ids) pairs."
+        files, local = self.locate(np.asarray(ids, dtype='int64'))
+        for i in np.unique(files):
+            yield(int(i), local[files == i])
+
+    def store(self, i):
+        "Return the opened store of file `i`."
+        with self.lock:
+            if i in self.open_stores:
+                self.open_stores.move_to_end(i)
+            else:
+                self.stores[i].open()
+                self.open_stores[i] = self.stores[i]
+                while len(self.open_stores) > self.max_open:
+                    _, store = self.open_stores.popitem(last=False)
+                    store.close()
+            return(self.stores[i])
+
+    def read(self, start, stop):
+        "Read events [start, stop) padding past the last event with zeros."
+        out = np.zeros(
+            (stop - start, self.im_h, self.im_w, self.n_channels),
+            dtype=self.dtype)
+        pos = start
+        end = min(stop, self.n_events)
+        while pos < end:
+            i = int(np.searchsorted(self.offsets, pos, side='right') - 1)
+            file_end = min(end, int(self.offsets[i + 1]))
+            local = pos - int(self.offsets[i])
+            with self.lock, metrics.span('hdf5_read', events=file_end - pos):
+                self.store(i).dataset.read_direct(
+                    out, np.s_[local:local + file_end - pos],
+                    np.s_[pos - start:file_end - start])
+            pos = file_end
+        return(out)
+
+    def read_page(self, page):
+        "Return the raw images of a 1-based page."
+        start = (page - 1) * self.page_size
+        return(self.read(start, start + self.page_size))
+
+    def read_ids(self, ids, max_gap=16):
+        """Read the events `ids` in the given order.
+
+        The ids are sorted and grouped into runs whose gaps are at most
+        `max_gap` events, each run is read with one contiguous read.
+        """
+        ids = np.asarray(ids, dtype='int64')
+        out = np.empty(
+            (len(ids), self.im_h, self.im_w, self.n_channels),
+            dtype=self.dtype)
+        if len(ids) == 0:
+            return(out)
+        order = np.argsort(ids, kind='stable')
+        sorted_ids = ids[order]
+        breaks = np.flatnonzero(np.diff(sorted_ids) > max_gap + 1) + 1
+        for run in np.split(np.arange(len(ids)), breaks):
+            first, last = sorted_ids[run[0]], sorted_ids[run[-1]]
+            block = self.read(int(first), int(last) + 1)
+            out[order[run]] = block[sorted_ids[run] - first]
+        return(out)
+
+    def open(self):
+        "Files are opened again on demand."
+
+    def close(self):
+        with self.lock:
+            for store in self.open_stores.values():
+                store.close()
+            self.open_stores.clear()
+
+
+class EventOrder:
+    """Pages over a selection of events shown in a given order.
+
+    `order` holds the event ids in display order, `None` pages through all
+    events in file order. Provides `read_page` and `n_pages` like the
+    stores, so it can be handed to a `Prefetcher`.
+    """
+
+    def __init__(self, store, page_size, order=None):
+        self.store = store
+        self.page_size = page_size
+        self.order = order
+        self.n_events = store.n_events if order is None else len(order)
+        self.n_pages = 1 + self.n_events // self.page_size
+
+    def ids(self, page, last=None):
+        """Return the event ids of a 1-based page, or of the pages from
+        `page` to `last`, without padding."""
+        start = (page - 1) * self.page_size
+        stop = min((last or page) * self.page_size, self.n_events)
+        if self.order is None:
+            return(np.arange(start, max(start, stop), dtype='int64'))
+        return(self.order[start:stop])
+
+    def read_page(self, page):
+        "Return the raw images of a 1-based page."
+        if self.order is None:
+            # the store keeps the page size it was opened with, the grid
+            # may have changed since
+            start = (page - 1) * self.page_size
+            return(self.store.read(start, start + self.page_size))
+        ids = self.ids(page)
+        out = np.zeros(
+            (self.page_size, self.store.im_h, self.store.im_w,
+             self.store.n_channels), dtype=self.store.dtype)
+        out[:len(ids)] = self.store.read_ids(ids)
+        return(out)
+
+
+class BufferPool:
+    """Recycles the memory of page buffers instead of allocating it anew
+    for every page.
+
+    Memory only returns to the pool once the `PageBuffer` using it was
+    garbage collected, so it is never reused while image views of it
+    exist. At most `capacity` free blocks of each size are kept.
+    """
+
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.free = {}
+        self.lock = threading.Lock()
+
+    def take(self, nbytes):
+        with self.lock:
+            blocks = self.free.get(nbytes)
+            if blocks:
+                metrics.count('buffer_reuse')
+                return(blocks.pop())
+        metrics.count('buffer_alloc')
+        return(np.empty(nbytes, dtype='uint8'))
+
+    def give(self, blocks):
+        with self.lock:
+            for block in blocks:
+                free = self.free.setdefault(block.nbytes, [])
+                if len(free) < self.capacity:
+                    free.append(block)
+
+
+class PageBuffer:
+    """The converted images of a page in memory owned by the buffer.
+
+    `rgb` holds (n, h, w, 3) images, `raw` the source images when they were
+    read. Every image starts on a 4 byte boundary as QImage expects, rows
+    are contiguous. Grayscale and single channel planes are computed on
+    first use into memory of the same pool. Views of the buffer must keep
+    the buffer itself alive, its memory goes back to the pool when it is
+    collected.
+    """
+
+    def __init__(self, rgb, raw=None, pool=None, blocks=None):
+        self.rgb = rgb
+        self.raw = raw
+        self.pool = pool
+        self.blocks = [] if blocks is None else blocks
+        self.planes = {}
+        if pool is not None:
+            # the finalizer holds the block list but not the buffer
+            weakref.finalize(self, pool.give, self.blocks)
+
+    @staticmethod
+    def images(pool, blocks, n, h, w, channels):
+        "Allocate (n, h, w, channels) uint8 images aligned to 4 bytes."
+        stride = (h * w * channels + 3) // 4 * 4
+        block = np.empty(n * stride, 'uint8') if pool is None \
+            else pool.take(n * stride)
+        blocks.append(block)
+        return(np.ndarray((n, h, w, channels), dtype='uint8', buffer=block,
+                          strides=(stride, w * channels, channels, 1)))
+
+    @classmethod
+    def convert(cls, raw, convert, pool=None):
+        "Convert raw images into a new buffer."
+        blocks = []
+        rgb = cls.images(pool, blocks, *raw.shape[:3], 3)
+        with metrics.span('convert', events=len(raw)):
+            convert(raw, out=rgb)
+        return(cls(rgb, raw, pool, blocks))
+
+    def __len__(self):
+        return(len(self.rgb))
+
+    def plane(self, key, fill):
+        if key not in self.planes:
+            plane = self.images(self.pool, self.blocks, *self.rgb.shape[:3], 1)
+            fill(plane[..., 0])
+            self.planes[key] = plane[..., 0]
+        return(self.planes[key])
+
+    def gray(self):
+        "Luminance of the RGB images as (n, h, w) uint8."
+        def fill(out):
+            rgb = self.rgb.astype('uint16')
+            np.copyto(out, (rgb[..., 0] * 77 + rgb[..., 1] * 150
+                            + rgb[..., 2] * 29) >> 8, casting='unsafe')
+        return(self.plane('gray', fill))
+
+    def channel(self, c, transform):
+        "Channel `c` of the raw images through its display window."
+        return(self.plane(
+            ('channel', c), lambda out: transform.channel(self.raw, c, out)))
+
+
+def convert_page(pages, page, convert, thumbnails=None, pool=None):
+    """Read and convert a 1-based page of `pages`, an `EventOrder`.
+
+    With `thumbnails` the converted images are taken from the thumbnail
+    cache when all events of the page are there, and stored in it after a
+    conversion otherwise. Returns a `PageBuffer` whose raw images are None
+    on a thumbnail hit.
+    """
+    ids = pages.ids(page) if thumbnails is not None else None
+    if thumbnails is not None:
+        cached = thumbnails.get(ids)
+        metrics.count('thumbnail_miss' if cached is None else 'thumbnail_hit')
+        if cached is not None:
+            if len(ids) == pages.page_size:
+                return(PageBuffer(cached, pool=pool))
+            # the last page is padded
+            blocks = []
+            rgb = PageBuffer.images(
+                pool, blocks, pages.page_size, *cached.shape[1:])
+            rgb[:len(ids)] = cached
+            rgb[len(ids):] = 0
+            return(PageBuffer(rgb, pool=pool, blocks=blocks))
+    buffer = PageBuffer.convert(pages.read_page(page), convert, pool)
+    if thumbnails is not None and len(ids):
+        thumbnails.put(ids, buffer.rgb[:len(ids)])
+    return(buffer)
+
+
+class PageCache:
+    "Thread-safe LRU cache holding at most `capacity` pages."
+
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, page):
+        with self.lock:
+            return(page in self.pages)
+
+    def get(self, page):
+        with self.lock:
+            if page not in self.pages:
+                return(None)
+            self.pages.move_to_end(page)
+            return(self.pages[page])
+
+    def put(self, page, value):
+        with self.lock:
+            self.pages[page] = value
+            self.pages.move_to_end(page)
+            while len(self.pages) > self.capacity:
+                self.pages.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+
+
+class Prefetcher:
+    """Read and convert pages around the current one on a thread pool.
+
+    `get` returns the converted page, from the cache when it was prefetched,
+    and schedules pages N+1..N+ahead and N-behind..N-1 in the background.
+    HDF5 reads are serialized by h5py, conversion runs without the GIL.
+
+    Pages are `PageBuffer`s holding the raw images next to the converted
+    ones, so that after `set_convert` cached pages are converted again
+    without another read. Their memory is recycled through a `BufferPool`.
+    Pages found in the optional on-disk `thumbnails` are neither read nor
+    converted.
+    """
+
+    def __init__(self, store, convert, ahead=2, behind=1, cache_pages=8,
+                 workers=2, thumbnails=None):
+        self.store = store
+        self.convert = convert
+        self.thumbnails = thumbnails
+        self.generation = 0
+        self.ahead = ahead
+        self.behind = behind
+        self.cache = PageCache(max(cache_pages, ahead + behind + 1))
+        self.pool = BufferPool(self.cache.capacity + workers + 2)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='prefetch')
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def load(self, page):
+        "Read and convert a page into a [generation, PageBuffer] entry."
+        with self.lock:
+            generation, convert = self.generation, self.convert
+            thumbnails = self.thumbnails
+        return([generation, convert_page(
+            self.store, page, convert, thumbnails, self.pool)])
+
+    def _task(self, page):
+        try:
+            entry = self.load(page)
+            self.cache.put(page, entry)
+            return(entry)
+        finally:
+            with self.lock:
+                self.pending.pop(page, None)
+
+    def get_entry(self, page):
+        entry = self.cache.get(page)
+        metrics.count('page_cache_miss' if entry is None else 'page_cache_hit')
+        if entry is None:
+            with self.lock:
+                future = self.pending.get(page)
+            if future is not None:
+                entry = future.result()
+            else:
+                entry = self.load(page)
+                self.cache.put(page, entry)
+        if entry[0] != self.generation and entry[1].raw is None:
+            # thumbnails of older settings are replaced, not converted
+            entry = self.load(page)
+            self.cache.put(page, entry)
+        elif entry[0] != self.generation:
+            # views of the old buffer stay valid, it is not written to
+            entry[:] = [self.generation, PageBuffer.convert(
+                entry[1].raw, self.convert, self.pool)]
+        self.schedule(page)
+        return(entry)
+
+    def get(self, page):
+        "Return the `PageBuffer` of a page."
+        return(self.get_entry(page)[1])
+
+    def get_raw(self, page):
+        "Return the raw images of a page."
+        buffer = self.get_entry(page)[1]
+        if buffer.raw is None:
+            buffer.raw = self.store.read_page(page)
+        return(buffer.raw)
+
+    def set_convert(self, convert, thumbnails=None):
+        """Switch the conversion and the thumbnails made with it, cached
+        pages are updated when next used."""
+        with self.lock:
+            self.convert = convert
+            self.thumbnails = thumbnails
+            self.generation += 1
+
+    def schedule(self, page):
+        "Queue the neighbours of a page that are neither cached nor pending."
+        pages = list(range(page + 1, page + self.ahead + 1)) \
+            + list(range(page - 1, page - self.behind - 1, -1))
+        for p in pages:
+            if p < 1 or p > self.store.n_pages or p in self.cache:
+                continue
+            with self.lock:
+                if p not in self.pending and p not in self.cache:
+                    self.pending[p] = self.executor.submit(self._task, p)
+        metrics.gauge('prefetch_queue', self.queue_depth)
+
+    @property
+    def queue_depth(self):
+        with self.lock:
+            return(len(self.pending))
+
+    def wait(self):
+        "Block until all queued pages are loaded."
+        with self.lock:
+            futures = list(self.pending.values())
+        wait(futures)
+
+    def clear(self):
+        self.wait()
+        self.cache.clear()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.cache.clear()
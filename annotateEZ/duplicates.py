@@ -0,0 +1,193 @@
+import os
+
+import numpy as np
+
+# Bits of the hash compared exactly in each band
+BAND_BITS = 16
+
+BIT_COUNTS = np.array([bin(i).count('1') for i in range(256)], dtype='uint8')
+
+
+def popcount(values):
+    "Set bits of each uint64 value."
+    if hasattr(np, 'bitwise_count'):
+        return(np.bitwise_count(values))
+    values = np.ascontiguousarray(values, dtype='uint64')
+    return(BIT_COUNTS[values.view('uint8')].reshape(-1, 8).sum(axis=1))
+
+
+def tile_hash(images):
+    """64-bit perceptual hashes of image tiles, shape (n, height, width,
+    channels), e.g. the raw 16-bit images.
+
+    Each tile is reduced to 8 x 8 gray cells by block averages, and each
+    bit tells whether a cell is brighter than the mean of its four
+    neighbours, so the bits trace the place and size of both dark and
+    bright structures. The bits only compare cells of one tile, which
+    makes the hash independent of the tile's brightness and contrast, so
+    dim tiles keep the detail an 8-bit conversion would flatten.
+    """
+    gray = images.sum(axis=3, dtype='float32')
+    n, h, w = gray.shape
+    rows = np.arange(8) * h // 8
+    cols = np.arange(8) * w // 8
+    cells = np.add.reduceat(np.add.reduceat(gray, rows, axis=1), cols, axis=2)
+    cells /= np.maximum(np.diff(np.append(rows, h)), 1)[:, None]
+    cells /= np.maximum(np.diff(np.append(cols, w)), 1)[None, :]
+    edges = np.pad(cells, ((0, 0), (1, 1), (1, 1)), mode='edge')
+    neighbours = (edges[:, :-2, 1:-1] + edges[:, 2:, 1:-1]
+                  + edges[:, 1:-1, :-2] + edges[:, 1:-1, 2:]) / 4
+    bits = np.packbits((cells > neighbours).reshape(n, 64), axis=1)
+    return(bits.view('>u8')[:, 0].astype('uint64'))
+
+
+def near_pairs(hashes, distance, window):
+    """Pairs of events whose hashes differ in at most `distance` bits.
+
+    The hashes are split into 64 / BAND_BITS bands. Hashes within 3 bits
+    share at least one band, so only events with an equal band are
+    compared, each with the next `window` events sorted by band and hash.
+    """
+    n = len(hashes)
+    pairs = []
+    for band in range(64 // BAND_BITS):
+        # rotate the band to the top bits, so one sort orders by band first
+        shift = (band + 1) * BAND_BITS
+        rotated = hashes >> np.uint64(shift % 64) \
+            | hashes << np.uint64(64 - shift)
+        order = np.argsort(rotated)
+        rotated = rotated[order]
+        keys = rotated >> np.uint64(64 - BAND_BITS)
+        for offset in range(1, min(window, n - 1) + 1):
+            same = keys[:-offset] == keys[offset:]
+            if not same.any():
+                break
+            # rotated hashes differ in as many bits as the hashes
+            near = np.flatnonzero(same & (popcount(
+                rotated[:-offset] ^ rotated[offset:]) <= distance))
+            pairs.append((order[near], order[near + offset]))
+    if not pairs:
+        return(np.empty(0, 'int64'), np.empty(0, 'int64'))
+    return(np.concatenate([a for a, _ in pairs]),
+           np.concatenate([b for _, b in pairs]))
+
+
+def find_groups(hashes, distance=3, window=16):
+    """Group events whose hashes differ in at most `distance` bits from the
+    first event of their group.
+
+    Events with equal hashes join the first of them, and only the distinct
+    hashes are compared by `near_pairs`. Events joined by near pairs are
+    grouped by label propagation with pointer jumping, a vectorized
+    union-find. Members further than `distance` from the smallest id of
+    their group are then grouped again among themselves, so chains of
+    slowly changing hashes are split and every event is within `distance`
+    of its representative.
+
+    Returns the representative of each event, the smallest id of its
+    group.
+    """
+    bands = 64 // BAND_BITS
+    if distance >= bands:
+        raise ValueError(f"Hashes {distance} bits apart may not share one "
+                         f"of the {bands} bands, at most {bands - 1} bits "
+                         f"are supported!")
+    hashes = np.asarray(hashes, dtype='uint64')
+    _, first, inverse = np.unique(
+        hashes, return_index=True, return_inverse=True)
+    by_id = np.argsort(first)
+    ids = first[by_id]
+    distinct = hashes[ids]
+    n = len(ids)
+    a, b = near_pairs(distinct, distance, window)
+    representative = np.arange(n, dtype='int64')
+    while len(a):
+        labels = np.arange(n, dtype='int64')
+        while True:
+            low = np.minimum(labels[a], labels[b])
+            before = labels.copy()
+            np.minimum.at(labels, a, low)
+            np.minimum.at(labels, b, low)
+            labels = labels[labels]
+            if np.array_equal(labels, before):
+                break
+        # events close to the first event of their group are done
+        events = np.union1d(a, b)
+        done = events[popcount(
+            distinct[events] ^ distinct[labels[events]]) <= distance]
+        representative[done] = labels[done]
+        left = np.ones(n, dtype=bool)
+        left[done] = False
+        keep = left[a] & left[b]
+        a, b = a[keep], b[keep]
+    # back from the distinct hashes, sorted by id, to all events
+    rank = np.empty(n, dtype='int64')
+    rank[by_id] = np.arange(n)
+    return(ids[representative][rank][inverse])
+
+
+class DuplicateGroups:
+    """Groups of near-duplicate events of a session, given by the
+    representative id of each event."""
+
+    def __init__(self, representative):
+        self.representative = np.asarray(representative, dtype='int64')
+        self.n_events = len(self.representative)
+        self.order = np.argsort(self.representative, kind='stable')
+        self.sorted = self.representative[self.order]
+        self.n_groups = int(np.count_nonzero(
+            self.representative == np.arange(self.n_events)))
+
+    def members(self, ids):
+        "All events of the groups of `ids`, in one array."
+        ids = np.asarray(ids, dtype='int64')
+        ids = ids[(ids >= 0) & (ids < self.n_events)]
+        groups = np.unique(self.representative[ids])
+        starts = np.searchsorted(self.sorted, groups, side='left')
+        sizes = np.searchsorted(self.sorted, groups, side='right') - starts
+        ends = np.cumsum(sizes)
+        index = np.arange(ends[-1] if len(ends) else 0) \
+            + np.repeat(starts - ends + sizes, sizes)
+        return(self.order[index])
+
+    def collapse(self, order=None):
+        "Keep the first event of each group in `order`, file order if None."
+        if order is None:
+            return(np.flatnonzero(
+                self.representative == np.arange(self.n_events)))
+        order = np.asarray(order, dtype='int64')
+        _, first = np.unique(self.representative[order], return_index=True)
+        return(order[np.sort(first)])
+
+
+def read_groups(paths, key, sizes):
+    """The duplicate groups stored in the `key` group of each file, None when
+    no file has them.
+
+    Events whose stored representative, a file name and id, is the same
+    are grouped, and the first of them in the session represents the
+    group, also when the representative's file is not part of it. Events
+    of files without groups are groups of their own.
+    """
+    import h5py
+
+    codes = {os.path.basename(path): i for i, path in enumerate(paths)}
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    keys = np.empty(offsets[-1], dtype='int64')
+    found = False
+    for i, path in enumerate(paths):
+        part = slice(offsets[i], offsets[i + 1])
+        keys[part] = (i << 32) + np.arange(sizes[i])
+        with h5py.File(path, 'r') as file:
+            if key in file and 'representative' in file[key]:
+                group = file[key]
+                files = np.array([codes.setdefault(str(name), len(codes))
+                                  for name in group.attrs['files']], 'int64')
+                keys[part] = (files[group['representative_file'][:]] << 32) \
+                    + group['representative'][:]
+                found = True
+    if not found:
+        return(None)
+    _, first, inverse = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+    return(DuplicateGroups(first[inverse]))
@@ -1,12 +1,179 @@
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 
+import argparse
+import logging
 import os
 from pathlib import Path
 import sys
+import time
 from tqdm import tqdm
 
-import pandas as pd
+import h5py
 import numpy as np
 
-sys.path.append(str(Path(__file__).resolve().parents[1]))
\ No newline at end of file
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from annotateEZ.data import load_filters, session_paths
+from annotateEZ.similar import write_index
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkDataset(Dataset):
+    """Chunks of `chunk` events of an HDF5 image dataset as float tensors.
+
+    The file is opened lazily in each DataLoader worker, so handles are
+    never shared across processes. Images are returned channels first and
+    scaled by `scale`.
+    """
+
+    def __init__(self, path, key, chunk, scale=65535.0):
+        self.path = path
+        self.key = key
+        self.chunk = chunk
+        self.scale = scale
+        self.file = None
+        with h5py.File(path, 'r') as file:
+            self.n_events = file[key].shape[0]
+
+    def __len__(self):
+        return (self.n_events + self.chunk - 1) // self.chunk
+
+    def __getitem__(self, i):
+        if self.file is None:
+            load_filters()
+            self.file = h5py.File(self.path, 'r')
+        start = i * self.chunk
+        stop = min(start + self.chunk, self.n_events)
+        images = self.file[self.key][start:stop]
+        images = torch.from_numpy(images.astype('float32') / self.scale)
+        return start, images.permute(0, 3, 1, 2).contiguous()
+
+
+def predict(model, path, key, chunk=1024, workers=2, scale=65535.0,
+            embeddings=None):
+    """Run `model` over all images of `path`.
+
+    Returns the predicted class and its softmax probability per event.
+    When an `embeddings` array is given, e.g. a memory map, it is filled
+    with the output of the model's `embed` method, or with its logits
+    when it has none.
+    """
+    dataset = ChunkDataset(path, key, chunk, scale)
+    loader = DataLoader(
+        dataset, batch_size=None, shuffle=False, num_workers=workers,
+        persistent_workers=False)
+    labels = np.zeros(dataset.n_events, dtype='uint8')
+    scores = np.zeros(dataset.n_events, dtype='float32')
+    with torch.inference_mode(), tqdm(
+            total=dataset.n_events, unit='events',
+            desc=os.path.basename(path)) as progress:
+        for start, images in loader:
+            logits = model(images)
+            probs = torch.softmax(logits, dim=1)
+            score, label = probs.max(dim=1)
+            stop = start + len(images)
+            if embeddings is not None:
+                if hasattr(model, 'embed'):
+                    logits = model.embed(images)
+                embeddings[start:stop] = logits.flatten(1).numpy()
+            labels[start:stop] = label.numpy()
+            scores[start:stop] = score.numpy()
+            progress.update(len(images))
+    return labels, scores
+
+
+def open_embeddings(model, path, args):
+    """A memory-mapped .npy file next to `path` for the embeddings of its
+    events, sized by running the model on the first image.
+
+    Embeddings are streamed there while the images are still read, and
+    copied into the input file once all are done.
+    """
+    dataset = ChunkDataset(path, args.image_key, 1, args.scale)
+    _, images = dataset[0]
+    dataset.file.close()
+    with torch.inference_mode():
+        out = model.embed(images) if hasattr(model, 'embed') \
+            else model(images)
+    return np.lib.format.open_memmap(
+        f"{path}.embeddings.npy", mode='w+', dtype='float32',
+        shape=(dataset.n_events, out.flatten(1).shape[1]))
+
+
+def write_columns(path, key, columns):
+    "Store 1D arrays as datasets of the `key` group of an input file."
+    with h5py.File(path, 'r+') as file:
+        group = file.require_group(key)
+        for name, values in columns.items():
+            if name in group:
+                del group[name]
+            group.create_dataset(name, data=values)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Pre-label events with a TorchScript model on CPU.")
+    parser.add_argument(
+        'input', help="input file, directory or glob pattern")
+    parser.add_argument(
+        '--model', required=True, help="TorchScript model file")
+    parser.add_argument('--image-key', default='images')
+    parser.add_argument(
+        '--column-key', default='columns',
+        help="group the predicted columns are written to")
+    parser.add_argument(
+        '--prefix', default='pred', help="prefix of the column names")
+    parser.add_argument('--chunk', type=int, default=1024)
+    parser.add_argument(
+        '--workers', type=int, default=2, help="HDF5 reader processes")
+    parser.add_argument(
+        '--threads', type=int, default=torch.get_num_threads(),
+        help="torch threads used for the model")
+    parser.add_argument('--scale', type=float, default=65535.0)
+    parser.add_argument(
+        '--embed', action='store_true',
+        help="also store embeddings and their search index for similar "
+             "events")
+    parser.add_argument(
+        '--embedding-key', default='embeddings',
+        help="group the embeddings are written to")
+    parser.add_argument(
+        '--lists', type=int,
+        help="clusters of the search index, about sqrt(events) by default")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    torch.set_num_threads(args.threads)
+    model = torch.jit.load(args.model, map_location='cpu')
+    model.eval()
+
+    paths = session_paths(args.input)
+    if not paths:
+        sys.exit(f"No input files found at: {args.input}")
+    total, started = 0, time.perf_counter()
+    for path in paths:
+        embeddings = None
+        if args.embed:
+            embeddings = open_embeddings(model, path, args)
+        labels, scores = predict(
+            model, path, args.image_key, args.chunk, args.workers, args.scale,
+            embeddings)
+        write_columns(path, args.column_key, {
+            f"{args.prefix}_label": labels, f"{args.prefix}_score": scores})
+        total += len(labels)
+        logger.info(f"Wrote {len(labels)} predictions to {path}")
+        if embeddings is not None:
+            embeddings.flush()
+            n_lists = write_index(
+                path, args.embedding_key, embeddings, args.lists)
+            del embeddings
+            os.remove(f"{path}.embeddings.npy")
+            logger.info(f"Wrote embeddings in {n_lists} lists to {path}")
+    seconds = time.perf_counter() - started
+    logger.info(f"Pre-labelled {total} events in {seconds:.1f} s "
+                f"({total / max(seconds, 1e-9):.0f} events/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import os
+import time
+
+import numpy as np
+
+# One record per label change: event id and new label
+RECORD = np.dtype([('id', '<u8'), ('label', 'u1')])
+
+
+class Journal:
+    """Append-only binary log of label changes stored next to the input file.
+
+    Records are handed to the OS on every append, so an application crash
+    loses nothing, and are fsynced in batches of `sync_every` records or
+    every `sync_interval` seconds. The interval is checked on append and by
+    `sync_due`, which the viewer calls from a timer, so records are also
+    synced when no more labels change. After labels were saved to the HDF5
+    file the journal is truncated.
+    """
+
+    def __init__(self, path, sync_every=256, sync_interval=2.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+            # drop a record torn by a crash, so appends stay aligned
+            size = self.file.tell()
+            if size % RECORD.itemsize:
+                self.file.truncate(size - size % RECORD.itemsize)
+
+    def append(self, ids, label):
+        "Log that all `ids` were set to `label`."
+        self.open()
+        ids = np.atleast_1d(ids)
+        records = np.empty(len(ids), dtype=RECORD)
+        records['id'] = ids
+        records['label'] = label
+        self.file.write(records.tobytes())
+        self.file.flush()
+        self.unsynced += len(records)
+        if self.unsynced >= self.sync_every \
+                or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync_due(self):
+        "Fsync the records once `sync_interval` passed since the last sync."
+        if self.unsynced and \
+                time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def read(self):
+        "Return all complete records, ignoring a torn record at the end."
+        if not os.path.exists(self.path):
+            return(np.empty(0, dtype=RECORD))
+        n = os.path.getsize(self.path) // RECORD.itemsize
+        return(np.fromfile(self.path, dtype=RECORD, count=n))
+
+    def replay(self, labels):
+        """Apply the logged changes to `labels` in place.
+
+        Returns the ids of the events whose label was set by the journal.
+        """
+        records = self.read()
+        records = records[records['id'] < len(labels)]
+        if len(records) == 0:
+            return(np.empty(0, dtype='int64'))
+        # the last record of an event wins
+        ids, first = np.unique(records['id'][::-1], return_index=True)
+        ids = ids.astype('int64')
+        labels[ids] = records['label'][::-1][first]
+        return(ids)
+
+    def truncate(self):
+        "Drop all records once their labels are stored in the HDF5 file."
+        self.close()
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, 'wb') as file:
+                os.fsync(file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+        self.file = None
+
+
+class SessionJournal:
+    """The journals of all files of a `Session`, used with session-wide ids.
+
+    Each file keeps its own journal with file-local ids, so journals stay
+    valid when files are added to or removed from a session.
+    """
+
+    def __init__(self, session, **kwargs):
+        self.session = session
+        self.journals = [Journal(f"{path}.journal", **kwargs)
+                         for path in session.paths]
+
+    def append(self, ids, label):
+        for i, local in self.session.split(np.atleast_1d(ids)):
+            self.journals[i].append(local, label)
+
+    def replay(self, labels):
+        "Apply all journals to `labels`, returning the session-wide ids set."
+        ids = [np.empty(0, dtype='int64')]
+        offsets = self.session.offsets
+        for i, journal in enumerate(self.journals):
+            local = journal.replay(labels[offsets[i]:offsets[i + 1]])
+            ids.append(local + offsets[i])
+        return(np.concatenate(ids))
+
+    def sync_due(self):
+        for journal in self.journals:
+            journal.sync_due()
+
+    def truncate(self):
+        for journal in self.journals:
+            journal.truncate()
+
+    def close(self):
+        for journal in self.journals:
+            journal.close()
@@ -0,0 +1,141 @@
+import numpy as np
+
+
+class LabelStore:
+    """Labels kept in a chunked, resizable uint8 dataset of the input file.
+
+    Only the chunks holding labels that changed since the last save are
+    written, so saving costs O(changes) instead of rewriting every event.
+    """
+
+    def __init__(self, path, key, n_events, chunk=65536):
+        self.path = path
+        self.key = key
+        self.n_events = n_events
+        self.chunk = chunk
+
+    def load(self, initial=None):
+        """Read the labels without changing the file.
+
+        Files without the dataset start with `initial`, e.g. the `label`
+        column of files annotated before labels had their own dataset, or
+        with zeros. The dataset is only created by the first `save`, so
+        read-only files can be viewed.
+        """
+        import h5py
+
+        labels = np.zeros(self.n_events, dtype='uint8')
+        with h5py.File(self.path, 'r') as file:
+            if self.key not in file:
+                if initial is not None:
+                    labels[:] = initial
+                return(labels)
+            dataset = file[self.key]
+            self.chunk = dataset.chunks[0] if dataset.chunks else self.chunk
+            n = min(dataset.shape[0], self.n_events)
+            labels[:n] = dataset[:n]
+        return(labels)
+
+    def save(self, labels, changed, names=None):
+        """Write the chunks of `labels` holding the `changed` event ids.
+
+        The dataset is created with all labels when it does not exist yet.
+        `names` updates the label keymap stored under `labels` when given.
+        Returns the number of chunks written.
+        """
+        import h5py
+
+        chunks = np.unique(np.asarray(changed, dtype='int64') // self.chunk)
+        with h5py.File(self.path, 'r+') as file:
+            if self.key not in file:
+                file.create_dataset(
+                    self.key, data=labels, maxshape=(None,),
+                    chunks=(min(self.chunk, max(1, self.n_events)),))
+                chunks = np.arange(-(-self.n_events // self.chunk))
+            else:
+                dataset = file[self.key]
+                if dataset.shape[0] != self.n_events:
+                    dataset.resize((self.n_events,))
+                for c in chunks:
+                    start = c * self.chunk
+                    stop = min(start + self.chunk, self.n_events)
+                    dataset[start:stop] = labels[start:stop]
+            if names is not None:
+                names = np.array(names, dtype=h5py.string_dtype())
+                if 'labels' not in file \
+                        or list(file['labels'].asstr()[:]) != list(names):
+                    if 'labels' in file:
+                        del file['labels']
+                    file.create_dataset('labels', data=names)
+        return(len(chunks))
+
+
+class LabelModel:
+    """Labels of all events with dirty tracking and running class counts.
+
+    Tiles write through `set`, which keeps `counts` up to date and marks
+    the event in the boolean array `dirty`, so page turns need no scan of
+    the labels and saves find the changes with one vectorized scan.
+    Changes are also appended to `journal` when given.
+    When `groups` is set, it maps ids to all events of their duplicate
+    groups, which then get the same label.
+    """
+
+    def __init__(self, labels, n_classes, journal=None):
+        self.labels = labels
+        self.n_events = len(labels)
+        self.counts = np.bincount(labels, minlength=n_classes)
+        self.dirty = np.zeros(self.n_events, dtype=bool)
+        self.journal = journal
+        self.groups = None
+
+    def __getitem__(self, id):
+        if id >= self.n_events:
+            return(0)
+        return(self.labels[id])
+
+    def set(self, id, label):
+        if id >= self.n_events:
+            return
+        if self.groups is not None:
+            self.set_many([id], label)
+            return
+        old = self.labels[id]
+        if old == label:
+            return
+        self.counts[old] -= 1
+        self.counts[label] += 1
+        self.labels[id] = label
+        self.dirty[id] = True
+        if self.journal is not None:
+            self.journal.append(id, label)
+
+    def set_many(self, ids, label):
+        """Set all `ids` to `label` with one vectorized write and one journal
+        append. Returns the number of events whose label changed."""
+        if self.groups is not None:
+            ids = self.groups(ids)
+        ids = np.unique(np.asarray(ids, dtype='int64'))
+        ids = ids[(ids >= 0) & (ids < self.n_events)]
+        old = self.labels[ids]
+        changed = old != label
+        ids, old = ids[changed], old[changed]
+        if len(ids) == 0:
+            return(0)
+        self.counts -= np.bincount(old, minlength=len(self.counts))
+        self.counts[label] += len(ids)
+        self.labels[ids] = label
+        self.dirty[ids] = True
+        if self.journal is not None:
+            self.journal.append(ids, label)
+        return(len(ids))
+
+    @property
+    def n_selected(self):
+        return(self.n_events - self.counts[0])
+
+    def take_dirty(self):
+        "Return the ids changed since the last call and reset them."
+        dirty = np.flatnonzero(self.dirty)
+        self.dirty[dirty] = False
+        return(dirty)
@@ -0,0 +1,236 @@
+import io
+import pickle
+import threading
+
+import numpy as np
+
+
+class NameUnpickler(pickle.Unpickler):
+    "Reads the pickled column name lists of PyTables, refusing any class."
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Unexpected object in names: {name}")
+
+
+def read_names(data):
+    return([str(name) for name in NameUnpickler(io.BytesIO(data)).load()])
+
+
+def attr(node, name):
+    value = node.attrs.get(name)
+    return(value.decode() if isinstance(value, bytes) else value)
+
+
+def frame_sources(group):
+    """Yield the columns of a pandas frame stored in an HDF5 group.
+
+    Each column is given as (name, (dataset, field, index)): the path of
+    the dataset holding it, the field of a compound dataset and the index
+    along the second axis, either None when not needed. Columns pickled as
+    Python objects, e.g. strings of the fixed format, are skipped.
+    """
+    pandas_type = attr(group, 'pandas_type')
+    if pandas_type == 'frame':
+        for b in range(int(group.attrs['nblocks'])):
+            values = group[f"block{b}_values"]
+            if values.ndim != 2 or values.dtype.kind not in 'biuf':
+                continue
+            for j, name in enumerate(group[f"block{b}_items"][:]):
+                name = name.decode() if isinstance(name, bytes) else str(name)
+                yield(name, (values.name, None, j))
+    elif pandas_type == 'frame_table':
+        table = group['table']
+        for field in table.dtype.names:
+            if field == 'index':
+                continue
+            names = table.attrs.get(f"{field}_kind")
+            names = [field] if names is None else read_names(names)
+            shaped = table.dtype[field].shape != ()
+            for j, name in enumerate(names):
+                yield(name, (table.name, field, j if shaped else None))
+    else:
+        raise ValueError(f"Unsupported data layout of {group.name}: "
+                         f"{pandas_type}")
+
+
+def frame_labels(file, data_key, rows=slice(None)):
+    """Rows of the `label` column of a data frame, where files annotated
+    before labels had their own dataset kept them. None without it."""
+    if data_key not in file:
+        return(None)
+    for name, source in frame_sources(file[data_key]):
+        if name == 'label':
+            return(read_source(file, source, rows).astype('uint8'))
+    return(None)
+
+
+def memmap_dataset(path, dataset):
+    "Memory map a contiguous, uncompressed dataset, None for other layouts."
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None \
+            or dataset.dtype.names is not None:
+        return(None)
+    return(np.memmap(path, dtype=dataset.dtype, mode='r', offset=offset,
+                     shape=dataset.shape))
+
+
+def read_source(file, source, rows=slice(None)):
+    "Read `rows` of a column given by a `frame_sources` source."
+    path, field, index = source
+    dataset = file[path]
+    if field is None:
+        return(dataset[rows] if index is None else dataset[rows, index])
+    values = dataset.fields(field)[rows]
+    return(values if index is None else values[:, index])
+
+
+class ColumnStore:
+    """Per-event data columns of a session, read from the files on demand.
+
+    Single columns of the pandas data frames are read with h5py, from the
+    blocks of the fixed format or the fields of the table format, next to
+    the 1D datasets of the `column_key` group, e.g. predictions of eval.py.
+    Contiguous datasets are memory mapped instead of read. Only columns
+    that are sorted, filtered or shown are touched, each column is kept
+    once read. Files lacking a column have NaN values.
+
+    The `label` column of the data frames only seeds the label dataset,
+    it is stale once labels are saved, so it is neither sorted, filtered
+    nor shown.
+    """
+
+    def __init__(self, paths, data_key, column_key, sizes):
+        import h5py
+
+        self.paths = list(paths)
+        self.sizes = np.asarray(sizes, dtype='int64')
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes)))
+        self.sources = {}
+        self.kinds = {}
+        self.cache = {}
+        self.lock = threading.Lock()
+        for i, path in enumerate(self.paths):
+            with h5py.File(path, 'r') as file:
+                if data_key not in file:
+                    raise KeyError(f"Data not found in input file {path}!")
+                sources = list(frame_sources(file[data_key]))
+                if column_key in file:
+                    sources += [(name, (dataset.name, None, None))
+                                for name, dataset in file[column_key].items()
+                                if dataset.ndim == 1]
+                for name, source in sources:
+                    self.sources.setdefault(
+                        name, [None] * len(self.paths))[i] = source
+                    dtype = file[source[0]].dtype
+                    if source[1] is not None:
+                        dtype = dtype[source[1]]
+                    self.kinds.setdefault(name, set()).add(dtype.base.kind)
+        self.columns = list(self.sources)
+
+    def __contains__(self, name):
+        return(name in self.sources)
+
+    def __len__(self):
+        return(len(self.columns))
+
+    @property
+    def numeric(self):
+        "Names of the columns holding numbers in all files."
+        return([name for name in self.columns
+                if name != 'label' and self.kinds[name] <= set('biuf')])
+
+    def read(self, name, i):
+        "Values of a column in file `i`, None when the file lacks it."
+        import h5py
+
+        source = self.sources[name][i]
+        if source is None:
+            return(None)
+        path, field, index = source
+        with h5py.File(self.paths[i], 'r') as file:
+            values = None
+            if field is None:
+                values = memmap_dataset(self.paths[i], file[path])
+            if values is not None:
+                return(values if index is None else values[:, index])
+            return(read_source(file, source))
+
+    def get(self, name):
+        "Values of a column for all events of the session."
+        with self.lock:
+            if name not in self.cache:
+                parts = [self.read(name, i) for i in range(len(self.paths))]
+                parts = [np.full(self.sizes[i], np.nan) if part is None
+                         else part for i, part in enumerate(parts)]
+                self.cache[name] = parts[0] if len(parts) == 1 \
+                    else np.concatenate(parts)
+            return(self.cache[name])
+
+    def where(self, name, low=None, high=None, chunk=1 << 20):
+        """Return the ids and values of the events with low <= value <= high.
+
+        Uncached columns are scanned `chunk` events at a time, so only the
+        matching values are held in memory.
+        """
+        import h5py
+
+        ids, values = [], []
+        for i, source in enumerate(self.sources[name]):
+            if source is None:
+                continue
+            with h5py.File(self.paths[i], 'r') as file:
+                for start in range(0, self.sizes[i], chunk):
+                    stop = min(start + chunk, self.sizes[i])
+                    if name in self.cache:
+                        block = self.cache[name][self.offsets[i] + start:
+                                                 self.offsets[i] + stop]
+                    else:
+                        block = read_source(file, source, slice(start, stop))
+                    mask = np.ones(len(block), dtype=bool)
+                    if low is not None:
+                        mask &= block >= low
+                    if high is not None:
+                        mask &= block <= high
+                    ids.append(np.flatnonzero(mask) + self.offsets[i] + start)
+                    values.append(block[mask])
+        if not ids:
+            return(np.empty(0, 'int64'), np.empty(0))
+        return(np.concatenate(ids), np.concatenate(values))
+
+    def row(self, id):
+        "Values of all columns for event `id`, reading one row per dataset."
+        import h5py
+
+        i = int(np.searchsorted(self.offsets, id, side='right') - 1)
+        local = id - int(self.offsets[i])
+        values = {}
+        rows = {}
+        with h5py.File(self.paths[i], 'r') as file:
+            for name in self.columns:
+                source = self.sources[name][i]
+                if source is None or name == 'label':
+                    continue
+                path, field, index = source
+                if path not in rows:
+                    rows[path] = file[path][local]
+                value = rows[path]
+                if field is not None:
+                    value = value[field]
+                if index is not None:
+                    value = value[index]
+                if isinstance(value, bytes):
+                    value = value.decode(errors='replace')
+                values[name] = value.item() if hasattr(value, 'item') \
+                    else value
+        return(values)
+
+    def frame(self, data_key, i):
+        "The full data frame of file `i` with the extra columns added."
+        import pandas as pd
+
+        frame = pd.read_hdf(self.paths[i], data_key)
+        for name in self.columns:
+            if name not in frame.columns:
+                values = self.read(name, i)
+                frame[name] = np.nan if values is None else np.asarray(values)
+        return(frame)
@@ -0,0 +1,106 @@
+from collections import Counter
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+
+class Metrics:
+    """Timing spans, counters and gauges of the hot paths.
+
+    Every finished span is also written as one JSON line to the file given
+    to `open`, so slow sessions can be analysed afterwards. The lines are
+    kept in memory and written in batches of `flush_lines`, or once the
+    oldest waited `flush_seconds`.
+    """
+
+    flush_lines = 4096
+    flush_seconds = 10.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.counters = Counter()
+        self.gauges = {}
+        self.file = None
+        self.pending = []
+        self.flushed = time.monotonic()
+
+    def open(self, path):
+        self.close()
+        self.file = open(path, 'a')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.flush()
+                self.file.close()
+            self.file = None
+
+    def write(self, record):
+        "Queue one JSON line, the lock must be held."
+        if not self.pending:
+            self.flushed = time.monotonic()
+        self.pending.append(json.dumps(record) + '\n')
+        if len(self.pending) >= self.flush_lines or \
+                time.monotonic() - self.flushed >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        "Write the queued lines, the lock must be held."
+        self.file.writelines(self.pending)
+        self.file.flush()
+        self.pending = []
+
+    @contextmanager
+    def span(self, name, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, **fields)
+
+    def record(self, name, seconds, **fields):
+        with self.lock:
+            count, total, worst, _ = self.spans.get(name, (0, 0.0, 0.0, 0.0))
+            self.spans[name] = (
+                count + 1, total + seconds, max(worst, seconds), seconds)
+            if self.file is not None:
+                self.write(dict(
+                    time=round(time.time(), 3), span=name,
+                    ms=round(seconds * 1000, 3), **fields))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def write_counters(self):
+        "Append the current counters and gauges as one JSON line."
+        with self.lock:
+            if self.file is not None:
+                self.write(dict(
+                    time=round(time.time(), 3), counters=dict(self.counters),
+                    gauges=self.gauges))
+                self.flush()
+
+    def summary(self):
+        "Return human readable lines, e.g. for an on-screen overlay."
+        with self.lock:
+            lines = [f"{name}: last {last * 1000:.1f} ms, "
+                     f"mean {total / count * 1000:.1f} ms, "
+                     f"max {worst * 1000:.1f} ms (n={count})"
+                     for name, (count, total, worst, last)
+                     in sorted(self.spans.items())]
+            lines += [f"{name}: {value}"
+                      for name, value in sorted(self.counters.items())]
+            lines += [f"{name}: {value}"
+                      for name, value in sorted(self.gauges.items())]
+        return(lines)
+
+
+# Shared by all modules, like the module level loggers
+metrics = Metrics()
@@ -0,0 +1,47 @@
+import numpy as np
+
+
+class EventIndex:
+    """Sorting and filtering of events by numeric data columns.
+
+    `get_column(name)` returns the values of a column for all events. The
+    argsort of a column is computed once and reused for both directions
+    and for every filter on it. Filters on columns not sorted yet are
+    pushed down to `where(name, low, high)` when given, which returns the
+    ids and values of the matching events, and only those are sorted.
+    """
+
+    def __init__(self, get_column, where=None):
+        self.get_column = get_column
+        self.where = where
+        self.argsorts = {}
+
+    def argsort(self, column):
+        if column not in self.argsorts:
+            self.argsorts[column] = np.argsort(
+                self.get_column(column), kind='stable').astype('int64')
+        return(self.argsorts[column])
+
+    def order(self, column, descending=False, low=None, high=None):
+        "Return the event ids sorted by `column` within [low, high]."
+        filtered = low is not None or high is not None
+        if filtered and self.where is not None \
+                and column not in self.argsorts:
+            ids, values = self.where(column, low, high)
+            order = ids[np.argsort(values, kind='stable')]
+            return(order[::-1] if descending else order)
+        order = self.argsort(column)
+        if filtered:
+            values = self.get_column(column)
+            mask = np.ones(len(values), dtype=bool)
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+            order = order[mask[order]]
+        if descending:
+            order = order[::-1]
+        return(order)
+
+    def clear(self):
+        self.argsorts.clear()
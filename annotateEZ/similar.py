@@ -0,0 +1,164 @@
+import numpy as np
+
+from annotateEZ.metadata import memmap_dataset
+
+
+def normalize(vectors):
+    "Scale rows to unit length, so inner products are cosine similarities."
+    vectors = np.asarray(vectors, dtype='float32')
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return(vectors / np.maximum(norms, 1e-12))
+
+
+def assign(vectors, centroids, chunk=65536):
+    "Index of the most similar centroid of each row, `chunk` rows at a time."
+    lists = np.empty(len(vectors), dtype='int32')
+    for start in range(0, len(vectors), chunk):
+        block = normalize(vectors[start:start + chunk])
+        lists[start:start + len(block)] = (block @ centroids.T).argmax(axis=1)
+    return(lists)
+
+
+def kmeans(sample, n_lists, iterations=10, seed=0):
+    """Spherical k-means of the unit rows of `sample`.
+
+    Returns `n_lists` unit centroids. Empty clusters are restarted at
+    random sample rows.
+    """
+    rng = np.random.default_rng(seed)
+    sample = normalize(sample)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(iterations):
+        lists = assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, sample)
+        empty = np.bincount(lists, minlength=n_lists) == 0
+        sums[empty] = sample[rng.choice(len(sample), empty.sum())]
+        centroids = normalize(sums)
+    return(centroids)
+
+
+def write_index(path, key, embeddings, n_lists=None, chunk=65536):
+    """Store per-event embeddings with an inverted file (IVF) index.
+
+    The events are clustered by k-means on a sample, about sqrt(n) lists,
+    and the embeddings are written as float16 unit vectors grouped by
+    list into the `key` group of the file:
+
+    - `centroids` of the lists,
+    - `offsets` of each list in `vectors` and `ids`,
+    - `vectors` and event `ids` in list order,
+    - `position` of each event in `vectors`.
+
+    `embeddings` may be a memory map, it is read `chunk` rows at a time.
+    """
+    import h5py
+
+    n = len(embeddings)
+    if n_lists is None:
+        n_lists = int(np.clip(np.sqrt(n), 1, 65536))
+    n_lists = max(1, min(n_lists, n))
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(n, min(n, 64 * n_lists), replace=False))
+    centroids = kmeans(embeddings[sample], n_lists)
+    lists = assign(embeddings, centroids, chunk)
+    ids = np.argsort(lists, kind='stable')
+    position = np.empty(n, dtype='int64')
+    position[ids] = np.arange(n)
+    offsets = np.concatenate(
+        ([0], np.cumsum(np.bincount(lists, minlength=n_lists))))
+    with h5py.File(path, 'r+') as file:
+        if key in file:
+            del file[key]
+        group = file.create_group(key)
+        group.create_dataset('centroids', data=centroids)
+        group.create_dataset('offsets', data=offsets)
+        group.create_dataset('ids', data=ids)
+        group.create_dataset('position', data=position)
+        # contiguous, so the viewer can memory map it
+        vectors = group.create_dataset(
+            'vectors', shape=(n, centroids.shape[1]), dtype='float16')
+        for start in range(0, n, chunk):
+            rows = ids[start:start + chunk]
+            # read in file order, write in list order
+            read = np.sort(rows)
+            block = normalize(embeddings[read])
+            vectors[start:start + len(rows)] = \
+                block[np.searchsorted(read, rows)].astype('float16')
+    return(n_lists)
+
+
+class SimilarIndex:
+    """Approximate nearest neighbours of events by their embeddings.
+
+    Loads the indexes written by `write_index` from the files of a
+    session; files without one are skipped. A search scores the query
+    against the centroids of each file and only reads the vectors of the
+    `probes` most similar lists, memory mapped.
+    """
+
+    def __init__(self, paths, key, sizes):
+        import h5py
+
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)))
+        self.files = []
+        for path in paths:
+            index = None
+            with h5py.File(path, 'r') as file:
+                if key in file and 'vectors' in file[key]:
+                    index = {}
+                    for name, dataset in file[key].items():
+                        values = memmap_dataset(path, dataset)
+                        index[name] = dataset[:] if values is None \
+                            else values
+            self.files.append(index)
+        self.n_files = sum(index is not None for index in self.files)
+
+    def __bool__(self):
+        return(self.n_files > 0)
+
+    def vectors(self, ids):
+        "Embeddings of session-wide event `ids`, None when any is missing."
+        ids = np.asarray(ids, dtype='int64')
+        files = np.searchsorted(self.offsets, ids, side='right') - 1
+        out = None
+        for i in np.unique(files):
+            index = self.files[i]
+            if index is None:
+                return(None)
+            mask = files == i
+            rows = index['position'][ids[mask] - self.offsets[i]]
+            if out is None:
+                out = np.empty(
+                    (len(ids), index['vectors'].shape[1]), dtype='float32')
+            out[mask] = index['vectors'][rows]
+        return(out)
+
+    def search(self, id, k=1000, probes=16):
+        """Return event `id` and up to `k` - 1 event ids most similar to it,
+        the most similar first, or None when the event has no embedding."""
+        query = self.vectors([id])
+        if query is None:
+            return(None)
+        query = query[0]
+        ids, scores = [], []
+        for i, index in enumerate(self.files):
+            if index is None:
+                continue
+            similar = index['centroids'] @ query
+            lists = np.argsort(similar)[::-1][:probes]
+            for j in lists:
+                start, stop = index['offsets'][j], index['offsets'][j + 1]
+                if start == stop:
+                    continue
+                scores.append(index['vectors'][start:stop] @ query)
+                ids.append(index['ids'][start:stop] + self.offsets[i])
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        # the query comes first, ahead of ties of the float16 vectors
+        mask = ids != id
+        ids, scores = ids[mask], scores[mask]
+        if len(ids) > k - 1:
+            top = np.argpartition(scores, -(k - 1))[-(k - 1):]
+            ids, scores = ids[top], scores[top]
+        ids = ids[np.argsort(scores, kind='stable')[::-1]]
+        return(np.concatenate(([id], ids)).astype('int64'))
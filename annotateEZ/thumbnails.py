@@ -0,0 +1,199 @@
+import hashlib
+import os
+import threading
+from collections import Counter
+
+import numpy as np
+
+# Events hashed at the start, middle and end of each file
+SAMPLE_EVENTS = 64
+
+
+class ThumbnailFile:
+    """Converted images of one input file in a memory-mapped .npy file.
+
+    A second byte map `done` marks the events already converted, so the
+    file fills up while pages are viewed.
+    """
+
+    def __init__(self, path, shape):
+        self.path = path
+        mode = 'r+' if os.path.exists(path) else 'w+'
+        self.images = np.lib.format.open_memmap(
+            path, mode=mode, dtype='uint8', shape=shape)
+        # new images must never be marked done by an older byte map
+        if mode == 'r+' and not os.path.exists(done_path(path)):
+            mode = 'w+'
+        self.done = np.lib.format.open_memmap(
+            done_path(path), mode=mode, dtype='uint8', shape=shape[:1])
+        if self.images.shape != shape or self.done.shape != shape[:1]:
+            raise ValueError(f"Thumbnails do not match their file: {path}")
+        # the modification time orders entries for eviction
+        os.utime(path)
+
+    def flush(self):
+        self.images.flush()
+        self.done.flush()
+
+
+class SessionThumbnails:
+    """The thumbnail files of all files of a `Session` for one display
+    setting, used with session-wide ids.
+
+    A new instance is made when the display settings change, so pages
+    converted with older settings never end up in the new files.
+    """
+
+    def __init__(self, session, files):
+        self.session = session
+        self.files = files
+
+    def get(self, ids):
+        """Return the cached images of `ids`, or None unless all are cached.
+
+        Consecutive events of one file are returned as a view of the memory
+        map without a copy.
+        """
+        ids = np.asarray(ids, dtype='int64')
+        if len(ids) == 0:
+            return(None)
+        files, local = self.session.locate(ids)
+        if (files == files[0]).all() and (np.diff(local) == 1).all():
+            thumbnails = self.files[files[0]]
+            start, stop = local[0], local[-1] + 1
+            if thumbnails is None or not thumbnails.done[start:stop].all():
+                return(None)
+            return(thumbnails.images[start:stop])
+        out = np.empty(
+            (len(ids), self.session.im_h, self.session.im_w, 3),
+            dtype='uint8')
+        for i in np.unique(files):
+            mask = files == i
+            thumbnails = self.files[i]
+            if thumbnails is None or not thumbnails.done[local[mask]].all():
+                return(None)
+            out[mask] = thumbnails.images[local[mask]]
+        return(out)
+
+    def put(self, ids, rgb):
+        "Store the converted images `rgb` of `ids`."
+        files, local = self.session.locate(np.asarray(ids, dtype='int64'))
+        for i in np.unique(files):
+            mask = files == i
+            thumbnails = self.files[i]
+            thumbnails.images[local[mask]] = rgb[mask]
+            thumbnails.done[local[mask]] = 1
+
+    def flush(self):
+        for thumbnails in self.files:
+            if thumbnails is not None:
+                thumbnails.flush()
+
+
+class ThumbnailCache:
+    """Converted RGB images kept in a cache directory across sessions.
+
+    Each pair of image dataset and display settings has its own thumbnail
+    file. Files are named by a hash of the dataset shape, dtype and sampled
+    content and of the display settings, so replaced images or changed
+    settings never show stale thumbnails. Label saves rewrite the input
+    files, so their size and modification time are not part of the name.
+
+    When a session is opened, the least recently used thumbnail files are
+    deleted until the directory holds at most `max_bytes` on disk. Files
+    of sessions not yet released are kept.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.identities = {}
+        # open sessions per file, two settings may map to the same file
+        self.in_use = Counter()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def identity(self, session, i):
+        "Hash identifying the images of file `i` of a session."
+        path = session.paths[i]
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.identities:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(repr((session.shape[1:], str(session.dtype),
+                                int(session.sizes[i]))).encode())
+            start, n = int(session.offsets[i]), int(session.sizes[i])
+            for first in sorted({0, max(0, n // 2 - SAMPLE_EVENTS // 2),
+                                 max(0, n - SAMPLE_EVENTS)}):
+                stop = min(first + SAMPLE_EVENTS, n)
+                digest.update(session.read(start + first, start + stop))
+            self.identities[key] = digest.hexdigest()
+        return(self.identities[key])
+
+    def session(self, session, settings):
+        "Open the thumbnails of all files of `session` for `settings`."
+        settings_id = hashlib.blake2b(
+            repr(settings).encode(), digest_size=8).hexdigest()
+        files = []
+        with self.lock:
+            for i in range(len(session.paths)):
+                if session.sizes[i] == 0:
+                    files.append(None)
+                    continue
+                path = os.path.join(
+                    self.directory,
+                    f"{self.identity(session, i)}-{settings_id}.npy")
+                shape = (int(session.sizes[i]), session.im_h, session.im_w, 3)
+                files.append(ThumbnailFile(path, shape))
+                self.in_use[path] += 1
+            self.evict()
+        return(SessionThumbnails(session, files))
+
+    def release(self, thumbnails):
+        "Flush the files of a session no longer used, so they can be evicted."
+        thumbnails.flush()
+        with self.lock:
+            for thumbnail_file in thumbnails.files:
+                if thumbnail_file is None:
+                    continue
+                self.in_use[thumbnail_file.path] -= 1
+                if self.in_use[thumbnail_file.path] <= 0:
+                    del self.in_use[thumbnail_file.path]
+
+    def evict(self):
+        "Delete the least recently used thumbnail files over the size cap."
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.npy') or name.endswith('.done.npy'):
+                continue
+            size = disk_usage(path)
+            if os.path.exists(done_path(path)):
+                size += disk_usage(done_path(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path in self.in_use:
+                continue
+            try:
+                for p in (path, done_path(path)):
+                    if os.path.exists(p):
+                        os.remove(p)
+            except OSError:
+                # still mapped by a page being converted, e.g. on Windows
+                continue
+            total -= size
+
+
+def done_path(path):
+    return(path[:-len('.npy')] + '.done.npy')
+
+
+def disk_usage(path):
+    "Bytes a file occupies on disk, less than its size when it is sparse."
+    stat = os.stat(path)
+    if hasattr(stat, 'st_blocks'):
+        return(min(stat.st_size, stat.st_blocks * 512))
+    return(stat.st_size)
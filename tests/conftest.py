@@ -0,0 +1,283 @@
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+RESULTS = []
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmarks')
+    group.addoption(
+        '--bench-scales', default='10000',
+        help="comma separated event counts of the synthetic files, "
+             "e.g. 10000,100000,1000000,5000000")
+    group.addoption(
+        '--bench-image-size', type=int, default=16,
+        help="height and width of the synthetic images")
+    group.addoption(
+        '--bench-json', default=None, metavar='PATH',
+        help="write the benchmark results to PATH as JSON")
+    group.addoption(
+        '--bench-baseline', default=None, metavar='PATH',
+        help="compare the results with a JSON file written by --bench-json "
+             "and fail when a case is slower by more than --bench-tolerance")
+    group.addoption(
+        '--bench-tolerance', type=float, default=0.25,
+        help="allowed relative slowdown against the baseline")
+
+
+def pytest_generate_tests(metafunc):
+    if 'scale' in metafunc.fixturenames:
+        scales = [int(s) for s in
+                  metafunc.config.getoption('--bench-scales').split(',')]
+        metafunc.parametrize('scale', scales, scope='session')
+
+
+def compare_baseline(config):
+    "Return the cases slower than the baseline by more than the tolerance."
+    path = config.getoption('--bench-baseline')
+    if path is None:
+        return([])
+    with open(path) as file:
+        baseline = {r['name']: r for r in json.load(file)}
+    tolerance = config.getoption('--bench-tolerance')
+    slower = []
+    for result in RESULTS:
+        base = baseline.get(result['name'])
+        if base is not None and \
+                result['seconds'] > base['seconds'] * (1 + tolerance):
+            slower.append((result['name'], base['seconds'], result['seconds']))
+    return(slower)
+
+
+def pytest_sessionfinish(session):
+    if not RESULTS:
+        return
+    path = session.config.getoption('--bench-json')
+    if path is not None:
+        with open(path, 'w') as file:
+            json.dump(RESULTS, file, indent=1)
+    session.config.bench_slower = compare_baseline(session.config)
+    if session.config.bench_slower:
+        session.exitstatus = pytest.ExitCode.TESTS_FAILED
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not RESULTS:
+        return
+    terminalreporter.section('benchmarks')
+    terminalreporter.write_line(
+        f"{'name':<40}{'events':>10}{'seconds':>10}{'events/s':>14}"
+        f"{'RSS MB':>10}{'+peak MB':>10}")
+    for r in RESULTS:
+        terminalreporter.write_line(
+            f"{r['name']:<40}{r['events']:>10}{r['seconds']:>10.4f}"
+            f"{r['events'] / r['seconds']:>14.0f}{r['rss_mb']:>10.1f}"
+            f"{r['peak_mb']:>10.1f}")
+    for name, before, after in getattr(config, 'bench_slower', []):
+        terminalreporter.write_line(
+            f"slower than baseline: {name} {before:.4f}s -> {after:.4f}s",
+            red=True)
+
+
+def rss_mb():
+    "Current resident set size of the process, from /proc on Linux."
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+    except OSError:
+        return(float('nan'))
+    return(pages * os.sysconf('SC_PAGE_SIZE') / 2**20)
+
+
+class RSSSampler(threading.Thread):
+    """Sample the resident set size every `interval` seconds until stopped,
+    so the peak of a single call can be told apart from earlier cases."""
+
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss_mb()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, rss_mb())
+        return(self.peak)
+
+
+@pytest.fixture
+def bench(request):
+    """Time a callable and record its throughput for the summary.
+
+    `bench(func, events, rounds=3)` returns the result of the last call and
+    records the fastest of `rounds` calls, the RSS before the first call
+    and how far the calls raised it at their peak.
+    """
+    def run(func, events, rounds=3):
+        best = float('inf')
+        result = None
+        before = rss_mb()
+        sampler = RSSSampler()
+        sampler.start()
+        try:
+            for _ in range(rounds):
+                # drop the previous result so rounds do not add up
+                result = None
+                start = time.perf_counter()
+                result = func()
+                best = min(best, time.perf_counter() - start)
+        finally:
+            peak = sampler.stop()
+        RESULTS.append({
+            'name': request.node.name, 'events': events, 'seconds': best,
+            'rss_mb': before, 'peak_mb': peak - before})
+        return result
+    return run
+
+
+@pytest.fixture(scope='session')
+def synthetic_file(tmp_path_factory, scale, request):
+    "An input file in the image_key/data_key layout with `scale` events."
+    size = request.config.getoption('--bench-image-size')
+    path = tmp_path_factory.mktemp('data') / f"events_{scale}.hdf5"
+    rng = np.random.default_rng(0)
+    block = 65536
+    with h5py.File(path, 'w') as file:
+        images = file.create_dataset(
+            'images', shape=(scale, size, size, 4), dtype='uint16',
+            chunks=(min(scale, 256), size, size, 4))
+        for start in range(0, scale, block):
+            stop = min(start + block, scale)
+            images[start:stop] = rng.integers(
+                0, 65536, (stop - start, size, size, 4), dtype='uint16')
+    pd.DataFrame({
+        'area': rng.random(scale, dtype='float32'),
+        'score': rng.random(scale, dtype='float32'),
+    }).to_hdf(path, key='features', mode='a')
+    return path
+
+
+@pytest.fixture
+def make_file(tmp_path):
+    """Write small input files into `tmp_path`.
+
+    `make_file(name, n)` returns the path of a file with `n` blank events,
+    or with `images` instead. `labels` fill the label dataset and
+    `frame_labels` the `label` column of the data frame, as files annotated
+    before labels had their own dataset. The frame is only written with
+    `frame=True` or frame labels, in the pandas `format`.
+    """
+    def make(name, n=None, images=None, labels=None, frame=False,
+             frame_labels=None, format='fixed'):
+        path = str(tmp_path / name)
+        if images is None:
+            images = np.zeros((n, 2, 2, 4), dtype='uint16')
+        n = len(images)
+        with h5py.File(path, 'w') as file:
+            file.create_dataset('images', data=images)
+            if labels is not None:
+                file.create_dataset(
+                    'annotations', data=np.asarray(labels, 'u1'),
+                    maxshape=(None,), chunks=(4,))
+        if frame or frame_labels is not None:
+            columns = {'area': np.arange(n, dtype='float32')}
+            if frame_labels is not None:
+                columns['label'] = np.asarray(frame_labels, dtype='int64')
+            pd.DataFrame(columns).to_hdf(
+                path, key='features', mode='a', format=format)
+        return path
+    return make
+
+
+def window_config():
+    """Settings of the windows under test, independent of config.yml, with
+    the metrics file and the thumbnail cache off."""
+    channels = [
+        {'name': name, 'color': color, 'active': True, 'gamma': 1.0,
+         'min': 0, 'max': 65535}
+        for name, color in [('DAPI', 'blue'), ('TRITC', 'red'),
+                            ('CY5', 'green'), ('FITC', 'white')]]
+    labels = [{'name': name, 'color': color, 'active': True}
+              for name, color in [('D', 'black'), ('CK', 'red'),
+                                  ('CD', 'yellow'), ('V', 'green')]]
+    return {
+        'active_label': 1, 'active_queue': 2000, 'active_refresh': 500,
+        'cache_pages': 8, 'channels': channels, 'column_key': 'columns',
+        'data_key': 'features', 'display_mode': 'rgb',
+        'duplicate_key': 'duplicates', 'embedding_key': 'embeddings',
+        'image_key': 'images', 'label_key': 'annotations', 'labels': labels,
+        'mask_key': 'masks', 'max_open_files': 16, 'metrics_file': '',
+        'output_dir': '', 'pixmap_cache_mb': 256, 'prefetch_pages': 2,
+        'show_metrics': False, 'similar_events': 1000, 'similar_probes': 16,
+        'thumbnail_cache_dir': '', 'thumbnail_cache_mb': 4096,
+        'tile_size': 85, 'x_size': 15, 'y_size': 15,
+    }
+
+
+@pytest.fixture(scope='session')
+def qapp():
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    yield app
+
+
+@pytest.fixture
+def make_window(qapp, synthetic_file, monkeypatch):
+    """Create MainWindows with all dialogs bypassed, closed at teardown.
+
+    `make_window(paths)` loads `paths` in the background like the command
+    line does; without them nothing is loaded and the open dialog returns
+    `synthetic_file`.
+    """
+    from PyQt5.QtWidgets import QFileDialog
+    from annotateEZ import annotateEZ as app
+
+    monkeypatch.setattr(
+        QFileDialog, 'getOpenFileNames',
+        lambda *args, **kwargs: ([str(synthetic_file)], ''))
+    monkeypatch.setattr(app, 'save_config', lambda: None)
+    monkeypatch.setattr(app, 'config', window_config(), raising=False)
+    windows = []
+
+    def make(paths=None):
+        windows.append(app.MainWindow(paths=paths))
+        return windows[-1]
+    yield make
+    for w in windows:
+        if w.loader is not None:
+            w.loader.wait()
+        qapp.processEvents()
+        if w.prefetcher is not None:
+            w.prefetcher.shutdown()
+        if w.store is not None:
+            w.store.close()
+        if w.journal is not None:
+            w.journal.truncate()
+            for journal in w.journal.journals:
+                if os.path.exists(journal.path):
+                    os.remove(journal.path)
+
+
+@pytest.fixture
+def window(make_window):
+    "A MainWindow with `synthetic_file` loaded."
+    w = make_window()
+    w.load_data(block=True)
+    return w
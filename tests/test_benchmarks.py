@@ -0,0 +1,193 @@
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+
+from annotateEZ import cli
+from annotateEZ.convert import (
+    DisplayTransform, channels2rgb8bit, convert_parallel)
+from annotateEZ.duplicates import read_groups
+from annotateEZ.similar import SimilarIndex, write_index
+from annotateEZ.thumbnails import ThumbnailCache
+
+# Largest block of events converted at once in the conversion benchmarks
+BLOCK = 65536
+
+
+def read_block(path, scale):
+    with h5py.File(path, 'r') as file:
+        return file['images'][:min(scale, BLOCK)]
+
+
+def test_load_data(window, bench, scale):
+    bench(lambda: window.load_data(block=True), scale)
+    assert window.n_events == scale
+
+
+def test_first_page(make_window, synthetic_file, qapp, bench, scale):
+    "Time to first interaction: from start to the first page on screen."
+    def start():
+        w = make_window(paths=[str(synthetic_file)])
+        while not w.canvas.ids:
+            qapp.processEvents()
+        return w
+    w = bench(start, scale)
+    assert w.isVisible()
+
+
+def test_import_is_light():
+    "Importing the GUI must not load pandas, h5py or yaml."
+    code = ("import sys, annotateEZ.annotateEZ; "
+            "print(' '.join(m for m in ('pandas', 'h5py', 'yaml') "
+            "if m in sys.modules))")
+    result = subprocess.run(
+        [sys.executable, '-c', code], capture_output=True, text=True,
+        check=True, cwd=Path(__file__).resolve().parents[1])
+    assert result.stdout.strip() == ''
+
+
+def test_channels2rgb8bit(synthetic_file, bench, scale):
+    images = read_block(synthetic_file, scale)
+    rgb = bench(lambda: channels2rgb8bit(images), len(images))
+    assert rgb.shape == images.shape[:3] + (3,)
+
+
+def test_convert_parallel(synthetic_file, bench, scale):
+    with h5py.File(synthetic_file, 'r') as file:
+        images = file['images']
+        rgb = bench(lambda: convert_parallel(images, chunk=4096), scale)
+        assert (rgb[:BLOCK] == channels2rgb8bit(images[:BLOCK])).all()
+
+
+def test_display_transform(synthetic_file, bench, scale):
+    images = read_block(synthetic_file, scale)
+    transform = DisplayTransform([{'name': str(c)} for c in range(4)])
+    rgb = bench(lambda: transform(images), len(images))
+    assert rgb.shape == images.shape[:3] + (3,)
+
+
+def test_rechunk(synthetic_file, tmp_path, bench, scale):
+    bench(lambda: cli.main(['rechunk', str(synthetic_file), '--output-dir',
+                            str(tmp_path), '--page-size', '225']), scale)
+    with h5py.File(synthetic_file, 'r') as a, \
+            h5py.File(tmp_path / synthetic_file.name, 'r') as b:
+        assert b['images'].chunks[0] == min(scale, 225)
+        assert (b['images'][:BLOCK] == a['images'][:BLOCK]).all()
+        assert set(b) == set(a)
+
+
+def test_dedup(synthetic_file, tmp_path, bench, scale):
+    "Hash and group a file where every tenth event repeats the one before."
+    path = tmp_path / synthetic_file.name
+    shutil.copy(synthetic_file, path)
+    with h5py.File(path, 'r+') as file:
+        images = file['images']
+        for start in range(0, scale, 40960):
+            block = images[start:start + 40960]
+            block[1::10] = block[0::10][:len(block[1::10])]
+            images[start:start + 40960] = block
+    bench(lambda: cli.main(['dedup', str(path)]), scale)
+    groups = read_groups([path], 'duplicates', [scale])
+    copies = np.arange(1, scale, 10)
+    assert (groups.representative[copies] == copies - 1).all()
+    assert groups.n_groups <= scale - len(copies)
+    assert set(groups.members([copies[0]])) >= {0, 1}
+
+
+def test_similar_search(tmp_path, bench, scale):
+    "Nearest neighbours of clustered embeddings, checked against all."
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(64, 32))
+    embeddings = centers[rng.integers(0, 64, scale)] \
+        + rng.normal(scale=0.3, size=(scale, 32))
+    path = tmp_path / 'embeddings.hdf5'
+    h5py.File(path, 'w').close()
+    write_index(path, 'embeddings', embeddings)
+    index = SimilarIndex([path], 'embeddings', [scale])
+    ids = bench(lambda: index.search(7, k=100), 1)
+    vectors = index.vectors(np.arange(scale))
+    exact = np.argsort(vectors @ vectors[7])[::-1][:100]
+    assert ids[0] == 7
+    assert len(np.intersect1d(ids, exact)) >= 90
+
+
+def test_reset_map(window, bench, scale):
+    def build():
+        window.pixmaps.clear()
+        window.prefetcher.clear()
+        window.reset_map()
+    bench(build, len(window.canvas.ids))
+
+
+def test_reset_map_thumbnails(window, tmp_path, bench, scale):
+    cache = ThumbnailCache(str(tmp_path), 1 << 40)
+    thumbnails = cache.session(window.store, window.transform.settings)
+    window.prefetcher.set_convert(window.transform, thumbnails)
+    window.reset_map()
+
+    def build():
+        window.pixmaps.clear()
+        window.prefetcher.clear()
+        window.reset_map()
+    bench(build, len(window.canvas.ids))
+
+
+def test_reset_map_cached(window, bench, scale):
+    window.reset_map()
+    bench(window.reset_map, len(window.canvas.ids))
+
+
+def test_page_turn(window, bench, scale):
+    turns = min(window.n_pages - 1, 20)
+
+    def turn():
+        window.current_page = 1
+        for _ in range(turns):
+            window.nextPage()
+    bench(turn, turns * len(window.canvas.ids), rounds=1)
+
+
+def test_save_labels(window, bench, scale):
+    window.selectAll()
+    bench(window.save_labels, len(window.canvas.ids))
+
+
+def test_label_pages(window, bench, scale, monkeypatch):
+    from PyQt5.QtWidgets import QMessageBox
+    monkeypatch.setattr(
+        QMessageBox, 'question', lambda *args: QMessageBox.Yes)
+
+    def label():
+        window.label_pages(1)
+        window.label_pages(0)
+    bench(label, 2 * scale)
+    assert window.model.n_selected == 0
+
+
+def test_active_refresh(window, qapp, bench, scale):
+    "Retrain the active learner on reviewed pages and rank all events."
+    learner = window.learner
+    ids = np.arange(min(scale, 2000))
+    window.model.set_many(ids[window.columns.get('area')[ids] > 0.8], 1)
+    learner.review(ids)
+    snapshot = learner.snapshot(window.model.labels)
+    queue = bench(lambda: learner.update(*snapshot), scale)
+    assert len(queue) == min(learner.queue_size, scale - len(ids))
+    assert not learner.reviewed[queue].any()
+    window.apply_order(window.order_bar.UNCERTAIN, False, None, None)
+    window.ranker.wait()
+    qapp.processEvents()
+    assert window.canvas.ids[0] == window.pages.order[0]
+
+
+def test_save_data(window, bench, scale):
+    def save():
+        window.selectAll()
+        window.save_data()
+        window.selectNone()
+        window.save_data()
+    bench(save, 2 * len(window.canvas.ids))
+    assert window.model.n_selected == 0
@@ -0,0 +1,107 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from annotateEZ import cli
+from annotateEZ.journal import Journal
+
+
+def log(path, ids, label):
+    journal = Journal(f"{path}.journal")
+    journal.append(ids, label)
+    journal.close()
+
+
+def stored_labels(path):
+    with h5py.File(path, 'r') as file:
+        return list(file['annotations'][:])
+
+
+def test_export_falls_back_to_the_frame_labels(tmp_path, make_file):
+    old = make_file('old.hdf5', 5, frame_labels=[0, 1, 2, 0, 1])
+    new = make_file('new.hdf5', 5, labels=[3, 0, 0, 0, 0],
+                    frame_labels=[0, 1, 2, 0, 1], format='table')
+    log(new, [1, 4], 2)
+    cli.main(['--chunk', '2', 'export', old, new,
+              '--output-dir', str(tmp_path / 'out')])
+    frame = pd.read_csv(tmp_path / 'out' / 'old.txt', sep='\t')
+    assert list(frame['area']) == [0, 1, 2, 3, 4]
+    assert list(frame['label']) == [0, 1, 2, 0, 1]
+    frame = pd.read_csv(tmp_path / 'out' / 'new.txt', sep='\t')
+    assert list(frame['label']) == [3, 2, 0, 0, 2]
+
+
+def test_stats_counts_journal_and_frame_labels(capsys, make_file):
+    old = make_file('old.hdf5', 4, frame_labels=[1, 1, 0, 2])
+    new = make_file('new.hdf5', 3, labels=[0, 2, 0], frame=True)
+    log(new, 0, 1)
+    cli.main(['--chunk', '2', 'stats', old, new])
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == f"{old}: 4 events"
+    assert out[-4:] == ["total: 7 events",
+                        f"    0 {'D':<16}{2:>12}",
+                        f"    1 {'CK':<16}{3:>12}",
+                        f"    2 {'CD':<16}{2:>12}"]
+
+
+@pytest.mark.parametrize('strategy, expected', [
+    ('fill', [1, 3, 2, 2, 0, 1]),
+    ('overwrite', [1, 3, 3, 2, 0, 2]),
+])
+def test_merge(strategy, expected, make_file):
+    # the target only has labels in its data frame and its journal
+    target = make_file('target.hdf5', 6, frame_labels=[1, 0, 2, 0, 0, 1])
+    log(target, 1, 3)
+    source = make_file('source.hdf5', 6, labels=[0, 0, 3, 2, 0, 0],
+                       frame=True)
+    log(source, 5, 2)
+    cli.main(['--chunk', '4', 'merge', target, source,
+              '--strategy', strategy])
+    assert stored_labels(target) == expected
+    assert len(Journal(f"{target}.journal").read()) == 0
+    assert len(Journal(f"{source}.journal").read()) == 1
+
+
+def test_merge_rejects_other_events(make_file):
+    target = make_file('target.hdf5', 4, labels=[1, 0, 0, 0], frame=True)
+    log(target, 1, 2)
+    source = make_file('source.hdf5', 5, frame=True)
+    with pytest.raises(SystemExit):
+        cli.main(['merge', target, source])
+    assert stored_labels(target) == [1, 0, 0, 0]
+    assert len(Journal(f"{target}.journal").read()) == 1
+
+
+def test_convert_uses_a_smaller_chunk_per_thread(tmp_path, monkeypatch,
+                                                 make_file):
+    path = make_file('a.hdf5', 3, frame=True)
+    chunks = []
+
+    def convert_parallel(images, out, chunk, **kwargs):
+        chunks.append(chunk)
+        out[:] = 1
+    monkeypatch.setattr(cli, 'convert_parallel', convert_parallel)
+    cli.main(['convert', path, '--output-dir', str(tmp_path)])
+    cli.main(['--chunk', '100', 'convert', path,
+              '--output-dir', str(tmp_path)])
+    assert chunks == [8192, 100]
+    assert np.load(tmp_path / 'a.rgb.npy').shape == (3, 2, 2, 3)
+
+
+def test_rechunk_keeps_images_and_data(tmp_path, make_file):
+    path = make_file('a.hdf5', 10, labels=[1] * 10, frame=True)
+    with h5py.File(path, 'r+') as file:
+        file['images'][:] = np.arange(10 * 16).reshape(10, 2, 2, 4)
+    out = tmp_path / 'out'
+    cli.main(['rechunk', path, '--page-size', '4', '--output-dir', str(out)])
+    with h5py.File(path, 'r') as source, \
+            h5py.File(out / 'a.hdf5', 'r') as target:
+        assert target['images'].chunks == (4, 2, 2, 4)
+        assert target['images'].compression == 'lzf'
+        assert np.array_equal(target['images'][:], source['images'][:])
+        assert list(target['annotations'][:]) == [1] * 10
+    pd.testing.assert_frame_equal(pd.read_hdf(out / 'a.hdf5', 'features'),
+                                  pd.read_hdf(path, 'features'))
+    page, ids = cli.page_latency(str(out / 'a.hdf5'), 'images', 4)
+    assert page > 0 and ids > 0
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from annotateEZ.convert import DisplayTransform, channel_lut, channels2rgb8bit
+
+
+def reference_rgb8bit(image):
+    "The original float implementation the integer version must match."
+    image = image.astype('float')
+    if image.ndim == 4:
+        image[:, :, :, 0:3] = image[:, :, :, [1, 2, 0]]
+        if image.shape[3] > 3:
+            image = image[:, :, :, 0:3] + np.expand_dims(image[:, :, :, 3], 3)
+    else:
+        image[:, :, 0:3] = image[:, :, [1, 2, 0]]
+        if image.shape[2] > 3:
+            image = image[:, :, 0:3] + np.expand_dims(image[:, :, 3], 2)
+    image[image > 65535] = 65535
+    return (image // 256).astype('uint8')
+
+
+@pytest.mark.parametrize('channels', [3, 4, 5])
+def test_channels2rgb8bit_matches_reference(channels):
+    rng = np.random.default_rng(channels)
+    images = rng.integers(0, 65536, (37, 9, 11, channels), dtype='uint16')
+    # saturated sums and the edges of the value range
+    images[0] = 65535
+    images[1] = 0
+    images[2, :, :, 3 % channels] = 40000
+    expected = reference_rgb8bit(images)
+    assert np.array_equal(channels2rgb8bit(images, chunk=8), expected)
+    out = np.full(expected.shape, 7, dtype='uint8')
+    channels2rgb8bit(images, out=out)
+    assert np.array_equal(out, expected)
+    assert np.array_equal(channels2rgb8bit(images[5]), expected[5])
+
+
+def test_channel_lut_window_and_gamma():
+    lut = channel_lut(1000, 3000, 1.0)
+    assert lut.shape == (65536,) and lut.dtype == np.dtype('uint8')
+    assert lut[0] == lut[1000] == 0
+    assert lut[2000] == 128
+    assert lut[3000] == lut[65535] == 255
+    assert (np.diff(lut.astype('int')) >= 0).all()
+    gamma = channel_lut(0, 65535, 2.0)
+    assert gamma[32768] == round(255 * (32768 / 65535)**2)
+    assert channel_lut(0, 65535, 0.5)[16384] == \
+        round(255 * (16384 / 65535)**0.5)
+
+
+def test_display_transform_colors():
+    transform = DisplayTransform([
+        {'color': 'red', 'max': 1000},
+        {'color': 'cyan', 'max': 1000},
+        {'color': 'orange', 'max': 1000},
+        {'color': 'white', 'active': False},
+    ])
+    image = np.zeros((2, 3, 4), dtype='uint16')
+    image[0, 0] = [1000, 0, 0, 65535]
+    image[0, 1] = [0, 500, 0, 0]
+    image[0, 2] = [0, 0, 1000, 0]
+    # orange and red saturate the red output
+    image[1, 0] = [1000, 0, 1000, 0]
+    rgb = transform(image)
+    assert rgb[0, 0].tolist() == [255, 0, 0]
+    assert rgb[0, 1].tolist() == [0, 128, 128]
+    assert rgb[0, 2].tolist() == [255, 165, 0]
+    assert rgb[1, 0].tolist() == [255, 165, 0]
+    assert rgb[1, 1].tolist() == [0, 0, 0]
+    assert transform.channel(image, 1)[0, 1] == 128
+
+
+def test_default_transform_matches_channels2rgb8bit():
+    transform = DisplayTransform([{} for _ in range(4)])
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 16384, (5, 4, 4, 4), dtype='uint16')
+    expected = channels2rgb8bit(images).astype('int')
+    assert np.abs(transform(images).astype('int') - expected).max() <= 2
+
+
+def test_percentile_window_follows_the_sample():
+    transform = DisplayTransform([{'color': 'gray', 'percentile': [10, 90]}])
+    sample = np.arange(1001, dtype='uint16').reshape(7, 11, 13, 1)
+    transform.fit(sample)
+    low, high = transform.limits[0]
+    assert (low, high) == tuple(np.percentile(np.arange(1001), [10, 90]))
+    image = np.array([[[int(low)], [int(high)], [500]]], dtype='uint16')
+    rgb = transform(image)
+    assert rgb[0, 0].tolist() == [0, 0, 0]
+    assert rgb[0, 1].tolist() == [255, 255, 255]
+    assert rgb[0, 2].tolist() == [128] * 3
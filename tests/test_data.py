@@ -0,0 +1,103 @@
+import h5py
+import numpy as np
+import pytest
+
+from annotateEZ.data import ImageStore, Session
+
+
+def make_files(make_file, sizes):
+    "Files whose events hold their session-wide id in every pixel."
+    paths = []
+    start = 0
+    for i, n in enumerate(sizes):
+        ids = np.arange(start, start + n, dtype='uint16')
+        paths.append(make_file(f"{i}.hdf5", images=np.broadcast_to(
+            ids[:, None, None, None], (n, 2, 3, 4))))
+        start += n
+    return paths
+
+
+def event_ids(images):
+    return(list(images[:, 0, 0, 0]))
+
+
+@pytest.fixture
+def session(make_file):
+    session = Session(make_files(make_file, [3, 1, 4]), 'images', page_size=3)
+    yield session
+    session.close()
+
+
+def test_read_spans_files(session):
+    assert session.n_events == 8
+    assert session.n_pages == 3
+    assert event_ids(session.read(0, 8)) == list(range(8))
+    assert event_ids(session.read(2, 5)) == [2, 3, 4]
+    assert event_ids(session.read(3, 4)) == [3]
+
+
+def test_read_pads_past_the_last_event(session):
+    images = session.read(6, 10)
+    assert images.shape == (4, 2, 3, 4)
+    assert event_ids(images) == [6, 7, 0, 0]
+    assert not images[2:].any()
+    assert event_ids(session.read_page(3)) == [6, 7, 0]
+
+
+def test_read_ids_keeps_the_given_order(session):
+    ids = [7, 0, 3, 2, 7]
+    assert event_ids(session.read_ids(ids, max_gap=0)) == ids
+    assert event_ids(session.read_ids(ids)) == ids
+
+
+def test_locate_and_split(session):
+    files, local = session.locate(np.array([0, 2, 3, 4, 7]))
+    assert list(files) == [0, 0, 1, 2, 2]
+    assert list(local) == [0, 2, 0, 0, 3]
+    assert [(i, list(ids)) for i, ids in session.split([7, 0, 3])] == \
+        [(0, [0]), (1, [0]), (2, [3])]
+
+
+def test_least_recently_used_file_is_closed(make_file):
+    session = Session(make_files(make_file, [2, 2, 2]), 'images', 2,
+                      max_open=2)
+    assert event_ids(session.read(0, 6)) == list(range(6))
+    assert list(session.open_stores) == [1, 2]
+    session.read(0, 1)
+    assert list(session.open_stores) == [2, 0]
+    session.close()
+    assert not session.open_stores
+
+
+def test_mismatched_files_are_rejected(make_file):
+    paths = make_files(make_file, [2]) + [make_file('other.hdf5', 2)]
+    with pytest.raises(ValueError):
+        Session(paths, 'images', 2)
+
+
+def test_chunk_cache_holds_several_chunks(tmp_path):
+    path = str(tmp_path / 'a.hdf5')
+    with h5py.File(path, 'w') as file:
+        file.create_dataset('images', shape=(4096, 32, 32, 4),
+                            dtype='uint16', chunks=(1024, 32, 32, 4))
+    store = ImageStore(path, 'images', page_size=1024)
+    chunk_bytes = 1024 * 32 * 32 * 4 * 2
+    for _ in range(2):
+        _, nbytes, _ = store.dataset.id.get_access_plist().get_chunk_cache()
+        assert nbytes == store.cache_chunks * chunk_bytes
+        assert store.read(4090, 4100).shape == (10, 32, 32, 4)
+        store.close()
+        store.open()
+    store.close()
+
+
+def test_changed_grid_shows_the_events_of_its_ids(window):
+    from annotateEZ.annotateEZ import config
+    config['x_size'] = config['y_size'] = 10
+    window.apply_settings()
+    window.current_page = 2
+    window.reset_map()
+    ids = window.canvas.ids
+    assert ids[0] == 100
+    raw = window.prefetcher.get_raw(2)
+    assert np.array_equal(raw, window.store.read_ids(ids))
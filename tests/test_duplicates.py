@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from annotateEZ import cli
+from annotateEZ.duplicates import (
+    DuplicateGroups, find_groups, popcount, read_groups, tile_hash)
+
+
+def smooth_cells(rng, n, low, high, size=16):
+    "Gaussian cells of random place, width and brightness with shot noise."
+    return(gaussian_cells(rng, *rng.uniform(4, size - 4, (2, n)),
+                          rng.uniform(1, 4, n), low, high, size))
+
+
+def gaussian_cells(rng, cy, cx, sigma, low, high, size=16):
+    y, x = np.mgrid[0:size, 0:size]
+    cy, cx, sigma = (np.asarray(v, 'float')[:, None, None]
+                     for v in (cy, cx, sigma))
+    peak = rng.uniform(low, high, (len(cy), 1, 1))
+    cells = peak * np.exp(-((y - cy)**2 + (x - cx)**2) / (2 * sigma**2))
+    cells = cells[..., None] * np.array([1, 0.5, 0.3, 0.1]) + 10
+    return rng.poisson(cells).astype('uint16')
+
+
+def spread(hashes, representative):
+    return popcount(hashes ^ hashes[representative])
+
+
+def test_dim_cells_are_not_grouped():
+    # an 8-bit conversion maps all of these to black tiles
+    rng = np.random.default_rng(0)
+    cells = smooth_cells(rng, 2000, 20, 200)
+    representative = find_groups(tile_hash(cells))
+    assert np.count_nonzero(representative != np.arange(2000)) < 20
+
+
+@pytest.mark.parametrize('low, high', [(20, 200), (2000, 60000)])
+def test_distinct_smooth_cells_are_not_grouped(low, high):
+    # cells 3 pixels apart or of another width, wide enough to span
+    # several cells of the hash
+    cy, cx, sigma = np.meshgrid(np.arange(3, 14, 3), np.arange(3, 14, 3),
+                                [1, 2, 3.5])
+    cells = gaussian_cells(np.random.default_rng(1), cy.ravel(), cx.ravel(),
+                           sigma.ravel(), low, high)
+    representative = find_groups(tile_hash(cells))
+    assert (representative == np.arange(len(cells))).all()
+
+
+def test_groups_stay_close_to_their_representative():
+    rng = np.random.default_rng(1)
+    hashes = tile_hash(smooth_cells(rng, 2000, 2000, 60000))
+    representative = find_groups(hashes)
+    assert (spread(hashes, representative) <= 3).all()
+    # representatives are the first event of their group
+    assert (representative <= np.arange(2000)).all()
+    assert (representative[representative] == representative).all()
+
+
+def test_copies_are_found_at_any_brightness():
+    rng = np.random.default_rng(2)
+    cells = smooth_cells(rng, 300, 20, 20000)
+    copies = np.concatenate([cells, cells * 2, cells[::-1]])
+    representative = find_groups(tile_hash(copies))
+    ids = np.arange(300)
+    assert (representative[ids + 300] == representative[ids]).all()
+    assert (representative[600 + ids] == representative[299 - ids]).all()
+
+
+def test_chains_are_split():
+    # each hash is one bit away from the one before
+    bits = np.random.default_rng(3).permutation(64)[:20]
+    hashes = np.bitwise_xor.accumulate(
+        np.uint64(1) << bits.astype('uint64'))
+    representative = find_groups(hashes)
+    assert len(np.unique(representative)) > 1
+    assert (spread(hashes, representative) <= 3).all()
+
+
+def test_distance_is_limited_by_the_bands():
+    with pytest.raises(ValueError):
+        find_groups(np.zeros(3, dtype='uint64'), distance=4)
+
+
+def test_members_and_collapse():
+    groups = DuplicateGroups([0, 0, 2, 0, 2, 5])
+    assert groups.n_groups == 3
+    assert sorted(groups.members([3])) == [0, 1, 3]
+    assert sorted(groups.members([4, 5, 9])) == [2, 4, 5]
+    assert list(groups.collapse()) == [0, 2, 5]
+    assert list(groups.collapse([4, 3, 1, 5])) == [4, 3, 5]
+
+
+def test_dedup_groups_across_files(make_file):
+    cy, cx = np.meshgrid(np.arange(3, 14, 3), np.arange(3, 14, 3))
+    cells = gaussian_cells(np.random.default_rng(4), cy.ravel(), cx.ravel(),
+                           np.full(16, 2), 2000, 20000)
+    a = make_file('a.hdf5', images=cells[:10])
+    # the first four events of b repeat events 6-9 of a, brighter
+    b = make_file('b.hdf5',
+                  images=np.concatenate([cells[6:10] * 2, cells[10:]]))
+    cli.main(['--chunk', '3', 'dedup', a, b])
+    groups = read_groups([a, b], 'duplicates', [10, 10])
+    assert list(groups.representative) == \
+        list(range(10)) + [6, 7, 8, 9] + list(range(14, 20))
+    # without the file of the representatives the copies are their own
+    groups = read_groups([b], 'duplicates', [10])
+    assert groups.n_groups == 10
+    groups = read_groups([b, a], 'duplicates', [10, 10])
+    assert list(groups.representative[10:]) == \
+        list(range(10, 16)) + [0, 1, 2, 3]
+
+
+def test_dedup_rejects_distances_past_the_bands(make_file):
+    path = make_file('a.hdf5', 2)
+    with pytest.raises(SystemExit):
+        cli.main(['dedup', path, '--distance', '4'])
+
+
+def test_dedup_hashes_smaller_chunks(make_file, monkeypatch):
+    path = make_file('a.hdf5', 5000)
+    chunks = []
+
+    def tile_hash(images):
+        chunks.append(len(images))
+        return np.zeros(len(images), dtype='uint64')
+    monkeypatch.setattr(cli, 'tile_hash', tile_hash)
+    cli.main(['dedup', path])
+    cli.main(['--chunk', '3000', 'dedup', path])
+    assert chunks == [4096, 904, 3000, 2000]
@@ -0,0 +1,75 @@
+import os
+
+import h5py
+import numpy as np
+import torch
+
+from annotateEZ import eval
+from annotateEZ.similar import SimilarIndex
+
+
+class ChannelModel(torch.nn.Module):
+    "Predicts the brightest channel, embeds the first three channel means."
+
+    def forward(self, images):
+        return images.mean(dim=(2, 3)) * 10
+
+    @torch.jit.export
+    def embed(self, images):
+        return images.mean(dim=(2, 3))[:, :3]
+
+
+def brightest_channels(make_file, n):
+    images = np.full((n, 2, 2, 4), 1000, dtype='uint16')
+    images[np.arange(n), ..., np.arange(n) % 4] = 60000
+    return make_file('a.hdf5', images=images)
+
+
+def save_model(tmp_path):
+    path = str(tmp_path / 'model.pt')
+    torch.jit.script(ChannelModel()).save(path)
+    return path
+
+
+def test_predictions_are_written_as_columns(tmp_path, make_file):
+    path = brightest_channels(make_file, 10)
+    eval.main([path, '--model', save_model(tmp_path), '--chunk', '3',
+               '--workers', '0'])
+    with h5py.File(path, 'r') as file:
+        assert sorted(file['columns']) == ['pred_label', 'pred_score']
+        labels = file['columns/pred_label'][:]
+        scores = file['columns/pred_score'][:]
+        assert 'embeddings' not in file
+    assert labels.dtype == np.dtype('uint8')
+    assert list(labels) == list(np.arange(10) % 4)
+    logits = np.array([60000] + [1000] * 3) / 65535 * 10
+    expected = np.exp(logits[0]) / np.exp(logits).sum()
+    assert np.allclose(scores, expected, rtol=1e-5)
+
+
+def test_embeddings_are_indexed(tmp_path, make_file):
+    path = brightest_channels(make_file, 12)
+    eval.main([path, '--model', save_model(tmp_path), '--chunk', '5',
+               '--workers', '0', '--prefix', 'cnn', '--embed',
+               '--lists', '3'])
+    assert not os.path.exists(f"{path}.embeddings.npy")
+    with h5py.File(path, 'r') as file:
+        assert sorted(file['columns']) == ['cnn_label', 'cnn_score']
+        group = file['embeddings']
+        assert sorted(group) == \
+            ['centroids', 'ids', 'offsets', 'position', 'vectors']
+        assert group['centroids'].shape == (3, 3)
+        assert group['vectors'].shape == (12, 3)
+        assert group['vectors'].dtype == np.dtype('float16')
+        offsets, ids = group['offsets'][:], group['ids'][:]
+        position = group['position'][:]
+        vectors = group['vectors'][:]
+    assert offsets[0] == 0 and offsets[-1] == 12
+    assert sorted(ids) == list(range(12))
+    assert np.array_equal(ids[position], np.arange(12))
+    # events of the fourth channel embed to the same vector as each other
+    fourth = vectors[position[3::4]]
+    assert np.allclose(fourth, fourth[0], atol=1e-3)
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1, atol=1e-2)
+    index = SimilarIndex([path], 'embeddings', [12])
+    assert set(index.search(1, k=3, probes=3)) == {1, 5, 9}
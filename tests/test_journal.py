@@ -0,0 +1,88 @@
+import os
+
+import h5py
+import numpy as np
+
+from annotateEZ.data import Session
+from annotateEZ.journal import RECORD, Journal, SessionJournal
+
+
+def test_replay_last_record_wins(tmp_path):
+    journal = Journal(str(tmp_path / 'a.journal'))
+    journal.append([1, 2, 3], 1)
+    journal.append(2, 0)
+    journal.append([3, 99], 4)
+    journal.close()
+    labels = np.zeros(5, dtype='uint8')
+    ids = journal.replay(labels)
+    assert list(ids) == [1, 2, 3]
+    assert list(labels) == [0, 1, 0, 4, 0]
+
+
+def test_torn_record_is_ignored(tmp_path):
+    path = str(tmp_path / 'a.journal')
+    journal = Journal(path)
+    journal.append([0, 1], 2)
+    journal.close()
+    # a crash in the middle of a write leaves part of a record
+    with open(path, 'ab') as file:
+        file.write(b'\x03\x00\x00')
+    assert len(journal.read()) == 2
+    labels = np.zeros(3, dtype='uint8')
+    journal.replay(labels)
+    assert list(labels) == [2, 2, 0]
+    # appending drops the torn bytes instead of misaligning new records
+    journal.append(2, 3)
+    journal.close()
+    assert os.path.getsize(path) == 3 * RECORD.itemsize
+    assert list(journal.read()['id']) == [0, 1, 2]
+
+
+def test_truncate_drops_records(tmp_path):
+    journal = Journal(str(tmp_path / 'a.journal'))
+    journal.append([0, 1], 1)
+    journal.truncate()
+    assert len(journal.read()) == 0
+    journal.append(2, 1)
+    journal.close()
+    assert list(journal.read()['id']) == [2]
+
+
+def test_idle_records_are_synced_after_the_interval(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+    journal = Journal(str(tmp_path / 'a.journal'), sync_interval=60)
+    journal.append([0, 1], 1)
+    journal.sync_due()
+    assert not synced and journal.unsynced == 2
+    journal.last_sync -= 60
+    journal.sync_due()
+    assert len(synced) == 1 and journal.unsynced == 0
+    journal.sync_due()
+    assert len(synced) == 1
+    journal.close()
+
+
+def test_session_journal_uses_local_ids(make_file):
+    paths = [make_file('a.hdf5', 3), make_file('b.hdf5', 4)]
+    session = Session(paths, 'images', page_size=2)
+    journal = SessionJournal(session)
+    journal.append([1, 3, 6], 1)
+    journal.close()
+    assert list(Journal(f"{paths[0]}.journal").read()['id']) == [1]
+    assert list(Journal(f"{paths[1]}.journal").read()['id']) == [0, 3]
+    labels = np.zeros(7, dtype='uint8')
+    assert list(journal.replay(labels)) == [1, 3, 6]
+    assert list(np.flatnonzero(labels)) == [1, 3, 6]
+
+
+def test_save_truncates_journals(window):
+    window.model.set_many([1, 2], 1)
+    journal = window.journal.journals[0]
+    assert len(journal.read()) == 2
+    window.save_data()
+    assert len(journal.read()) == 0
+    with h5py.File(window.paths[0], 'r') as file:
+        assert list(file['annotations'][:4]) == [0, 1, 1, 0]
+    window.model.set_many([1, 2], 0)
+    window.save_data()
@@ -0,0 +1,73 @@
+import h5py
+import numpy as np
+
+from annotateEZ.labels import LabelModel, LabelStore
+
+
+def test_load_leaves_file_unchanged(make_file):
+    path = make_file('a.hdf5', 10)
+    initial = np.arange(10) % 3
+    labels = LabelStore(path, 'annotations', 10).load(initial)
+    assert np.array_equal(labels, initial)
+    with h5py.File(path, 'r') as file:
+        assert list(file) == ['images']
+
+
+def test_first_save_creates_dataset(make_file):
+    path = make_file('a.hdf5', 10)
+    store = LabelStore(path, 'annotations', 10, chunk=4)
+    labels = store.load(np.full(10, 2))
+    labels[3] = 1
+    assert store.save(labels, [3], names=['D', 'CK', 'CD']) == 3
+    with h5py.File(path, 'r') as file:
+        assert np.array_equal(file['annotations'][:], labels)
+        assert list(file['labels'].asstr()[:]) == ['D', 'CK', 'CD']
+    assert np.array_equal(LabelStore(path, 'annotations', 10).load(), labels)
+
+
+def test_save_writes_only_changed_chunks(make_file):
+    path = make_file('a.hdf5', 10)
+    store = LabelStore(path, 'annotations', 10, chunk=4)
+    labels = store.load()
+    store.save(labels, [])
+    # a chunk written behind the store's back shows whether it is rewritten
+    with h5py.File(path, 'r+') as file:
+        file['annotations'][0:4] = 9
+    labels[5] = 1
+    labels[9] = 2
+    assert store.save(labels, [5, 9]) == 2
+    with h5py.File(path, 'r') as file:
+        saved = file['annotations'][:]
+    assert (saved[0:4] == 9).all()
+    assert np.array_equal(saved[4:], labels[4:])
+
+
+def test_keymap_follows_names(make_file):
+    path = make_file('a.hdf5', 4)
+    store = LabelStore(path, 'annotations', 4)
+    labels = store.load()
+    store.save(labels, [], names=['D', 'CK'])
+    store.save(labels, [], names=['D', 'CK', 'V'])
+    with h5py.File(path, 'r') as file:
+        assert list(file['labels'].asstr()[:]) == ['D', 'CK', 'V']
+
+
+def test_model_counts_and_dirty():
+    model = LabelModel(np.zeros(8, dtype='uint8'), 3)
+    model.set(2, 1)
+    assert model.set_many([1, 2, 3, 20], 2) == 3
+    assert list(model.counts) == [5, 0, 3]
+    assert list(model.take_dirty()) == [1, 2, 3]
+    assert len(model.take_dirty()) == 0
+
+
+def test_dirty_survives_groups_and_failed_saves():
+    model = LabelModel(np.zeros(6, dtype='uint8'), 2)
+    model.groups = lambda ids: np.concatenate([ids, np.asarray(ids) + 3])
+    model.set(1, 1)
+    dirty = model.take_dirty()
+    assert list(dirty) == [1, 4]
+    # a failed save marks the events dirty again
+    model.dirty[dirty] = True
+    model.set_many([0], 1)
+    assert list(model.take_dirty()) == [0, 1, 3, 4]
@@ -0,0 +1,102 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from annotateEZ.metadata import ColumnStore, frame_labels
+
+
+def make_frame(n, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'area': rng.random(n).astype('float32'),
+        'count': rng.integers(0, 100, n),
+        'score': rng.random(n),
+        'flag': rng.random(n) > 0.5,
+        'name': [f"cell{i}" for i in range(n)],
+        'label': rng.integers(0, 3, n),
+    })
+
+
+FORMATS = {
+    'fixed': {'format': 'fixed'},
+    'table': {'format': 'table'},
+    'data_columns': {'format': 'table', 'data_columns': True},
+}
+
+
+@pytest.fixture(params=list(FORMATS))
+def files(request, tmp_path):
+    "Two files of one frame format, only the second with a prediction."
+    paths = []
+    for i, n in enumerate([7, 5]):
+        path = str(tmp_path / f"{i}.hdf5")
+        make_frame(n, i).to_hdf(path, key='features', mode='w',
+                                **FORMATS[request.param])
+        paths.append(path)
+    with h5py.File(paths[1], 'a') as file:
+        file.create_dataset('columns/prediction', data=np.arange(5.0))
+    store = ColumnStore(paths, 'features', 'columns', [7, 5])
+    frames = [pd.read_hdf(path, 'features') for path in paths]
+    return request.param, store, frames
+
+
+def test_numeric_columns(files):
+    _, store, _ = files
+    assert sorted(store.numeric) == \
+        ['area', 'count', 'flag', 'prediction', 'score']
+    assert 'label' in store
+
+
+def test_get_matches_pandas(files):
+    _, store, frames = files
+    for name in ['area', 'count', 'score', 'flag']:
+        expected = np.concatenate([frame[name] for frame in frames])
+        assert np.array_equal(store.get(name), expected)
+    prediction = store.get('prediction')
+    assert np.isnan(prediction[:7]).all()
+    assert list(prediction[7:]) == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_where_matches_pandas(files, cached):
+    _, store, frames = files
+    if cached:
+        store.get('score')
+    ids, values = store.where('score', 0.2, 0.7, chunk=3)
+    scores = np.concatenate([frame['score'] for frame in frames])
+    expected = np.flatnonzero((scores >= 0.2) & (scores <= 0.7))
+    assert list(ids) == list(expected)
+    assert np.array_equal(values, scores[expected])
+
+
+def test_row_matches_pandas(files):
+    layout, store, frames = files
+    for id in [0, 6, 7, 11]:
+        frame, local = (frames[0], id) if id < 7 else (frames[1], id - 7)
+        row = store.row(id)
+        assert 'label' not in row
+        for name in ['area', 'count', 'score', 'flag']:
+            assert row[name] == frame[name].iloc[local]
+        # strings of the fixed format are pickled and not read
+        assert ('name' in row) == (layout != 'fixed')
+        if 'name' in row:
+            assert row['name'] == frame['name'].iloc[local]
+        assert ('prediction' in row) == (id >= 7)
+
+
+def test_frame_adds_extra_columns(files):
+    _, store, frames = files
+    frame = store.frame('features', 1)
+    pd.testing.assert_frame_equal(frame[frames[1].columns], frames[1])
+    assert list(frame['prediction']) == [0, 1, 2, 3, 4]
+    assert np.isnan(store.frame('features', 0)['prediction']).all()
+
+
+def test_frame_labels(files):
+    _, store, frames = files
+    with h5py.File(store.paths[0], 'r') as file:
+        labels = frame_labels(file, 'features', slice(2, 5))
+        assert labels.dtype == np.dtype('uint8')
+        assert list(labels) == list(frames[0]['label'][2:5])
+        assert frame_labels(file, 'missing') is None
@@ -0,0 +1,29 @@
+import json
+
+from annotateEZ.metrics import Metrics
+
+
+def lines(path):
+    with open(path) as file:
+        return([json.loads(line) for line in file])
+
+
+def test_spans_are_written_in_batches(tmp_path):
+    path = tmp_path / 'metrics.jsonl'
+    metrics = Metrics()
+    metrics.flush_lines = 3
+    metrics.open(path)
+    for _ in range(2):
+        with metrics.span('paint', page=1):
+            pass
+    assert lines(path) == []
+    metrics.record('paint', 0.002)
+    assert [line['span'] for line in lines(path)] == ['paint'] * 3
+    metrics.count('hits')
+    metrics.record('paint', 0.001)
+    metrics.write_counters()
+    assert lines(path)[-1]['counters'] == {'hits': 1}
+    metrics.record('paint', 0.001)
+    metrics.close()
+    assert len(lines(path)) == 6
+    assert metrics.summary()[0].startswith('paint:')
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from annotateEZ.order import EventIndex
+
+VALUES = np.array([0.5, 0.1, 0.9, 0.1, 0.7, 0.3])
+
+
+def where(column, low, high):
+    "Push-down filter as `ColumnStore.where` returns it."
+    mask = np.ones(len(VALUES), dtype=bool)
+    if low is not None:
+        mask &= VALUES >= low
+    if high is not None:
+        mask &= VALUES <= high
+    ids = np.flatnonzero(mask)
+    return(ids, VALUES[ids])
+
+
+@pytest.fixture(params=['argsort', 'where'])
+def index(request):
+    calls = []
+
+    def get_column(name):
+        calls.append(name)
+        return(VALUES)
+    index = EventIndex(get_column,
+                       where if request.param == 'where' else None)
+    index.calls = calls
+    return index
+
+
+def test_order_ascending_and_descending(index):
+    assert list(index.order('area')) == [1, 3, 5, 0, 4, 2]
+    assert list(index.order('area', descending=True)) == [2, 4, 0, 5, 3, 1]
+
+
+@pytest.mark.parametrize('low, high, expected', [
+    (0.3, None, [5, 0, 4, 2]),
+    (None, 0.3, [1, 3, 5]),
+    (0.2, 0.8, [5, 0, 4]),
+    (0.95, None, []),
+])
+def test_filter(index, low, high, expected):
+    ids = index.order('area', low=low, high=high)
+    assert list(ids) == expected
+    ids = index.order('area', descending=True, low=low, high=high)
+    assert list(ids) == expected[::-1]
+
+
+def test_filter_agrees_before_and_after_sorting():
+    index = EventIndex(lambda name: VALUES, where)
+    pushed = index.order('area', low=0.1, high=0.7)
+    index.order('area')
+    assert 'area' in index.argsorts
+    assert list(index.order('area', low=0.1, high=0.7)) == list(pushed)
+
+
+def test_argsort_is_computed_once(index):
+    index.order('area')
+    index.order('area', descending=True)
+    index.order('area', low=0.2)
+    assert index.calls.count('area') <= 2
+    index.clear()
+    index.order('area')
+    assert 'area' in index.argsorts
@@ -0,0 +1,33 @@
+import h5py
+import numpy as np
+
+from annotateEZ.similar import SimilarIndex, write_index
+
+
+def test_search_returns_the_query_first(tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(300, 8))
+    # an exact copy ties with the query
+    embeddings[5] = embeddings[3]
+    path = tmp_path / 'embeddings.hdf5'
+    h5py.File(path, 'w').close()
+    write_index(path, 'embeddings', embeddings)
+    index = SimilarIndex([path], 'embeddings', [300])
+    ids = index.search(3, k=10, probes=1000)
+    assert list(ids[:2]) == [3, 5]
+    assert len(set(ids)) == 10
+    vectors = index.vectors(np.arange(300))
+    exact = np.argsort(vectors @ vectors[3], kind='stable')[::-1][:10]
+    assert set(ids) == set(exact)
+
+
+def test_find_similar_is_disabled_on_padding(window):
+    canvas = window.canvas
+    canvas.find_similar = lambda id: None
+    assert canvas.can_find_similar(0)
+    window.current_page = window.n_pages
+    window.reset_map()
+    n_shown = window.n_events - (window.n_pages - 1) * len(canvas.ids)
+    assert canvas.can_find_similar(n_shown - 1)
+    assert not canvas.can_find_similar(n_shown)
+    assert canvas.ids[n_shown] >= window.n_events
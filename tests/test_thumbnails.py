@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+
+from annotateEZ.data import Session
+from annotateEZ.thumbnails import ThumbnailCache
+
+
+def make_session(make_file, n=6):
+    path = make_file('a.hdf5', images=np.arange(
+        n * 2 * 2 * 4, dtype='uint16').reshape(n, 2, 2, 4))
+    return Session([path], 'images', page_size=3)
+
+
+def cached_files(directory):
+    return sorted(name for name in os.listdir(directory)
+                  if not name.endswith('.done.npy'))
+
+
+def test_thumbnails_are_stored_per_setting(tmp_path, make_file):
+    session = make_session(make_file)
+    cache = ThumbnailCache(str(tmp_path / 'cache'), 1 << 30)
+    thumbnails = cache.session(session, 'a')
+    assert thumbnails.get([0, 1]) is None
+    rgb = np.full((2, 2, 2, 3), 7, dtype='uint8')
+    thumbnails.put([0, 1], rgb)
+    assert np.array_equal(thumbnails.get([0, 1]), rgb)
+    cache.release(thumbnails)
+    assert np.array_equal(cache.session(session, 'a').get([0, 1]), rgb)
+    assert cache.session(session, 'b').get([0, 1]) is None
+    assert len(cached_files(cache.directory)) == 2
+
+
+def test_released_thumbnails_are_evicted(tmp_path, make_file):
+    session = make_session(make_file)
+    cache = ThumbnailCache(str(tmp_path / 'cache'), 0)
+
+    def names(*sessions):
+        return sorted(os.path.basename(f.path)
+                      for thumbnails in sessions for f in thumbnails.files)
+    first = cache.session(session, 'a')
+    again = cache.session(session, 'a')
+    cache.release(first)
+    # still used by the second session of the same settings
+    b = cache.session(session, 'b')
+    assert cached_files(cache.directory) == names(first, b)
+    cache.release(again)
+    c = cache.session(session, 'c')
+    assert cached_files(cache.directory) == names(b, c)
+    assert set(cache.in_use) == {f.path for f in b.files + c.files}
+
+
+def test_display_changes_open_one_thumbnail_session(window, tmp_path):
+    window.thumbnail_cache = ThumbnailCache(str(tmp_path / 'cache'), 1 << 30)
+    window.open_thumbnails()
+    first = window.thumbnails
+    for _ in range(3):
+        window.update_display()
+        assert window.thumbnails is None
+        assert window.thumbnail_timer.isActive()
+    assert not window.thumbnail_cache.in_use
+    window.open_thumbnails()
+    assert window.thumbnails is not first
+    assert window.prefetcher.thumbnails is window.thumbnails
+    assert len(window.thumbnail_cache.in_use) == 1
+    assert len(cached_files(tmp_path / 'cache')) == 1
+    window.thumbnail_timer.stop()